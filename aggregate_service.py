@@ -0,0 +1,339 @@
+"""Read-only HTTP/JSON service for the aggregates the dashboard shows.
+
+A plain WSGI application on the same dataset registry, cube and binning code as the Streamlit
+app, so other dashboards can query it instead of scraping download buttons:
+
+    python aggregate_service.py --port 8502
+
+    GET /datasets
+    GET /dimensions
+    GET /group-means?group=Region&metric=awkward_score&metric=identity&gender_str=男
+    GET /threshold-counts?metric=awkward_score&thresholds=-4,-2
+    GET /crosstab?metric=awkward_score&thresholds=-4,-2&category=Region
+    GET /quality
+
+Every endpoint takes `wave` (repeatable, default: the first dataset) and the filter dimensions
+major, grade, Region, gender_str and native_str, each repeatable; major and grade take the labels
+shown in the app. `exclude` (repeatable) leaves out the responses flagged by those quality checks
+(speeding, straight_lining, invalid_prob, duplicate_user, duplicate_ip); as in the app and
+report.py, it defaults to quality.DEFAULT_EXCLUDED, and `exclude=none` keeps every response. Responses carry an ETag derived from the content hash of the selected exports
+and the query, so unchanged data is answered with 304 Not Modified. `request(app, url)` runs
+the application in-process, without a socket. Unknown query parameters are answered with 400
+rather than ignored.
+"""
+import argparse
+import hashlib
+import io
+import json
+import socketserver
+import sys
+import threading
+import traceback
+from urllib.parse import parse_qs, urlsplit
+from wsgiref.simple_server import WSGIServer, make_server
+from wsgiref.util import setup_testing_defaults
+
+import numpy as np
+
+import dataset_registry
+import memo
+import quality
+import survey_analysis
+import survey_data
+
+
+class QueryError(ValueError):
+    """Invalid query parameters; answered with 400."""
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def _one(query, name, required=True):
+    values = query.get(name, [])
+    if len(values) > 1:
+        raise QueryError(f"'{name}' takes a single value")
+    if not values:
+        if required:
+            raise QueryError(f"missing '{name}'")
+        return None
+    return values[0]
+
+
+def _thresholds(query):
+    raw = _one(query, 'thresholds')
+    try:
+        thresholds = sorted(float(x) for x in raw.split(',') if x.strip())
+    except ValueError:
+        raise QueryError("'thresholds' must be comma-separated numbers") from None
+    if not thresholds:
+        raise QueryError("'thresholds' needs at least one number")
+    return thresholds
+
+
+def _metric(dataset, query):
+    metric = _one(query, 'metric')
+    if metric not in dataset['cube']['sum'].columns:
+        raise QueryError(f"unknown metric '{metric}'")
+    return metric
+
+
+def _grouping_key(dataset, query, name):
+    key = _one(query, name)
+    if key not in survey_analysis.GROUPING_KEYS or key not in dataset['outputs'][0].columns:
+        raise QueryError(f"'{name}' must be one of {[k for k in survey_analysis.GROUPING_KEYS if k in dataset['outputs'][0].columns]}")
+    return key
+
+
+def _selections(dataset, query):
+    # Same shape as the app's filter_selections: major/grade by code, the rest by value
+    _, _, _, major_mapping, grade_mapping, *_ = dataset['outputs']
+    coded = {'major': major_mapping, 'grade': grade_mapping}
+    selections = {}
+    for dim in survey_analysis.FILTER_DIMENSIONS:
+        values = query.get(dim)
+        if dim == 'quality_flags':
+            values = query.get('exclude', quality.DEFAULT_EXCLUDED)
+            if values == ['none']:
+                values = []
+            unknown = [v for v in values if v not in quality.QUALITY_CHECKS]
+            if unknown:
+                raise QueryError(f"unknown quality check {unknown}; available: {list(quality.QUALITY_CHECKS)}")
+            selections[dim] = quality.passing_values(values)
+            continue
+        if not values:
+            continue
+        if dim in coded:
+            unknown = [v for v in values if v not in coded[dim]]
+            if unknown:
+                raise QueryError(f"unknown {dim} {unknown}")
+            values = [coded[dim][v] for v in values]
+        selections[dim] = values
+    return selections
+
+
+def _filtered(dataset, query):
+    return survey_analysis.apply_filters(dataset['outputs'][0], dataset['filter_index'], _selections(dataset, query))
+
+
+# --- Endpoints: (service, dataset, query) -> JSON-able result ---
+def datasets_endpoint(service, dataset, query):
+    return {'datasets': [{'name': name, 'path': path} for name, path in service.discover().items()]}
+
+
+def dimensions_endpoint(service, dataset, query):
+    df, question_cols, _, major_mapping, grade_mapping, *_ = dataset['outputs']
+    filters = {}
+    for dim in survey_analysis.FILTER_DIMENSIONS:
+        if dim == 'major':
+            filters[dim] = list(major_mapping)
+        elif dim == 'grade':
+            filters[dim] = list(grade_mapping)
+        elif dim == 'quality_flags':
+            filters['exclude'] = quality.QUALITY_CHECKS
+            filters['exclude_default'] = quality.DEFAULT_EXCLUDED
+        elif dim in df.columns:
+            filters[dim] = sorted(df[dim].dropna().unique().tolist())
+    return {
+        'rows': len(df),
+        'metrics': list(dataset['cube']['sum'].columns),
+        'groups': {key: survey_analysis.GROUPING_LABELS.get(key, key)
+                   for key in survey_analysis.GROUPING_KEYS if key in df.columns},
+        'filters': filters,
+    }
+
+
+def group_means_endpoint(service, dataset, query):
+    group_key = _grouping_key(dataset, query, 'group')
+    # Repeated metrics are answered once
+    metrics = list(dict.fromkeys(query.get('metric') or dataset['cube']['sum'].columns))
+    unknown = [m for m in metrics if m not in dataset['cube']['sum'].columns]
+    if unknown:
+        raise QueryError(f"unknown metric {unknown}")
+    stats = survey_analysis.cube_group_stats(dataset['cube'], _selections(dataset, query), group_key, metrics)
+    return {'group': group_key, 'metrics': metrics,
+            'data': stats.rename(columns={group_key: 'group'}).to_dict(orient='records')}
+
+
+def threshold_counts_endpoint(service, dataset, query):
+    metric = _metric(dataset, query)
+    thresholds = _thresholds(query)
+    counts = survey_analysis.interval_counts(_filtered(dataset, query)[metric], thresholds)
+    total = int(counts.sum())
+    return {
+        'metric': metric, 'thresholds': thresholds, 'n': total,
+        'intervals': survey_analysis.interval_labels(thresholds),
+        'counts': counts,
+        'percent': counts / total * 100 if total else [0.0] * len(counts),
+    }
+
+
+def crosstab_endpoint(service, dataset, query):
+    metric = _metric(dataset, query)
+    thresholds = _thresholds(query)
+    category = _grouping_key(dataset, query, 'category')
+    filtered = _filtered(dataset, query)
+    valid = filtered[filtered[metric].notna()]
+    rows = sorted(valid[category].dropna().unique().tolist())
+    table = survey_analysis.category_interval_counts(valid[metric], valid[category], thresholds, rows)
+    test = survey_analysis.chi2_test(table)
+    return {
+        'metric': metric, 'category': category, 'thresholds': thresholds,
+        'rows': rows, 'intervals': survey_analysis.interval_labels(thresholds), 'counts': table,
+        'chi2': dict(zip(['chi2', 'p', 'dof'], test)) if test else None,
+    }
+
+
+def quality_endpoint(service, dataset, query):
+    df = dataset['outputs'][0]
+    if 'quality_flags' not in df.columns:
+        return {'rows': len(df), 'checks': {}, 'thresholds': {}}
+    counts = quality.check_counts(df['quality_flags'])
+    _, thresholds = quality.quality_report(df)
+    return {
+        'rows': len(df), 'flagged': int((df['quality_flags'] > 0).sum()),
+        'checks': {check: {'label': label, 'count': counts[check]} for check, label in quality.QUALITY_CHECKS.items()},
+        'thresholds': thresholds,
+    }
+
+
+ROUTES = {
+    '/datasets': datasets_endpoint,
+    '/dimensions': dimensions_endpoint,
+    '/group-means': group_means_endpoint,
+    '/threshold-counts': threshold_counts_endpoint,
+    '/crosstab': crosstab_endpoint,
+    '/quality': quality_endpoint,
+}
+
+# Query parameters each endpoint understands; anything else (a misspelled filter) is a 400
+_FILTER_PARAMS = ['wave', 'exclude'] + [dim for dim in survey_analysis.FILTER_DIMENSIONS if dim != 'quality_flags']
+PARAMETERS = {
+    '/datasets': [],
+    '/dimensions': ['wave'],
+    '/group-means': _FILTER_PARAMS + ['group', 'metric'],
+    '/threshold-counts': _FILTER_PARAMS + ['metric', 'thresholds'],
+    '/crosstab': _FILTER_PARAMS + ['metric', 'thresholds', 'category'],
+    '/quality': ['wave'],
+}
+
+_REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            500: 'Internal Server Error'}
+
+
+class AggregateService:
+    """WSGI application answering ROUTES from a dataset cache, with ETag-validated responses."""
+
+    def __init__(self, discover=dataset_registry.discover_datasets, cache=None):
+        self.discover = discover
+        self.cache = cache or dataset_registry.DatasetCache()
+        # Serialized bodies, keyed by dataset content and query
+        self.responses = memo.BoundedLRU(memo.RESULT_MEMO_MB * 1024 ** 2, memo.RESULT_MEMO_ENTRIES, sizeof=len)
+        self._digests = {}
+        self._digest_lock = threading.Lock()
+
+    def _content_hash(self, dataset_key):
+        # One sha256 per export version; (path, mtime, size) says when to hash again
+        h = hashlib.sha256()
+        for entry in dataset_key:
+            with self._digest_lock:
+                digest = self._digests.get(entry)
+            if digest is None:
+                digest = survey_data.file_digest(entry[1])
+                with self._digest_lock:
+                    self._digests[entry] = digest
+            h.update(digest.encode())
+        return h.hexdigest()
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self._respond(start_response, 405, {'error': "read-only service: use GET"})
+        path = environ.get('PATH_INFO') or '/'
+        route = path.rstrip('/') or '/'
+        endpoint = ROUTES.get(route)
+        if endpoint is None:
+            return self._respond(start_response, 404, {'error': f"unknown endpoint {path}", 'endpoints': list(ROUTES)})
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        try:
+            unknown = [name for name in query if name not in PARAMETERS[route]]
+            if unknown:
+                raise QueryError(f"unknown parameter {unknown}; {route} takes {PARAMETERS[route]}")
+            available = self.discover()
+            waves = list(available) if endpoint is datasets_endpoint else (query.pop('wave', None) or list(available)[:1])
+            unknown = [w for w in waves if w not in available]
+            if unknown or not waves:
+                raise QueryError(f"unknown wave {unknown}; available: {list(available)}")
+            dataset_key = dataset_registry.dataset_key(available, waves)
+            query_sig = memo.signature({k: sorted(v) if k in survey_analysis.FILTER_DIMENSIONS or k == 'exclude' else v for k, v in query.items()})
+            etag = '"' + hashlib.sha256(repr((self._content_hash(dataset_key), waves, path, query_sig)).encode()).hexdigest()[:32] + '"'
+            if etag in environ.get('HTTP_IF_NONE_MATCH', ''):
+                return self._respond(start_response, 304, None, etag)
+
+            def build():
+                dataset = self.cache.get(dataset_key, lambda: dataset_registry.build_dataset(dataset_key))
+                result = endpoint(self, dataset, query)
+                return json.dumps(_jsonable(result), ensure_ascii=False, allow_nan=False).encode('utf-8')
+
+            body = self.responses.get((etag, path, query_sig), build)
+        except QueryError as e:
+            return self._respond(start_response, 400, {'error': str(e)})
+        except Exception:
+            # Clients get JSON like every other answer; the traceback goes to the server log
+            traceback.print_exc(file=environ.get('wsgi.errors') or sys.stderr)
+            return self._respond(start_response, 500, {'error': "internal error"})
+        return self._respond(start_response, 200, body, etag, head=environ['REQUEST_METHOD'] == 'HEAD')
+
+    def _respond(self, start_response, status, payload, etag=None, head=False):
+        body = b'' if payload is None else payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        headers = [('Content-Type', 'application/json; charset=utf-8'), ('Content-Length', str(len(body)))]
+        if etag:
+            # Clients may keep the response but must revalidate it, which costs a 304 at most
+            headers += [('ETag', etag), ('Cache-Control', 'no-cache')]
+        start_response(f"{status} {_REASONS[status]}", headers)
+        return [b''] if head or status == 304 else [body]
+
+
+def request(app, url, headers=None, method='GET'):
+    """Call a WSGI `app` in-process. Returns (status code, headers dict, body bytes)."""
+    parts = urlsplit(url)
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': parts.path, 'QUERY_STRING': parts.query,
+               'wsgi.input': io.BytesIO()}
+    for name, value in (headers or {}).items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    setup_testing_defaults(environ)
+    response = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        response['status'] = int(status.split()[0])
+        response['headers'] = dict(response_headers)
+
+    body = b''.join(app(environ, start_response))
+    return response['status'], response['headers'], body
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8502)
+    args = parser.parse_args(argv)
+    with make_server(args.host, args.port, AggregateService(), server_class=ThreadingWSGIServer) as server:
+        print(f"Serving aggregates on http://{args.host}:{args.port}/ ({', '.join(ROUTES)})")
+        server.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
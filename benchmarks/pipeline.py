@@ -0,0 +1,121 @@
+"""Per-stage benchmark of the dashboard pipeline on synthetic exports.
+
+For each size, a synthetic export (see synthetic.py) is generated once and cached, then every
+stage the app runs on a rerun is timed without Streamlit:
+
+    load/process     raw CSV -> processed frame (streaming ETL), and snapshot write/read
+    filter           mask index build, then applying a typical sidebar selection
+    grouped means    cube build, then every metric x grouping key from the cube
+    threshold        interval counts for every metric
+    contingency      category x interval table plus chi-square for every metric x grouping key
+    csv export       filtered frame -> utf-8-sig CSV bytes
+
+    python benchmarks/pipeline.py --rows 10000 100000 1000000 --output pipeline.jsonl
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import survey_analysis  # noqa: E402
+import survey_data  # noqa: E402
+from synthetic import DEFAULT_OUT_DIR, ensure_synthetic  # noqa: E402
+
+THRESHOLDS = [3, 6]
+
+
+def timed(fn, repeat):
+    """(median ms, last result) of `repeat` calls to fn()."""
+    times, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), result
+
+
+def typical_selection(df):
+    # Half of the regions and everything else selected: a common sidebar state
+    regions = sorted(df['Region'].dropna().unique().tolist())
+    return {
+        'major': [], 'grade': [], 'gender_str': [], 'native_str': [],
+        'Region': regions[: max(1, len(regions) // 2)],
+    }
+
+
+def bench_size(n_rows, repeat, data_dir):
+    from scipy.stats import chi2_contingency
+
+    path = ensure_synthetic(n_rows, data_dir)
+    stages = {}
+
+    stages['load_process'], (outputs, watermark, screening) = timed(lambda: survey_data.read_survey(path), 1)
+    df, question_cols = outputs[0], outputs[1]
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, 'bench.parquet')
+        stages['snapshot_write'], _ = timed(lambda: survey_data.save_snapshot(snapshot, outputs, watermark, screening=screening), 1)
+        stages['snapshot_load'], _ = timed(lambda: survey_data.load_snapshot(snapshot), repeat)
+
+    stages['filter_index_build'], index = timed(lambda: survey_analysis.build_filter_index(df), 1)
+    selection = typical_selection(df)
+    stages['filter'], filtered = timed(lambda: survey_analysis.apply_filters(df, index, selection), repeat)
+
+    group_keys = [g for g in survey_analysis.GROUPING_KEYS if g in df.columns]
+    stages['cube_build'], cube = timed(lambda: survey_analysis.build_cube(df, question_cols), 1)
+    stages['grouped_means'], _ = timed(
+        lambda: [survey_analysis.cube_group_stats(cube, selection, g, question_cols) for g in group_keys], repeat)
+
+    stages['threshold_binning'], _ = timed(
+        lambda: [survey_analysis.interval_counts(filtered[m], THRESHOLDS) for m in question_cols], repeat)
+
+    def contingency():
+        for g in group_keys:
+            rows = filtered[g].dropna().unique().tolist()
+            for m in question_cols:
+                table = survey_analysis.category_interval_counts(filtered[m], filtered[g], THRESHOLDS, rows)
+                table = table[table.sum(axis=1) > 0][:, table.sum(axis=0) > 0]
+                if table.shape[0] > 1 and table.shape[1] > 1:
+                    chi2_contingency(table)
+    stages['contingency_chi2'], _ = timed(contingency, repeat)
+
+    stages['csv_export'], payload = timed(lambda: filtered.to_csv(index=False).encode('utf-8-sig'), repeat)
+
+    return {
+        'rows': n_rows,
+        'processed_rows': len(df),
+        'filtered_rows': len(filtered),
+        'processed_mb': round(df.memory_usage(deep=True).sum() / 1024 ** 2, 2),
+        'csv_mb': round(len(payload) / 1024 ** 2, 2),
+        'stages_ms': {k: round(v, 2) for k, v in stages.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--repeat', type=int, default=5, help="timed repetitions of the per-rerun stages")
+    parser.add_argument('--data-dir', default=DEFAULT_OUT_DIR, help="where synthetic exports are cached")
+    parser.add_argument('--output', default=None, help="append one JSON line per size to this file")
+    args = parser.parse_args(argv)
+
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    for n_rows in args.rows:
+        result = {'timestamp': stamp, **bench_size(n_rows, args.repeat, args.data_dir)}
+        print(f"\n{n_rows:,} rows ({result['processed_rows']:,} after the question-16 filter, "
+              f"{result['processed_mb']} MB in memory)")
+        for stage, ms in result['stages_ms'].items():
+            print(f"  {stage:<20} {ms:>10.1f} ms")
+        if args.output:
+            with open(args.output, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""Startup benchmark for the Streamlit app.
+
+Measures, in fresh interpreters, how long the modules every cold start imports take to load,
+then runs interactive_app.py headlessly (streamlit.testing AppTest) to time the first run and
+subsequent reruns. Results are printed as JSON and optionally appended to a JSON-lines file.
+
+    python benchmarks/startup.py --repeat 5 --budget-ms 2500 --output startup.jsonl
+
+Exits with status 1 when the median cold import time exceeds --budget-ms.
+"""
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, 'interactive_app.py')
+# Only imported by the features that need them
+LAZY_MODULES = ['plotly.express', 'scipy.stats', 'pyarrow.parquet']
+
+
+def startup_modules(app_path=APP_PATH):
+    """Modules imported by every script run: the app's top-level import statements.
+
+    Imports nested in functions or branches are the lazy ones and are not included.
+    """
+    with open(app_path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), app_path)
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def cold_import_ms(modules):
+    # A new interpreter per measurement, so nothing is already in sys.modules
+    code = ("import time; t = time.perf_counter(); "
+            + "; ".join(f"import {m}" for m in modules)
+            + "; print((time.perf_counter() - t) * 1000)")
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def import_breakdown(modules):
+    """Cumulative import time per top-level module from `python -X importtime`, in ms."""
+    code = "; ".join(f"import {m}" for m in modules)
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                         capture_output=True, text=True, check=True)
+    breakdown = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit() and not name.startswith('  '):
+            breakdown[name.strip()] = int(cumulative) / 1000
+    return {m: breakdown[m] for m in modules if m in breakdown}
+
+
+def app_run_ms(repeat):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=300)
+    start = time.perf_counter()
+    at.run()
+    first = (time.perf_counter() - start) * 1000
+    if at.exception:
+        raise RuntimeError(f"interactive_app.py raised: {at.exception[0].value}")
+    reruns = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        at.run()
+        reruns.append((time.perf_counter() - start) * 1000)
+    loaded = {m: m in sys.modules for m in LAZY_MODULES}
+    return first, reruns, loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="cold imports / reruns to time")
+    parser.add_argument('--budget-ms', type=float, default=None, help="fail if the median cold import exceeds this")
+    parser.add_argument('--output', default=None, help="append the result as one JSON line to this file")
+    parser.add_argument('--skip-app', action='store_true', help="only time imports, do not run the app")
+    args = parser.parse_args(argv)
+
+    os.chdir(ROOT)
+    modules = startup_modules()
+    cold = [cold_import_ms(modules) for _ in range(args.repeat)]
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'cold_import_ms': {'median': statistics.median(cold), 'min': min(cold), 'max': max(cold)},
+        'startup_breakdown_ms': import_breakdown(modules),
+        'lazy_breakdown_ms': import_breakdown(LAZY_MODULES),
+    }
+    if not args.skip_app:
+        first, reruns, loaded = app_run_ms(args.repeat)
+        result['first_run_ms'] = first
+        result['rerun_ms'] = {'median': statistics.median(reruns), 'min': min(reruns), 'max': max(reruns)}
+        result['lazy_modules_loaded_by_default_page'] = loaded
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    if args.budget_ms is not None and result['cold_import_ms']['median'] > args.budget_ms:
+        print(f"cold import median {result['cold_import_ms']['median']:.0f} ms exceeds budget {args.budget_ms:.0f} ms",
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
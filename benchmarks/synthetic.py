@@ -0,0 +1,102 @@
+"""Synthetic survey exports with the exact data.csv schema, for benchmarking at scale.
+
+Every column is sampled from its empirical distribution in data.csv (missing values included),
+so answer vocabularies, the question 21/24 multi-choice columns and the question-16 filter rate
+all match the real export. The 3.你来自于 province/city/district fill-ins are sampled as whole
+rows so that they stay consistent with each other. Rows are generated and written in chunks,
+so a 1M-row file never has to fit in memory.
+
+    python benchmarks/synthetic.py --rows 10000 100000 1000000 --out-dir benchmarks/.data
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_PATH = os.path.join(ROOT, 'data.csv')
+DEFAULT_OUT_DIR = os.path.join(ROOT, 'benchmarks', '.data')
+
+ORIGIN_COLUMNS = ['3.你来自于：_填空1', '3.你来自于：_填空2', '3.你来自于：_填空3']
+_SURVEY_START = pd.Timestamp('2025-04-21 08:00')
+_SURVEY_MINUTES = 6 * 24 * 60
+
+
+def _format_time(ts):
+    # Same layout as the export: 2025/4/26 09:05
+    return (ts.dt.year.astype(str) + '/' + ts.dt.month.astype(str) + '/' + ts.dt.day.astype(str) + ' '
+            + ts.dt.strftime('%H:%M'))
+
+
+def _empirical(series):
+    freqs = series.value_counts(dropna=False, normalize=True)
+    return freqs.index.to_numpy(dtype=object), freqs.to_numpy()
+
+
+def generate_chunk(source, n_rows, first_id, n_total, rng):
+    """`n_rows` synthetic responses with 编号 counting down from `first_id`, like the export."""
+    ids = np.arange(first_id, first_id - n_rows, -1)
+    chunk = {'编号': ids}
+
+    # Newest first, spread over the same week as the real survey
+    durations = rng.choice(source['答题时长'].to_numpy(), size=n_rows)
+    start = pd.Series(_SURVEY_START + pd.to_timedelta(ids * (_SURVEY_MINUTES / n_total), unit='min').floor('min'))
+    chunk['开始答题时间'] = _format_time(start).to_numpy()
+    chunk['结束答题时间'] = _format_time(start + pd.to_timedelta(durations, unit='s')).to_numpy()
+    chunk['答题时长'] = durations
+
+    origins = source[ORIGIN_COLUMNS].to_numpy(dtype=object)[rng.integers(0, len(source), n_rows)]
+    for i, col in enumerate(ORIGIN_COLUMNS):
+        chunk[col] = origins[:, i]
+
+    for col in source.columns:
+        if col in chunk:
+            continue
+        values, probs = _empirical(source[col])
+        chunk[col] = values[rng.choice(len(values), size=n_rows, p=probs)]
+
+    return pd.DataFrame(chunk, columns=source.columns)
+
+
+def write_synthetic(path, n_rows, seed=0, chunk_rows=100_000, source_path=SOURCE_PATH):
+    source = pd.read_csv(source_path)
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    written = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        while written < n_rows:
+            size = min(chunk_rows, n_rows - written)
+            chunk = generate_chunk(source, size, n_rows - written, n_rows, rng)
+            chunk.to_csv(f, index=False, header=written == 0)
+            written += size
+    return path
+
+
+def synthetic_path(n_rows, out_dir=DEFAULT_OUT_DIR, seed=0):
+    return os.path.join(out_dir, f"synthetic_{n_rows}_s{seed}.csv")
+
+
+def ensure_synthetic(n_rows, out_dir=DEFAULT_OUT_DIR, seed=0):
+    """Path of the synthetic export with `n_rows` rows, generating it on first use."""
+    path = synthetic_path(n_rows, out_dir, seed)
+    if not os.path.exists(path):
+        write_synthetic(path, n_rows, seed)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--out-dir', default=DEFAULT_OUT_DIR)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    for n_rows in args.rows:
+        path = write_synthetic(synthetic_path(n_rows, args.out_dir, args.seed), n_rows, args.seed)
+        print(f"{n_rows:>9} rows -> {path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
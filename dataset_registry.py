@@ -0,0 +1,103 @@
+"""Survey waves the dashboard can serve, and a memory-bounded cache of the processed ones.
+
+Every CSV export in DATA_DIR (plus data.csv) is a wave. Waves are processed one at a time by
+survey_data, so each keeps its own snapshot and codebook, and are combined on demand.
+"""
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+import memo
+import survey_analysis
+import survey_data
+
+DATA_DIR = os.environ.get('SURVEY_DATA_DIR', 'data')
+# Upper bound for the processed datasets one server process keeps around
+CACHE_MAX_MB = float(os.environ.get('SURVEY_CACHE_MB', 1024))
+CACHE_MAX_ENTRIES = int(os.environ.get('SURVEY_CACHE_ENTRIES', 8))
+
+
+def discover_datasets(data_dir=DATA_DIR, default_path=survey_data.DATA_PATH):
+    """{wave name: export path}, with data.csv first and then the exports in `data_dir` by name."""
+    datasets = {}
+    if os.path.exists(default_path):
+        datasets[survey_data._stem(default_path)] = default_path
+    for path in sorted(glob.glob(os.path.join(data_dir, '*.csv'))):
+        name = survey_data._stem(path)
+        if name in datasets:
+            name = os.path.join(os.path.basename(os.path.normpath(data_dir)), name)
+        datasets[name] = path
+    return datasets
+
+
+def dataset_key(datasets, names):
+    # stat() is cheap enough for every rerun; the snapshots still check the content hash
+    key = []
+    for name in names:
+        stat = os.stat(datasets[name])
+        key.append((name, datasets[name], stat.st_mtime_ns, stat.st_size))
+    return tuple(key)
+
+
+def _union_mapping(mappings):
+    # The first wave keeps its codes; labels first seen in later waves get the next free ones
+    union = {}
+    for mapping in mappings:
+        for label, _ in sorted(mapping.items(), key=lambda item: item[1]):
+            if label not in union:
+                union[label] = len(union) + 1
+    return union
+
+
+def combine_waves(named_outputs):
+    """Concatenate the process_survey outputs of several waves into one dataset.
+
+    `named_outputs` is [(wave name, outputs)]. major/grade are re-encoded against the union of
+    the waves' codebooks, and a categorical `wave` column records where each row came from.
+    A single wave is returned unchanged.
+    """
+    if len(named_outputs) == 1:
+        return named_outputs[0][1]
+    names = [name for name, _ in named_outputs]
+    major_mapping = _union_mapping(outputs[3] for _, outputs in named_outputs)
+    grade_mapping = _union_mapping(outputs[4] for _, outputs in named_outputs)
+    frames = [outputs[0] for _, outputs in named_outputs]
+    flag_cols = set.intersection(*({c for c in f.columns if f[c].dtype == np.uint8} for f in frames))
+
+    parts = []
+    for name, frame in zip(names, frames):
+        recoded = {'wave': name}
+        if 'major_str' in frame.columns:
+            recoded['major'] = survey_data.encode_answers(frame['major_str'], major_mapping)
+        if 'grade_str' in frame.columns:
+            recoded['grade'] = survey_data.encode_answers(frame['grade_str'], grade_mapping)
+        parts.append(frame.assign(**recoded))
+    df = pd.concat(parts, ignore_index=True)
+    df['wave'] = pd.Categorical(df['wave'], categories=names)
+    df = survey_data.compact_dtypes(df, flag_cols)
+
+    question_cols = sorted(set().union(*(outputs[1] for _, outputs in named_outputs)))
+    first = named_outputs[0][1]
+    return (df, question_cols, first[2], major_mapping, grade_mapping, *first[5:])
+
+
+def build_dataset(dataset_key):
+    """Processed outputs, filter index and cube of the waves in `dataset_key`."""
+    # survey_data reuses each export's columnar snapshot when its content hash is unchanged
+    waves = [(name, survey_data.load_and_process_data(path)) for name, path, *_ in dataset_key]
+    outputs = combine_waves(waves)
+    df, question_cols = outputs[0], outputs[1]
+    return {
+        'outputs': outputs,
+        'filter_index': survey_analysis.build_filter_index(df),
+        'cube': survey_analysis.build_cube(df, question_cols),
+    }
+
+
+class DatasetCache(memo.BoundedLRU):
+    """LRU of built datasets, bounded by SURVEY_CACHE_MB and SURVEY_CACHE_ENTRIES."""
+
+    def __init__(self, max_bytes=CACHE_MAX_MB * 1024 ** 2, max_entries=CACHE_MAX_ENTRIES):
+        super().__init__(max_bytes, max_entries)
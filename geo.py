@@ -0,0 +1,181 @@
+"""Normalization of the free-text origin answers (question 3: province, city, district).
+
+Respondents type these by hand ('上海市', ' 南通市', '恩施州', '红河（州）', '泰安新泰市'), so the
+raw strings are factorized and only the distinct values are resolved against GEO_TABLE_PATH,
+a bundled table of every prefecture-level city with its province, full name and city tier.
+The results are broadcast back to the rows through the factorize codes.
+"""
+import csv
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+GEO_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geo_cities.csv')
+
+MUNICIPALITIES = ('北京', '上海', '天津', '重庆')
+# Full names of the provincial units that are not simply '<name>省' (or '<name>市' for municipalities)
+PROVINCE_FULL_NAMES = {
+    '内蒙古': '内蒙古自治区', '广西': '广西壮族自治区', '西藏': '西藏自治区', '宁夏': '宁夏回族自治区',
+    '新疆': '新疆维吾尔自治区', '香港': '香港特别行政区', '澳门': '澳门特别行政区',
+}
+PROVINCE_TO_REGION = {
+    '上海': '上海本地', '江苏': '华东', '浙江': '华东', '安徽': '华东', '福建': '华东', '山东': '华东', '江西': '华东',
+    '广东': '华南', '广西': '华南', '海南': '华南',
+    '北京': '华北', '天津': '华北', '河北': '华北', '山西': '华北', '内蒙古': '华北',
+    '四川': '西南', '重庆': '西南', '云南': '西南', '贵州': '西南', '西藏': '西南',
+    '陕西': '西北', '甘肃': '西北', '青海': '西北', '宁夏': '西北', '新疆': '西北',
+    '辽宁': '东北', '吉林': '东北', '黑龙江': '东北'
+}
+# Tiers used in the table, in order; answers that resolve to no city have no tier
+CITY_TIERS = ['一线', '新一线', '二线', '三线及以下']
+# Shanghai districts, with the names of districts merged into them
+SHANGHAI_DISTRICTS = {
+    '黄浦区': ['黄浦', '卢湾', '南市'], '徐汇区': ['徐汇'], '长宁区': ['长宁'], '静安区': ['静安', '闸北'],
+    '普陀区': ['普陀'], '虹口区': ['虹口'], '杨浦区': ['杨浦'], '闵行区': ['闵行'], '宝山区': ['宝山'],
+    '嘉定区': ['嘉定'], '浦东新区': ['浦东', '浦东新', '南汇'], '金山区': ['金山'], '松江区': ['松江'],
+    '青浦区': ['青浦'], '奉贤区': ['奉贤'], '崇明区': ['崇明', '崇明县'],
+}
+
+_PROVINCE_SUFFIXES = ['省', '市', '自治区', '特别行政区', '回族', '壮族', '维吾尔', '维吾尔族']
+_CITY_SUFFIXES = ['市', '地区', '州', '盟', '林区']
+
+
+@functools.lru_cache(maxsize=None)
+def load_geo_table(path=GEO_TABLE_PATH):
+    """(province aliases -> province, city aliases -> (city, province, tier), the same city
+    aliases per province)."""
+    with open(path, encoding='utf-8', newline='') as f:
+        rows = list(csv.DictReader(f))
+    provinces = {}
+    for province in dict.fromkeys(row['province'] for row in rows):
+        full = PROVINCE_FULL_NAMES.get(province, province + ('市' if province in MUNICIPALITIES else '省'))
+        provinces[province] = provinces[full] = province
+    cities, province_cities = {}, {}
+    for row in rows:
+        entry = (row['city'], row['province'], row['tier'])
+        for alias in (row['city'], row['full_name'], row['city'] + '市'):
+            cities.setdefault(alias, entry)
+            province_cities.setdefault(row['province'], {}).setdefault(alias, entry)
+    return provinces, cities, province_cities
+
+
+def _clean(name):
+    # Whitespace anywhere and brackets around optional parts: ' 红河（州）' -> '红河州'
+    return ''.join(ch for ch in name if not ch.isspace() and ch not in '()（）')
+
+
+def _strip_suffix(name, suffixes):
+    for suffix in suffixes:
+        if name.endswith(suffix) and len(name) > len(suffix) + 1:
+            return name[:-len(suffix)]
+    return name
+
+
+def _prefix_match(name, table):
+    # '泰安新泰市' -> '泰安': the longest known name the answer starts with
+    for length in range(len(name) - 1, 1, -1):
+        if name[:length] in table:
+            return table[name[:length]]
+    return None
+
+
+def normalize_province(name):
+    """(short province name, whether it is a known province). Unknown answers lose their
+    administrative suffixes but are otherwise kept."""
+    provinces, _, _ = load_geo_table()
+    name = _clean(name)
+    province = provinces.get(name) or _prefix_match(name, provinces)
+    if province is not None:
+        return province, True
+    for _ in range(2):
+        for suffix in _PROVINCE_SUFFIXES:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+    return name, False
+
+
+def normalize_city(name, province=None):
+    """(city, province, tier) of a prefecture-level city answer; (cleaned answer, NaN, NaN) when unknown.
+
+    With a known `province`, only that province's cities match: 北京/朝阳 is not 朝阳, Liaoning.
+    """
+    _, cities, province_cities = load_geo_table()
+    if province is not None:
+        cities = province_cities.get(province, {})
+    name = _clean(name)
+    entry = cities.get(name) or cities.get(_strip_suffix(name, _CITY_SUFFIXES)) or _prefix_match(name, cities)
+    return entry if entry is not None else (name or np.nan, np.nan, np.nan)
+
+
+def normalize_district(name):
+    """(Shanghai district or NaN, cleaned answer). Districts elsewhere are not looked up."""
+    name = _clean(name)
+    for district, aliases in SHANGHAI_DISTRICTS.items():
+        if name == district or name in aliases or name + '区' == district:
+            return district, district
+    return np.nan, name or np.nan
+
+
+def _per_unique(values, func, n_out):
+    # func runs once per distinct string; code -1 (missing) picks the trailing NaN
+    codes, uniques = pd.factorize(values)
+    results = [func(str(u)) for u in uniques]
+    columns = []
+    for i in range(n_out):
+        column = np.empty(len(uniques) + 1, dtype=object)
+        column[:-1] = [r[i] for r in results]
+        column[-1] = np.nan
+        columns.append(column[codes])
+    return columns
+
+
+def normalize_origin(province, city=None, district=None):
+    """Province, City, District, city_tier and Region for raw question-3 answers.
+
+    A municipality named as the city decides the province (江苏/上海 is 上海); otherwise a known
+    province only accepts cities of that province, and a missing or unknown province is taken
+    from the city. In a municipality the city answer is a district (北京/朝阳区), so City and
+    city_tier are the municipality's and the answer fills a blank District. Region follows
+    PROVINCE_TO_REGION, with 其他地区 for everything else.
+    """
+    index = province.index
+    empty = pd.Series(np.nan, index=index, dtype=object)
+    city = empty if city is None else city
+    district = empty if district is None else district
+    province_name, province_known = _per_unique(province, normalize_province, 2)
+    province_known = province_known.astype(bool, copy=False) & pd.notna(province_known)
+    # A municipality as the city overrides the province, before cities are looked up per province
+    unscoped_city, = _per_unique(city, lambda c: (normalize_city(c)[0],), 1)
+    municipal_city = np.isin(unscoped_city, MUNICIPALITIES)
+    province_name = np.where(municipal_city, unscoped_city, province_name)
+    province_known = province_known | municipal_city
+
+    # One lookup per distinct (known province, city answer)
+    scope = np.where(province_known, province_name, '').astype(object)
+    city_key = pd.Series(scope + '\x1f' + city.astype(object).fillna('').astype(str).to_numpy(dtype=object), index=index).where(city.notna())
+    city_name, city_province, tier = _per_unique(
+        city_key, lambda key: normalize_city(key.split('\x1f', 1)[1], key.split('\x1f', 1)[0] or None), 3)
+    from_city = ~province_known & pd.notna(city_province)
+    province_name = np.where(from_city, city_province, province_name)
+
+    # Anywhere in a municipality is that city
+    _, cities, _ = load_geo_table()
+    municipal_province = np.isin(province_name, MUNICIPALITIES)
+    city_is_district = municipal_province & pd.notna(city_name) & ~np.isin(city_name, MUNICIPALITIES)
+    district = district.where(district.notna() | ~city_is_district, city_name)
+    city_name = np.where(municipal_province, province_name, city_name)
+    municipal_tier = pd.Series(province_name).map({m: cities[m][2] for m in MUNICIPALITIES}).to_numpy()
+    tier = np.where(municipal_province, municipal_tier, tier)
+
+    sh_district, generic_district = _per_unique(district, normalize_district, 2)
+    district_name = np.where((province_name == '上海') & pd.notna(sh_district), sh_district, generic_district)
+
+    region, = _per_unique(pd.Series(province_name, index=index),
+                          lambda p: (PROVINCE_TO_REGION.get(p, '其他地区'),), 1)
+    return pd.DataFrame({
+        'Province': province_name, 'City': city_name, 'District': district_name,
+        'city_tier': pd.Categorical(tier, categories=CITY_TIERS, ordered=True), 'Region': np.where(pd.isna(region), '其他地区', region),
+    }, index=index)
@@ -1,10 +1,18 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import plotly.express as px
-import category_encoders as ce
-import itertools # Not strictly used in final app but was in original
-from scipy.stats import chi2_contingency
+import functools
+import os
+import uuid
+
+import dataset_registry
+import memo
+import perf_trace
+import quality
+import survey_analysis
+import survey_data
+import survey_export
+import weighting
 
 # --- Page Configuration ---
 st.set_page_config(layout="wide", page_title="上海话数据交互分析平台")
@@ -14,809 +22,1066 @@ st.markdown("""
 请在左侧边栏选择筛选条件、分析指标和分组方式，右侧将展示相应的数据图表和表格。
 """)
 
-# --- Data Loading and Preprocessing (Adapted from share.py) ---
-@st.cache_data # Cache the data loading and processing
-def load_and_process_data():
-    df = pd.read_csv('data.csv')
-
-    # Initial filter as in share.py
-    # Consider making this an optional filter in the UI if broader analysis is needed
-    df = df[df['16.你是否愿意为了传承文化去特意学习上海话？'] == 'D.无所谓（请直接选择此项）'].copy() # Use .copy() to avoid SettingWithCopyWarning
-
-    drop_cols = [
-        '编号', '开始答题时间', '结束答题时间', '答题时长',
-        '3.你来自于：_填空3',
-        '语言', '清洗数据结果', '智能清洗数据无效概率',
-        '地理位置国家和地区', '地理位置省', '地理位置市',
-        '用户类型', '用户标识', '昵称', '自定义字段', 'IP', 'UA',
-        'Referrer', '中奖时间', '中奖金额', '审核状态', 'Unnamed: 58',
-        '16.你是否愿意为了传承文化去特意学习上海话？'
-    ]
-    df.drop(columns=[c for c in drop_cols if c in df.columns], inplace=True)
-
-    multi_cols_21 = [c for c in df.columns if c.startswith('21.你通常在以下哪些场合使用上海话')]
-    multi_cols_24 = [c for c in df.columns if c.startswith('24.你看过或听过以下哪类与上海话有关的内容')]
-    for col in multi_cols_21 + multi_cols_24:
-        df[col] = df[col].notna().astype(int)
-
-    rename_map = {
-        '1.你的性别是？': 'gender',
-        '2.你的年级是？': 'grade',
-        '4.你的专业类型是？': 'major',
-        '5.你目前就读的学校是？':'school',
-        '6.你是否为上海本地人？': 'native',
-        '7.你的父母是否为上海本地人？':'parents',
-        '8.你对上海话的整体印象是？': 'overall_impression',
-        '9.你认为上海话属于一种：': 'shanghainese_attitude',
-        '10.你认为学习/会说上海话是否是一种“本地身份”的象征？': 'identity',
-        '14.你对在公共场合听到上海话的看法是？': 'public_hear_view',
-        '15.你对私人场合使用上海话交流的看法是？': 'private_use_view',
-        '11.你对大学中开设上海话课程的态度是？': 'course_attitude',
-        '12.你是否认同“年轻一代应该会说一些上海话”？':'young_should',
-        '13.你觉得上海话在现代社会中的地位是？':'social_status_of_shanghainese',
-        '17.你是否觉得学校或社会应该提供更多学习上海话的机会？': 'more_learning_opportunity',
-        '18.你是否会说上海话？': 'speaking_ability',
-        '19.你能听懂上海话的程度是？': 'listening_ability',
-        '20.你与家人交流时最常用的语言是？':'family_language',
-        '21.你通常在以下哪些场合使用上海话？:与家人交流':'family_use',
-        '21.你通常在以下哪些场合使用上海话？:与朋友交流':'friend_use',
-        '21.你通常在以下哪些场合使用上海话？:在本地社区或邻里间':'local_community_use',
-        '21.你通常在以下哪些场合使用上海话？:在工作/兼职中':'work_use',
-        '21.你通常在以下哪些场合使用上海话？:基本不用':'basic_no_use',
-        '22.你使用上海话的频率是？': 'usage_freq',
-        '23.你会使用上海话发微信/社交平台信息吗？': 'sns_use_freq',
-        '24.你看过或听过以下哪类与上海话有关的内容？:上海话配音短视频':'shanghainese_dubbling_tiktok',
-        '24.你看过或听过以下哪类与上海话有关的内容？:上海话电视剧/电影':'shanghainese_movies',
-        '24.你看过或听过以下哪类与上海话有关的内容？:上海话广播/音频节目':'shanghainese_radio',
-        '24.你看过或听过以下哪类与上海话有关的内容？:上海话学习类内容':'shanghainese_learning_resources',
-        '24.你看过或听过以下哪类与上海话有关的内容？:几乎没有接触过':'never_shanghainese_content',
-        '25.你是否关注过沪语博主（如G僧东、册那队长等）？': 'follow_sh_blogger',
-        '26.你对此类沪语视频的看法是？': 'video_view',
-        '27.你是否曾因不会说上海话而感到尴尬/被排斥？': 'awkward_score',
-        '28.你认为目前的语言环境是否支持上海话的使用？': 'env_support',
-        '3.你来自于：_填空1': 'Province',
-        '3.你来自于：_填空2': 'City',
-    }
-    df.rename(columns={k:v for k,v in rename_map.items() if k in df.columns}, inplace=True)
-
-    def clean_province(name):
-        suffixes = ['省', '市', '自治区', '特别行政区', '回族', '壮族', '维吾尔', '维吾尔族']
-        for suffix in suffixes:
-            if isinstance(name, str) and name.endswith(suffix):
-                return name[:-len(suffix)]
-        return name
-
-    province_to_region = {
-        '上海': '上海本地', '江苏': '华东', '浙江': '华东', '安徽': '华东', '福建': '华东', '山东': '华东', '江西': '华东',
-        '广东': '华南', '广西': '华南', '海南': '华南',
-        '北京': '华北', '天津': '华北', '河北': '华北', '山西': '华北', '内蒙古': '华北',
-        '四川': '西南', '重庆': '西南', '云南': '西南', '贵州': '西南', '西藏': '西南',
-        '陕西': '西北', '甘肃': '西北', '青海': '西北', '宁夏': '西北', '新疆': '西北',
-        '辽宁': '东北', '吉林': '东北', '黑龙江': '东北'
-    }
-
-    if 'City' in df.columns and 'Province' in df.columns:
-        df.loc[df['City'].isin(['上海', '上海市']), 'Province'] = '上海'
-        df.loc[df['City'].isin(['北京', '北京市']), 'Province'] = '北京'
-        df.loc[df['City'].isin(['天津', '天津市']), 'Province'] = '天津'
-        df.loc[df['City'].isin(['重庆', '重庆市']), 'Province'] = '重庆'
-
-        df['Province'] = df['Province'].apply(clean_province)
-        df['Province'] = df['Province'].apply(clean_province) # Apply twice as in original
-        df['Region'] = df['Province'].map(province_to_region).fillna('其他地区')
-
-    # Specific Encodings for analysis & creating string columns for filters
-    gender_mapping_display = {1: '男', 0: '女', 2:'其他'} # For display
-    if 'gender' in df.columns:
-        df['gender_code'] = df['gender'].map({'A.男':1, 'B.女':0, 'C.其他':2})
-        df['gender_str'] = df['gender_code'].map(gender_mapping_display)
-
-    native_mapping_display = {'A.是，在上海出生并长大': '上海本地人(出生并长大)',
-                              'B.否，但在上海生活超过5年': '长期居住上海(>5年)',
-                              'C.否，在上海生活不足5年': '短期居住上海(<5年)'}
-    if 'native' in df.columns:
-        df['native_flag'] = (df['native'] == 'A.是，在上海出生并长大').astype(int)
-        df['long_term_sh'] = (df['native'] == 'B.否，但在上海生活超过5年').astype(int)
-        df['native_str'] = df['native'].map(lambda x: native_mapping_display.get(x, x))
-
-
-    if 'follow_sh_blogger' in df.columns:
-        df['follow_sh_blogger'] = df['follow_sh_blogger'].map({'A.是':1, 'B.否':0})
-    if 'identity' in df.columns:
-        df['identity'] = df['identity'].map({'A.是的':4, 'B.部分是':3, 'D.不清楚':2, 'C.否':1})
-    if 'course_attitude' in df.columns:
-        df['course_attitude'] = df['course_attitude'].map({'A.非常支持':4, 'B.支持':3, 'C.无所谓':2, 'D.反对':1})
-    if 'young_should' in df.columns:
-        df['young_should'] = df['young_should'].map({'A.非常认同':4, 'B.认同':3, 'C.不太认同':2, 'D.完全不认同':1})
-    if 'shanghainese_attitude' in df.columns:
-        df['shanghainese_attitude'] = df['shanghainese_attitude'].map({'A.地方语言，应予保护':4, 'B.沟通工具，实用即可':3, 'D.无所谓':2, 'C.方言，逐渐消失是自然现象':1})
-    if 'social_status_of_shanghainese' in df.columns:
-        df['social_status_of_shanghainese'] = df['social_status_of_shanghainese'].map({'A.重要，应重视':4, 'B.一般，可保留可取代':3, 'D.难说':2, 'C.不重要':1})
-    if 'more_learning_opportunity' in df.columns:
-        df['more_learning_opportunity'] = df['more_learning_opportunity'].map({'A.是':1, 'B.否':-1, 'C.无所谓': 0})
-    if 'awkward_score' in df.columns:
-        df['awkward_score'] = pd.to_numeric(df['awkward_score'], errors='coerce').fillna(0) # Ensure numeric before negation
-        df['awkward_score'] = -df['awkward_score']
-
-    original_major_col = df['major'].copy() if 'major' in df.columns else pd.Series()
-    original_grade_col = df['grade'].copy() if 'grade' in df.columns else pd.Series()
-
-    cat_cols = df.select_dtypes(include=['object']).columns.tolist()
-    # Columns to keep as strings for direct use (not to be ordinally encoded here if present)
-    keep_as_string = ['Region', 'gender_str', 'native_str', 'Province', 'City', 'school', 'parents', 'family_language', 'gender', 'native']
-    cat_cols_for_encoding = [col for col in cat_cols if col not in keep_as_string]
-
-    major_mapping = {}
-    grade_mapping = {}
-
-    if cat_cols_for_encoding:
-        encoder = ce.OrdinalEncoder(cols=cat_cols_for_encoding, handle_unknown='value', handle_missing='return_nan') # Use return_nan for explicit handling
-        df = encoder.fit_transform(df)
-
-        for mapping_info in encoder.category_mapping:
-            col_name = mapping_info['col']
-            current_map = {k:v for k,v in mapping_info['mapping'].items() if not (isinstance(k, float) and np.isnan(k))}
-            if col_name == 'major':
-                major_mapping = current_map
-            elif col_name == 'grade':
-                grade_mapping = current_map
-
-    # Fallback or ensure major/grade mappings exist even if not in cat_cols_for_encoding (e.g. if already numeric by mistake)
-    if not major_mapping and 'major' in df.columns:
-        unique_majors = original_major_col.dropna().unique()
-        major_mapping = {val: i+1 for i, val in enumerate(unique_majors)}
-        df['major'] = original_major_col.map(major_mapping) # Re-map using original values if needed
-
-    if not grade_mapping and 'grade' in df.columns:
-        unique_grades = original_grade_col.dropna().unique()
-        grade_mapping = {val: i+1 for i, val in enumerate(unique_grades)}
-        df['grade'] = original_grade_col.map(grade_mapping) # Re-map
-
-    # Define attitude_cols (inferred and explicit)
-    attitude_cols = [
-        'overall_impression', 'shanghainese_attitude', 'identity',
-        'public_hear_view', 'private_use_view', 'course_attitude',
-        'young_should', 'social_status_of_shanghainese',
-        'more_learning_opportunity', 'video_view', 'awkward_score', 'env_support'
-    ]
-    # Filter out cols not in df from attitude_cols
-    attitude_cols = [col for col in attitude_cols if col in df.columns]
-
-    question_cols_list = attitude_cols + [
-        'speaking_ability', 'listening_ability', 'usage_freq', 'sns_use_freq',
-        'family_use', 'friend_use', 'local_community_use', 'work_use', 'basic_no_use',
-        'shanghainese_dubbling_tiktok', 'shanghainese_movies', 'shanghainese_radio',
-        'shanghainese_learning_resources', 'never_shanghainese_content',
-        'follow_sh_blogger'
-    ]
-
-    final_question_cols = []
-    for col in question_cols_list:
-        if col in df.columns:
-            if not pd.api.types.is_numeric_dtype(df[col]):
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-            # Drop rows where essential numeric question columns became NaN after conversion, or fill them
-            # df.dropna(subset=[col], inplace=True) # This might reduce data significantly
-            # For now, we let mean handle NaNs, but this is a point of attention for data quality.
-            final_question_cols.append(col)
-    final_question_cols = sorted(list(set(final_question_cols))) # Unique and sorted
-
-    # Create string versions for major and grade for grouping display using the mappings
-    # Mappings are {original_name: encoded_code}
-    rev_major_mapping = {v: k for k, v in major_mapping.items()} if major_mapping else {}
-    rev_grade_mapping = {v: k for k, v in grade_mapping.items()} if grade_mapping else {}
-
-    if 'major' in df.columns and major_mapping:
-      df['major_str'] = df['major'].map(rev_major_mapping).fillna('未知')
-    if 'grade' in df.columns and grade_mapping:
-      df['grade_str'] = df['grade'].map(rev_grade_mapping).fillna('未知')
-
-    return df, final_question_cols, rename_map, major_mapping, grade_mapping, gender_mapping_display, native_mapping_display, province_to_region
-
-df_processed, question_cols, rename_map, major_mapping, grade_mapping, gender_map_disp, native_map_disp, prov_to_region_map = load_and_process_data()
-
-# --- Sidebar for Controls ---
-st.sidebar.header("⚙️ 筛选与可视化选项")
-
-# Metrics and Grouping Selection
-rev_rename_map = {v: k for k, v in rename_map.items()}
-def get_display_name(q_col):
-    original_question = rev_rename_map.get(q_col, q_col)
-    # Simplify common question formats
-    name = original_question.split("？:")[-1].split('？')[-1].split('是：')[-1]
-    name = name.replace('（请直接选择此项）','').replace("（", "(").replace("）", ")").strip()
-    if len(name) > 50: # Truncate very long names
-        name = name[:47] + "..."
-    return name if name else q_col
-
-question_cols_display_names = {}
-if question_cols:
-    question_cols_display_names = {q_col: q_col for q_col in question_cols}
-
-# Initialize threshold analysis variables
-threshold_metric = None
-threshold_values = []
-
-# Create filter options
-major_filter_options = []
-if major_mapping:
-    major_filter_options = sorted([k for k in major_mapping.keys() if not (isinstance(k, float) and np.isnan(k))])
-selected_major_names = st.sidebar.multiselect("🎓 选择专业类型", options=major_filter_options, default=major_filter_options)
-selected_major_codes = [major_mapping[name] for name in selected_major_names if name in major_mapping]
-
-grade_filter_options = []
-if grade_mapping:
-    grade_filter_options = sorted([k for k in grade_mapping.keys() if not (isinstance(k, float) and np.isnan(k))])
-selected_grade_names = st.sidebar.multiselect("📈 选择年级", options=grade_filter_options, default=grade_filter_options)
-selected_grade_codes = [grade_mapping[name] for name in selected_grade_names if name in grade_mapping]
-
-region_options = []
-if 'Region' in df_processed.columns:
-    region_options = sorted(df_processed['Region'].dropna().unique().tolist())
-selected_regions = st.sidebar.multiselect("🗺️ 选择地区", options=region_options, default=region_options)
-
-gender_str_options = []
-if 'gender_str' in df_processed.columns:
-    gender_str_options = sorted(df_processed['gender_str'].dropna().unique().tolist())
-selected_genders_str = st.sidebar.multiselect("🚻 选择性别", options=gender_str_options, default=gender_str_options)
-
-native_str_options = []
-if 'native_str' in df_processed.columns:
-    native_str_options = sorted(df_processed['native_str'].dropna().unique().tolist())
-selected_natives_str = st.sidebar.multiselect("🏠 选择上海人身份", options=native_str_options, default=native_str_options)
-
-# Apply filters
-filtered_df = df_processed.copy()
-if selected_major_codes and 'major' in filtered_df.columns:
-    filtered_df = filtered_df[filtered_df['major'].isin(selected_major_codes)]
-if selected_grade_codes and 'grade' in filtered_df.columns:
-    filtered_df = filtered_df[filtered_df['grade'].isin(selected_grade_codes)]
-if selected_regions and 'Region' in filtered_df.columns:
-    filtered_df = filtered_df[filtered_df['Region'].isin(selected_regions)]
-if selected_genders_str and 'gender_str' in filtered_df.columns:
-    filtered_df = filtered_df[filtered_df['gender_str'].isin(selected_genders_str)]
-if selected_natives_str and 'native_str' in filtered_df.columns:
-    filtered_df = filtered_df[filtered_df['native_str'].isin(selected_natives_str)]
-
-
-# Metrics and Grouping Selection
-
-selected_metrics_keys = st.sidebar.multiselect(
-    "📊 选择分析指标 (Y轴)",
-    options=list(question_cols_display_names.keys()),
-    format_func=lambda x: question_cols_display_names[x],
-    default=[question_cols[0]] if question_cols else []
-)
-
-# Grouping variables (use string versions for display)
-grouping_options_map = {}
-if 'Region' in filtered_df.columns:
-    grouping_options_map['Region'] = "地区"
-if 'gender_str' in filtered_df.columns:
-    grouping_options_map['gender_str'] = "性别"
-if 'native_str' in filtered_df.columns:
-    grouping_options_map['native_str'] = "上海人身份"
-if 'major_str' in filtered_df.columns and filtered_df['major_str'].nunique() > 0 :
-    grouping_options_map['major_str'] = "专业类型"
-if 'grade_str' in filtered_df.columns and filtered_df['grade_str'].nunique() > 0:
-    grouping_options_map['grade_str'] = "年级"
-
-
-if grouping_options_map:
-    selected_group_by_key = st.sidebar.selectbox(
-        "🗂️ 选择分组条件 (X轴)",
-        options=list(grouping_options_map.keys()),
-        format_func=lambda x: grouping_options_map[x],
-        index=0
-    )
-else:
-    st.sidebar.warning("⚠️ 没有可用的分组条件。请检查数据。")
-    selected_group_by_key = None
-
-
-# --- Main Area for Charts and Tables ---
-if not selected_metrics_keys or not selected_group_by_key or filtered_df.empty:
-    st.warning("⚠️ 请至少选择一个分析指标和一个分组条件，并确保筛选结果不为空。")
-    if filtered_df.empty:
-        st.info("当前筛选条件下没有数据。请尝试调整筛选器。")
-else:
-    st.subheader("📈 图表分析")
-
-    for metric_key in selected_metrics_keys:
-        metric_display_name = question_cols_display_names.get(metric_key, metric_key)
-        group_by_display_name = grouping_options_map.get(selected_group_by_key, selected_group_by_key)
-
-        if metric_key not in filtered_df.columns:
-            st.error(f"指标 '{metric_display_name}' ({metric_key}) 在筛选后的数据中不存在。")
-            continue
-        if selected_group_by_key not in filtered_df.columns:
-            st.error(f"分组条件 '{group_by_display_name}' ({selected_group_by_key}) 在筛选后的数据中不存在。")
-            continue
-
-        try:
-            if not pd.api.types.is_numeric_dtype(filtered_df[metric_key]):
-                 st.error(f"指标 '{metric_display_name}' ({metric_key}) 不是数值类型，无法计算均值。")
-                 continue
-
-            # Drop NA for the specific metric and group_by col before grouping to avoid errors with all-NA groups
-            temp_plot_df = filtered_df[[selected_group_by_key, metric_key]].dropna(subset=[metric_key, selected_group_by_key])
-            if temp_plot_df.empty:
-                st.info(f"指标 '{metric_display_name}' 按 '{group_by_display_name}' 分组后无有效数据可供绘图。")
-                continue
-
-            plot_df = temp_plot_df.groupby(selected_group_by_key, as_index=False)[metric_key].mean()
-            plot_df = plot_df.sort_values(by=metric_key, ascending=False)
-
-            if plot_df.empty:
-                st.info(f"指标 '{metric_display_name}' 按 '{group_by_display_name}' 分组后无数据可供绘图。")
-                continue
-
-            fig_title = f"'{metric_display_name}' 按 '{group_by_display_name}' 分布 (均值)"
-            fig = px.bar(plot_df, x=selected_group_by_key, y=metric_key,
-                         title=fig_title,
-                         labels={metric_key: f"均值 - {metric_display_name}", selected_group_by_key: group_by_display_name},
-                         color=selected_group_by_key,
-                         text_auto='.2f')
-            fig.update_layout(
-                xaxis_title=group_by_display_name,
-                yaxis_title=f"均值 - {metric_display_name}",
-                title_x=0.5,
-                legend_title_text=group_by_display_name
-            )
-            st.plotly_chart(fig, use_container_width=True)
-
-            csv_fig_data = plot_df.to_csv(index=False).encode('utf-8-sig')
-            st.download_button(
-                label=f"📥 下载图表 '{metric_display_name}' 数据 (CSV)",
-                data=csv_fig_data,
-                file_name=f"{metric_key}_by_{selected_group_by_key}.csv",
-                mime='text/csv',
-                key=f"download_chart_{metric_key}_{selected_group_by_key}"
-            )
-            st.markdown("---")
+# Times each stage of this rerun; shown in the sidebar debug panel and appended to perf_trace.TRACE_PATH when set
+trace = perf_trace.RerunTrace(st.session_state.setdefault('trace_session', uuid.uuid4().hex))
+
+
+def main():
+    # --- Data Loading and Preprocessing ---
+    @st.cache_resource # One bounded LRU per server process, shared by all sessions
+    def dataset_cache():
+        return dataset_registry.DatasetCache()
+
+    def load_dataset(dataset_key):
+        """Processed outputs, filter index and cube of the selected waves. Read-only: shared across sessions."""
+        def build():
+            perf_trace.note_cache_miss('load_dataset')
+            return dataset_registry.build_dataset(dataset_key)
+        return dataset_cache().get(dataset_key, build)
+
+    @st.cache_resource # Derived results (filters, group means, tables) shared by all sessions
+    def result_memo():
+        return memo.BoundedLRU(memo.RESULT_MEMO_MB * 1024 ** 2, memo.RESULT_MEMO_ENTRIES)
+
+    def memoized(name, build, *inputs):
+        """build() for these inputs, computed once and then reused by later reruns and sessions."""
+        def build_once():
+            perf_trace.note_cache_miss(name)
+            return build()
+        return result_memo().get((name, *memo.signature(inputs)), build_once)
+
+    def load_weights(dataset_key, weights_signature):
+        """Raking weights for one set of population margins, with the cube weighted by them; None
+        when no margins are set. `weights_signature` is (margins, excluded quality checks): only the
+        responses the quality filter keeps are raked, the others get weight 0. Read-only: shared
+        across sessions."""
+        if not weights_signature:
+            return None
+        def build():
+            perf_trace.note_cache_miss('raking_weights')
+            dataset = load_dataset(dataset_key)
+            df, question_cols = dataset['outputs'][:2]
+            margins, excluded = weights_signature
+            kept = survey_analysis.apply_filters(df, dataset['filter_index'], {'quality_flags': quality.passing_values(excluded)})
+            weights, info = weighting.rake(kept, {dim: dict(levels) for dim, levels in margins})
+            weights = weights.reindex(df.index, fill_value=0.0)
+            return {'weights': weights, 'info': info, 'cube': survey_analysis.build_cube(df, question_cols, weights)}
+        return result_memo().get(('raking_weights', dataset_key, weights_signature), build)
+
+    def filtered_weights(dataset_key, weights_signature, filtered):
+        weighted = load_weights(dataset_key, weights_signature)
+        return None if weighted is None else weighted['weights'].loc[filtered.index]
+
+    @st.cache_data(max_entries=16, show_spinner=False)
+    def export_filtered_data(dataset_key, filter_signature, export_format, weights_signature=None):
+        # Only runs when the download button is clicked, once per filter selection and format
+        dataset = load_dataset(dataset_key)
+        filtered = survey_analysis.apply_filters(dataset['outputs'][0], dataset['filter_index'], dict(filter_signature))
+        weights = filtered_weights(dataset_key, weights_signature, filtered)
+        if weights is not None:
+            filtered = filtered.assign(weight=weights)
+        return survey_export.export_bytes(filtered, export_format)
+
+    @st.cache_data(max_entries=64, show_spinner=False)
+    def threshold_histogram(dataset_key, filter_signature, metric, weights_signature=None):
+        perf_trace.note_cache_miss('threshold_histogram')
+        dataset = load_dataset(dataset_key)
+        filtered = survey_analysis.apply_filters(dataset['outputs'][0], dataset['filter_index'], dict(filter_signature))
+        return survey_analysis.histogram_bins(filtered[metric], weights=filtered_weights(dataset_key, weights_signature, filtered))
+
+    @st.cache_data(max_entries=256, show_spinner=False)
+    def load_group_ci(dataset_key, filter_signature, group_key, metric, weights_signature=None):
+        perf_trace.note_cache_miss('group_ci')
+        dataset = load_dataset(dataset_key)
+        filtered = survey_analysis.apply_filters(dataset['outputs'][0], dataset['filter_index'], dict(filter_signature))
+        workers = os.cpu_count() if len(filtered) >= survey_analysis.BOOTSTRAP_POOL_MIN_ROWS else None
+        ci = survey_analysis.bootstrap_group_ci(filtered[metric], filtered[group_key], workers=workers,
+                                                weights=filtered_weights(dataset_key, weights_signature, filtered))
+        return ci[['group', 'ci_low', 'ci_high']].rename(columns={'group': group_key})
+
+    @st.cache_data(max_entries=16, show_spinner="正在对所有指标与分组变量进行卡方检验…")
+    def load_significance_scan(dataset_key, filter_signature, n_permutations, weights_signature=None):
+        perf_trace.note_cache_miss('significance_scan')
+        dataset = load_dataset(dataset_key)
+        df, question_cols = dataset['outputs'][:2]
+        filtered = survey_analysis.apply_filters(df, dataset['filter_index'], dict(filter_signature))
+        # The closed-form tests take milliseconds; only permutation tests are spread over a process pool
+        return survey_analysis.significance_scan(filtered, question_cols, n_permutations=n_permutations,
+                                                 workers=os.cpu_count() if n_permutations else None,
+                                                 weights=filtered_weights(dataset_key, weights_signature, filtered))
+
+    @st.cache_data(max_entries=32, show_spinner="正在计算相关系数矩阵…")
+    def load_rank_correlation(dataset_key, filter_signature, method):
+        perf_trace.note_cache_miss('rank_correlation')
+        dataset = load_dataset(dataset_key)
+        df, question_cols = dataset['outputs'][:2]
+        filtered = survey_analysis.apply_filters(df, dataset['filter_index'], dict(filter_signature))
+        return survey_analysis.rank_correlation(filtered, question_cols, method)
+
+    # --- Sidebar for Controls ---
+    st.sidebar.header("⚙️ 筛选与可视化选项")
+
+    # Survey waves: data.csv plus every export in dataset_registry.DATA_DIR
+    available_datasets = dataset_registry.discover_datasets()
+    if not available_datasets:
+        st.error(f"未找到问卷数据文件：请将 `{survey_data.DATA_PATH}` 或导出文件放在 `{dataset_registry.DATA_DIR}/` 目录下。")
+        st.stop()
+    selected_waves = list(available_datasets)[:1]
+    if len(available_datasets) > 1:
+        selected_waves = st.sidebar.multiselect("📂 选择调查批次 (多选则合并)", options=list(available_datasets), default=selected_waves) or selected_waves
+    current_dataset_key = dataset_registry.dataset_key(available_datasets, selected_waves)
+
+    with trace.cached('load_dataset', waves=len(selected_waves)) as stage_info:
+        dataset = load_dataset(current_dataset_key)
+        df_processed, question_cols, rename_map, major_mapping, grade_mapping, gender_map_disp, native_map_disp, prov_to_region_map = dataset['outputs']
+        filter_index = dataset['filter_index']
+        cube = dataset['cube']
+        stage_info['rows'] = len(df_processed)
+        stage_info['cells'] = len(cube['keys'])
+
+    # Metrics and Grouping Selection
+    rev_rename_map = {v: k for k, v in rename_map.items()}
+    def get_display_name(q_col):
+        original_question = rev_rename_map.get(q_col, q_col)
+        # Simplify common question formats
+        name = original_question.split("？:")[-1].split('？')[-1].split('是：')[-1]
+        name = name.replace('（请直接选择此项）','').replace("（", "(").replace("）", ")").strip()
+        if len(name) > 50: # Truncate very long names
+            name = name[:47] + "..."
+        return name if name else q_col
+
+    question_cols_display_names = {}
+    if question_cols:
+        question_cols_display_names = {q_col: q_col for q_col in question_cols}
+
+    # Initialize threshold analysis variables
+    threshold_metric = None
+    threshold_values = []
+
+    # Create filter options
+    major_filter_options = []
+    if major_mapping:
+        major_filter_options = sorted([k for k in major_mapping.keys() if not (isinstance(k, float) and np.isnan(k))])
+    selected_major_names = st.sidebar.multiselect("🎓 选择专业类型", options=major_filter_options, default=major_filter_options)
+    selected_major_codes = [major_mapping[name] for name in selected_major_names if name in major_mapping]
 
-        except Exception as e:
-            st.error(f"为指标 '{metric_display_name}' 和分组 '{group_by_display_name}' 生成图表时出错: {e}")
-
-
-    st.subheader("📄 筛选后数据预览 (前100条)")
-    display_cols = []
-    if selected_group_by_key:
-        display_cols.append(selected_group_by_key)
-    display_cols.extend(selected_metrics_keys)
-    display_cols.extend([col for col in ['major_str', 'grade_str', 'Region', 'gender_str', 'native_str']
-                    if col != selected_group_by_key and col in filtered_df.columns])
-    st.dataframe(filtered_df[list(dict.fromkeys(display_cols))].head(100))
-
-    csv_filtered_data = filtered_df.to_csv(index=False).encode('utf-8-sig')
-    st.download_button(
-        label="📥 下载筛选后完整数据 (CSV)",
-        data=csv_filtered_data,
-        file_name="filtered_shanghainese_data.csv",
-        mime='text/csv',
-        key="download_filtered_all"
+    grade_filter_options = []
+    if grade_mapping:
+        grade_filter_options = sorted([k for k in grade_mapping.keys() if not (isinstance(k, float) and np.isnan(k))])
+    selected_grade_names = st.sidebar.multiselect("📈 选择年级", options=grade_filter_options, default=grade_filter_options)
+    selected_grade_codes = [grade_mapping[name] for name in selected_grade_names if name in grade_mapping]
+
+    region_options = []
+    if 'Region' in df_processed.columns:
+        region_options = sorted(df_processed['Region'].dropna().unique().tolist())
+    selected_regions = st.sidebar.multiselect("🗺️ 选择地区", options=region_options, default=region_options)
+
+    gender_str_options = []
+    if 'gender_str' in df_processed.columns:
+        gender_str_options = sorted(df_processed['gender_str'].dropna().unique().tolist())
+    selected_genders_str = st.sidebar.multiselect("🚻 选择性别", options=gender_str_options, default=gender_str_options)
+
+    native_str_options = []
+    if 'native_str' in df_processed.columns:
+        native_str_options = sorted(df_processed['native_str'].dropna().unique().tolist())
+    selected_natives_str = st.sidebar.multiselect("🏠 选择上海人身份", options=native_str_options, default=native_str_options)
+
+    # Response-quality screening (quality.py): the flags are computed once per export, in the snapshot
+    excluded_checks = []
+    if 'quality_flags' in df_processed.columns:
+        quality_counts = memoized('quality_counts', lambda: quality.check_counts(df_processed['quality_flags']), current_dataset_key)
+        excluded_checks = st.sidebar.multiselect(
+            "🧹 排除可疑答卷", options=list(quality.QUALITY_CHECKS), default=quality.DEFAULT_EXCLUDED,
+            format_func=lambda check: f"{quality.QUALITY_CHECKS[check]} ({quality_counts[check]})", key="excluded_checks"
+        )
+
+    # Apply filters: one AND of the precomputed per-value masks, then a single take
+    filter_selections = {
+        'major': selected_major_codes,
+        'grade': selected_grade_codes,
+        'Region': selected_regions,
+        'gender_str': selected_genders_str,
+        'native_str': selected_natives_str,
+        'quality_flags': quality.passing_values(excluded_checks),
+    }
+    trace.lap('sidebar_filters')
+    # Selection order does not change the filtered rows, so it is not part of the signature
+    filter_signature = memo.signature({dim: sorted(values) for dim, values in filter_selections.items()})
+    with trace.cached('apply_filters', rows_in=len(df_processed)) as stage_info:
+        filtered_df = memoized('apply_filters',
+                               lambda: survey_analysis.apply_filters(df_processed, filter_index, filter_selections),
+                               current_dataset_key, filter_signature)
+        stage_info['rows_out'] = len(filtered_df)
+
+
+    # Metrics and Grouping Selection
+
+    selected_metrics_keys = st.sidebar.multiselect(
+        "📊 选择分析指标 (Y轴)",
+        options=list(question_cols_display_names.keys()),
+        format_func=lambda x: question_cols_display_names[x],
+        default=[question_cols[0]] if question_cols else []
     )
 
-    # --- Threshold Analysis Section ---
+    # Grouping variables (use string versions for display)
+    grouping_options_map = {}
+    if 'wave' in filtered_df.columns:
+        grouping_options_map['wave'] = "调查批次"
+    if 'Region' in filtered_df.columns:
+        grouping_options_map['Region'] = "地区"
+    if 'city_tier' in filtered_df.columns and filtered_df['city_tier'].notna().any():
+        grouping_options_map['city_tier'] = "城市等级"
+    if 'gender_str' in filtered_df.columns:
+        grouping_options_map['gender_str'] = "性别"
+    if 'native_str' in filtered_df.columns:
+        grouping_options_map['native_str'] = "上海人身份"
+    if 'major_str' in filtered_df.columns and filtered_df['major_str'].nunique() > 0 :
+        grouping_options_map['major_str'] = "专业类型"
+    if 'grade_str' in filtered_df.columns and filtered_df['grade_str'].nunique() > 0:
+        grouping_options_map['grade_str'] = "年级"
+
+
+    if grouping_options_map:
+        selected_group_by_key = st.sidebar.selectbox(
+            "🗂️ 选择分组条件 (X轴)",
+            options=list(grouping_options_map.keys()),
+            format_func=lambda x: grouping_options_map[x],
+            index=0
+        )
+    else:
+        st.sidebar.warning("⚠️ 没有可用的分组条件。请检查数据。")
+        selected_group_by_key = None
+
+    # With many metrics, one grouped pass and a single faceted figure is much cheaper than a chart per metric
+    combine_metric_charts = False
+    if len(selected_metrics_keys) > 1:
+        combine_metric_charts = st.sidebar.checkbox("🧩 多指标合并为一张分面图", value=False)
+
+    # Bootstrap intervals are cached per filter selection, so toggling other widgets does not resample
+    show_mean_ci = st.sidebar.checkbox("📏 显示均值的 95% 置信区间 (Bootstrap)", value=True)
+
+    # Download payloads are serialized when a button is clicked, not on every rerun
+    export_format = st.sidebar.selectbox("💾 下载文件格式", options=survey_export.available_formats(), index=0)
+
+    # --- Survey weights ---
+    # Population margins start at the sample's own shares (all weights 1) until they are edited
+    raking_margins = {}
+    if st.sidebar.checkbox("⚖️ 按总体边际加权 (Raking)", value=False, key="use_weights"):
+        with st.sidebar.expander("设置总体边际（目标占比 %）", expanded=True):
+            # Shares among the responses the quality filter keeps, which are the ones raked
+            sample_shares = weighting.sample_margins(
+                survey_analysis.apply_filters(df_processed, filter_index, {'quality_flags': quality.passing_values(excluded_checks)}))
+            for dim, shares in sample_shares.items():
+                if not st.checkbox(f"按{weighting.RAKING_LABELS[dim]}加权", value=dim != 'native_str', key=f"rake_{dim}"):
+                    continue
+                margin_df = st.data_editor(
+                    pd.DataFrame({'类别': list(shares), '目标占比 (%)': [round(share * 100, 2) for share in shares.values()]}),
+                    disabled=['类别'], hide_index=True, key=f"margin_{dim}"
+                )
+                raking_margins[dim] = {level: float(share) for level, share in zip(margin_df['类别'], margin_df['目标占比 (%)'])
+                                       if pd.notna(share) and share > 0}
+    weights_signature = (memo.signature(raking_margins), tuple(sorted(excluded_checks))) if raking_margins else None
+
+    with trace.cached('raking_weights', dims=len(raking_margins)) as stage_info:
+        weighted = load_weights(current_dataset_key, weights_signature)
+        analysis_cube = weighted['cube'] if weighted else cube
+        weights = weighted['weights'].loc[filtered_df.index] if weighted else None
+        if weighted:
+            stage_info.update(iterations=weighted['info']['iterations'], cells=weighted['info']['cells'])
+    if weighted:
+        rake_info = weighted['info']
+        st.sidebar.caption(
+            f"迭代 {rake_info['iterations']} 次{'后收敛' if rake_info['converged'] else '仍未收敛'}；"
+            f"有效样本量 {rake_info.get('effective_n', 0):.1f}（设计效应 {rake_info.get('design_effect', float('nan')):.2f}），"
+            f"权重范围 {rake_info.get('min_weight', 0):.2f} – {rake_info.get('max_weight', 0):.2f}"
+            + (f"；{rake_info['excluded']} 人的类别未设定目标占比，权重为 0" if rake_info['excluded'] else "")
+        )
+        if not rake_info['converged']:
+            st.sidebar.warning("加权未收敛：各边际之间可能相互矛盾，请检查目标占比。")
+        for dim, levels in rake_info['unmatched'].items():
+            st.sidebar.warning(f"{weighting.RAKING_LABELS.get(dim, dim)}中没有样本的类别无法加权：{', '.join(map(str, levels))}")
+    # Appended to titles and labels of every weighted result
+    weight_note = "（加权）" if weighted else ""
+    count_label = "加权人数" if weighted else "人数"
+
+
+    # --- Main Area for Charts and Tables ---
     if not selected_metrics_keys or not selected_group_by_key or filtered_df.empty:
-        pass  # Don't show threshold analysis if no metrics or filtered data
+        st.warning("⚠️ 请至少选择一个分析指标和一个分组条件，并确保筛选结果不为空。")
+        if filtered_df.empty:
+            st.info("当前筛选条件下没有数据。请尝试调整筛选器。")
     else:
-        st.markdown("---")
-        st.subheader("📊 阈值分析")
-
-        enable_threshold_analysis = st.checkbox("启用阈值分析", value=False)
-
-        if enable_threshold_analysis:
-            if not selected_metrics_keys:
-                st.warning("请先在侧边栏选择至少一个分析指标 (Y轴)。")
-            else:
-                # Use the first selected metric for threshold analysis
-                threshold_metric = selected_metrics_keys[0]
-                metric_display_name = question_cols_display_names.get(threshold_metric, threshold_metric)
+        # plotly and scipy are imported where they are first needed, so cold starts and pages
+        # without charts do not pay for them (see benchmarks/startup.py)
+        import plotly.express as px
+
+        trace.lap('sidebar_metrics')
+        st.subheader("📈 图表分析")
+
+        if combine_metric_charts:
+            group_by_display_name = grouping_options_map.get(selected_group_by_key, selected_group_by_key)
+            numeric_metrics = [m for m in selected_metrics_keys if m in cube['sum'].columns]
+            for metric_key in selected_metrics_keys:
+                if metric_key not in numeric_metrics:
+                    st.error(f"指标 '{question_cols_display_names.get(metric_key, metric_key)}' ({metric_key}) 不是数值类型，无法计算均值。")
+
+            try:
+                # Means and counts of every selected metric from one pass over the cube
+                with trace.cached('grouped_means', metrics=len(numeric_metrics)) as stage_info:
+                    stats_df = memoized('grouped_means',
+                                        lambda: survey_analysis.cube_group_stats(analysis_cube, filter_selections, selected_group_by_key, numeric_metrics),
+                                        current_dataset_key, filter_signature, selected_group_by_key, numeric_metrics, weights_signature) if numeric_metrics else pd.DataFrame()
+                    stage_info['groups'] = len(stats_df)
+                if stats_df.empty:
+                    st.info(f"所选指标按 '{group_by_display_name}' 分组后无有效数据可供绘图。")
+                else:
+                    if show_mean_ci:
+                        with trace.cached('group_ci', metrics=len(numeric_metrics)):
+                            ci_df = pd.concat([
+                                load_group_ci(current_dataset_key, filter_signature, selected_group_by_key, m, weights_signature).assign(metric=m)
+                                for m in numeric_metrics
+                            ])
+                        stats_df = stats_df.merge(ci_df, on=[selected_group_by_key, 'metric'], how='left')
+                    facet_df = stats_df.assign(指标=stats_df['metric'].map(lambda m: question_cols_display_names.get(m, m)))
+                    facet_cols = min(3, len(numeric_metrics))
+                    facet_rows = -(-len(numeric_metrics) // facet_cols)
+                    fig = px.bar(facet_df, x=selected_group_by_key, y='mean',
+                                 title=f"多指标按 '{group_by_display_name}' 分布 (均值){weight_note}",
+                                 labels={'mean': "均值", selected_group_by_key: group_by_display_name},
+                                 color=selected_group_by_key,
+                                 facet_col='指标', facet_col_wrap=facet_cols,
+                                 hover_data=['count'],
+                                 error_y=facet_df['ci_high'] - facet_df['mean'] if show_mean_ci else None,
+                                 error_y_minus=facet_df['mean'] - facet_df['ci_low'] if show_mean_ci else None,
+                                 text_auto='.2f')
+                    # Metrics live on different scales, so each facet gets its own y axis
+                    fig.update_yaxes(matches=None, showticklabels=True)
+                    fig.for_each_annotation(lambda a: a.update(text=a.text.split('=', 1)[-1]))
+                    fig.update_layout(
+                        height=280 * facet_rows + 120,
+                        title_x=0.5,
+                        legend_title_text=group_by_display_name
+                    )
+                    st.plotly_chart(fig, use_container_width=True)
+                    trace.lap('chart', metrics=len(numeric_metrics))
+
+                    st.download_button(
+                        label=f"📥 下载全部指标图表数据 ({export_format})",
+                        data=functools.partial(survey_export.export_bytes, stats_df, export_format),
+                        file_name=survey_export.export_file_name(f"metrics_by_{selected_group_by_key}", export_format),
+                        mime=survey_export.export_mime(export_format),
+                        key=f"download_chart_all_{selected_group_by_key}"
+                    )
+                st.markdown("---")
+
+            except Exception as e:
+                st.error(f"为所选指标和分组 '{group_by_display_name}' 生成分面图时出错: {e}")
+
+        else:
+            for metric_key in selected_metrics_keys:
+                metric_display_name = question_cols_display_names.get(metric_key, metric_key)
+                group_by_display_name = grouping_options_map.get(selected_group_by_key, selected_group_by_key)
+
+                if metric_key not in filtered_df.columns:
+                    st.error(f"指标 '{metric_display_name}' ({metric_key}) 在筛选后的数据中不存在。")
+                    continue
+                if selected_group_by_key not in filtered_df.columns:
+                    st.error(f"分组条件 '{group_by_display_name}' ({selected_group_by_key}) 在筛选后的数据中不存在。")
+                    continue
+
+                try:
+                    if metric_key not in cube['sum'].columns:
+                         st.error(f"指标 '{metric_display_name}' ({metric_key}) 不是数值类型，无法计算均值。")
+                         continue
+
+                    # Group means come from the pre-aggregated cube; groups without valid values are left out
+                    with trace.cached('grouped_means', metric=metric_key) as stage_info:
+                        plot_df = memoized('grouped_means',
+                                           lambda: survey_analysis.cube_group_means(analysis_cube, filter_selections, selected_group_by_key, metric_key),
+                                           current_dataset_key, filter_signature, selected_group_by_key, metric_key, weights_signature)
+                        stage_info['groups'] = len(plot_df)
+                    if plot_df.empty:
+                        st.info(f"指标 '{metric_display_name}' 按 '{group_by_display_name}' 分组后无有效数据可供绘图。")
+                        continue
+
+                    if show_mean_ci:
+                        with trace.cached('group_ci', metric=metric_key):
+                            ci_df = load_group_ci(current_dataset_key, filter_signature, selected_group_by_key, metric_key, weights_signature)
+                        plot_df = plot_df.merge(ci_df, on=selected_group_by_key, how='left')
+
+                    plot_df = plot_df.sort_values(by=metric_key, ascending=False)
+
+                    fig_title = f"'{metric_display_name}' 按 '{group_by_display_name}' 分布 (均值){weight_note}"
+                    fig = px.bar(plot_df, x=selected_group_by_key, y=metric_key,
+                                 title=fig_title,
+                                 labels={metric_key: f"均值 - {metric_display_name}", selected_group_by_key: group_by_display_name},
+                                 color=selected_group_by_key,
+                                 error_y=plot_df['ci_high'] - plot_df[metric_key] if show_mean_ci else None,
+                                 error_y_minus=plot_df[metric_key] - plot_df['ci_low'] if show_mean_ci else None,
+                                 text_auto='.2f')
+                    fig.update_layout(
+                        xaxis_title=group_by_display_name,
+                        yaxis_title=f"均值 - {metric_display_name}",
+                        title_x=0.5,
+                        legend_title_text=group_by_display_name
+                    )
+                    st.plotly_chart(fig, use_container_width=True)
+                    trace.lap('chart', metric=metric_key)
+
+                    st.download_button(
+                        label=f"📥 下载图表 '{metric_display_name}' 数据 ({export_format})",
+                        data=functools.partial(survey_export.export_bytes, plot_df, export_format),
+                        file_name=survey_export.export_file_name(f"{metric_key}_by_{selected_group_by_key}", export_format),
+                        mime=survey_export.export_mime(export_format),
+                        key=f"download_chart_{metric_key}_{selected_group_by_key}"
+                    )
+                    st.markdown("---")
 
-                st.write(f"当前分析指标: **{metric_display_name}**")
+                except Exception as e:
+                    st.error(f"为指标 '{metric_display_name}' 和分组 '{group_by_display_name}' 生成图表时出错: {e}")
+
+
+        st.subheader("📄 筛选后数据预览 (前100条)")
+        display_cols = []
+        if selected_group_by_key:
+            display_cols.append(selected_group_by_key)
+        display_cols.extend(selected_metrics_keys)
+        display_cols.extend([col for col in ['major_str', 'grade_str', 'Region', 'gender_str', 'native_str']
+                        if col != selected_group_by_key and col in filtered_df.columns])
+        st.dataframe(filtered_df[list(dict.fromkeys(display_cols))].head(100))
+
+        trace.lap('data_preview')
+        st.download_button(
+            label=f"📥 下载筛选后完整数据 ({export_format})",
+            data=functools.partial(export_filtered_data, current_dataset_key, filter_signature, export_format, weights_signature),
+            file_name=survey_export.export_file_name("filtered_shanghainese_data", export_format),
+            mime=survey_export.export_mime(export_format),
+            key="download_filtered_all"
+        )
+
+        # --- Threshold Analysis Section ---
+        if not selected_metrics_keys or not selected_group_by_key or filtered_df.empty:
+            pass  # Don't show threshold analysis if no metrics or filtered data
+        else:
+            st.markdown("---")
+            st.subheader("📊 阈值分析")
 
-                threshold_input = st.text_input(
-                    "输入阈值（用逗号分隔，例如：1,2,3）",
-                    key="threshold_input"
-                )
+            enable_threshold_analysis = st.checkbox("启用阈值分析", value=False)
 
-                if threshold_input:
-                    try:
-                        threshold_values = [float(x.strip()) for x in threshold_input.split(",") if x.strip()]
-                        threshold_values.sort()
-                    except ValueError:
-                        st.error("请输入有效的数字，用逗号分隔")
-
-                if not threshold_values:
-                    st.warning("请输入至少一个阈值。")
-                elif threshold_metric not in filtered_df.columns:
-                    st.error(f"所选指标 '{metric_display_name}' 在筛选后的数据中不存在。")
+            if enable_threshold_analysis:
+                if not selected_metrics_keys:
+                    st.warning("请先在侧边栏选择至少一个分析指标 (Y轴)。")
                 else:
-                    # Create interval labels
-                    interval_labels = []
-                    for i in range(len(threshold_values) + 1):
-                        if i == 0:
-                            interval_labels.append(f"< {threshold_values[0]}")
-                        elif i == len(threshold_values):
-                            interval_labels.append(f">= {threshold_values[-1]}")
-                        else:
-                            interval_labels.append(f"{threshold_values[i-1]} - {threshold_values[i]}")
-
-                    # Calculate counts for each interval
-                    interval_counts = []
-                    valid_data = filtered_df[pd.notna(filtered_df[threshold_metric])]
-
-                    for i in range(len(threshold_values) + 1):
-                        if i == 0:
-                            count = sum(valid_data[threshold_metric] < threshold_values[0])
-                        elif i == len(threshold_values):
-                            count = sum(valid_data[threshold_metric] >= threshold_values[-1])
-                        else:
-                            count = sum((valid_data[threshold_metric] >= threshold_values[i-1]) &
-                                         (valid_data[threshold_metric] < threshold_values[i]))
-                        interval_counts.append(count)
-
-                    # Create DataFrame for visualization
-                    total_count = sum(interval_counts)
-                    percentages = [count / total_count * 100 if total_count > 0 else 0 for count in interval_counts]
-
-                    threshold_df = pd.DataFrame({
-                        '区间': interval_labels,
-                        '人数': interval_counts,
-                        '百分比 (%)': [f"{p:.2f}%" for p in percentages]
-                    })
-
-                    # Create two columns for charts
-                    col1, col2 = st.columns(2)
-
-                    with col1:
-                        st.subheader("柱状图")
-                        fig_bar = px.bar(
-                            threshold_df,
-                            x='区间',
-                            y='人数',
-                            title=f"'{metric_display_name}' 的阈值分析",
-                            text='人数'
-                        )
-                        fig_bar.update_layout(
-                            xaxis_title="分数区间",
-                            yaxis_title="人数",
-                            title_x=0.5
-                        )
-                        st.plotly_chart(fig_bar, use_container_width=True)
-
-                    with col2:
-                        st.subheader("饼图")
-                        fig_pie = px.pie(
-                            threshold_df,
-                            values='人数',
-                            names='区间',
-                            title=f"'{metric_display_name}' 的区间分布",
-                            hover_data=['百分比 (%)']
-                        )
-                        fig_pie.update_layout(
-                            title_x=0.5
-                        )
-                        st.plotly_chart(fig_pie, use_container_width=True)
-
-                    # Display data table
-                    st.subheader("区间人数统计表")
-                    st.dataframe(threshold_df)
-
-                    # Display histogram
-                    st.subheader("数据分布直方图")
-
-                    # Create histogram with threshold lines
-                    fig_hist = px.histogram(
-                        valid_data,
-                        x=threshold_metric,
-                        nbins=20,
-                        title=f"'{metric_display_name}' 的分布直方图",
-                        labels={threshold_metric: metric_display_name}
-                    )
+                    # Use the first selected metric for threshold analysis
+                    threshold_metric = selected_metrics_keys[0]
+                    metric_display_name = question_cols_display_names.get(threshold_metric, threshold_metric)
 
-                    # Add vertical lines for thresholds
-                    for threshold in threshold_values:
-                        fig_hist.add_vline(
-                            x=threshold,
-                            line_dash="dash",
-                            line_color="red",
-                            annotation_text=f"阈值: {threshold}",
-                            annotation_position="top right"
-                        )
+                    st.write(f"当前分析指标: **{metric_display_name}**")
 
-                    fig_hist.update_layout(
-                        xaxis_title=metric_display_name,
-                        yaxis_title="频数",
-                        title_x=0.5
+                    threshold_input = st.text_input(
+                        "输入阈值（用逗号分隔，例如：1,2,3）",
+                        key="threshold_input"
                     )
 
-                    st.plotly_chart(fig_hist, use_container_width=True)
-
-                    # Display descriptive statistics
-                    st.subheader("描述性统计")
-
-                    # Calculate descriptive statistics
-                    desc_stats = valid_data[threshold_metric].describe()
-
-                    # Create a DataFrame for display
-                    stats_df = pd.DataFrame({
-                        '统计量': ['样本数', '平均值', '标准差', '最小值', '25%分位数', '中位数', '75%分位数', '最大值'],
-                        '值': [
-                            f"{desc_stats['count']:.0f}",
-                            f"{desc_stats['mean']:.2f}",
-                            f"{desc_stats['std']:.2f}",
-                            f"{desc_stats['min']:.2f}",
-                            f"{desc_stats['25%']:.2f}",
-                            f"{desc_stats['50%']:.2f}",
-                            f"{desc_stats['75%']:.2f}",
-                            f"{desc_stats['max']:.2f}"
-                        ]
-                    })
-
-                    st.dataframe(stats_df)
-
-                    # Add download buttons for data
-                    col1, col2 = st.columns(2)
-
-                    with col1:
-                        # Add download button for threshold analysis data
-                        csv_threshold_data = threshold_df.to_csv(index=False).encode('utf-8-sig')
-                        st.download_button(
-                            label=f"📥 下载区间统计数据 (CSV)",
-                            data=csv_threshold_data,
-                            file_name=f"{threshold_metric}_threshold_analysis.csv",
-                            mime='text/csv',
-                            key="download_threshold_analysis"
+                    if threshold_input:
+                        try:
+                            threshold_values = [float(x.strip()) for x in threshold_input.split(",") if x.strip()]
+                            threshold_values.sort()
+                        except ValueError:
+                            st.error("请输入有效的数字，用逗号分隔")
+
+                    if not threshold_values:
+                        st.warning("请输入至少一个阈值。")
+                    elif threshold_metric not in filtered_df.columns:
+                        st.error(f"所选指标 '{metric_display_name}' 在筛选后的数据中不存在。")
+                    else:
+                        trace.lap('threshold_inputs')
+                        interval_labels = survey_analysis.interval_labels(threshold_values)
+
+                        # Calculate counts for each interval in one vectorized pass
+                        with trace.cached('threshold_binning', thresholds=len(threshold_values)) as stage_info:
+                            valid_data = memoized('threshold_rows',
+                                                  lambda: filtered_df[pd.notna(filtered_df[threshold_metric])],
+                                                  current_dataset_key, filter_signature, threshold_metric)
+                            valid_weights = weights.loc[valid_data.index] if weights is not None else None
+                            interval_counts = memoized('threshold_binning',
+                                                       lambda: survey_analysis.interval_counts(valid_data[threshold_metric], threshold_values, valid_weights).tolist(),
+                                                       current_dataset_key, filter_signature, threshold_metric, threshold_values, weights_signature)
+                            stage_info['rows'] = len(valid_data)
+
+                        # Create DataFrame for visualization
+                        total_count = sum(interval_counts)
+                        percentages = [count / total_count * 100 if total_count > 0 else 0 for count in interval_counts]
+
+                        threshold_df = pd.DataFrame({
+                            '区间': interval_labels,
+                            count_label: [round(count, 2) for count in interval_counts],
+                            '百分比 (%)': [f"{p:.2f}%" for p in percentages]
+                        })
+
+                        # Create two columns for charts
+                        col1, col2 = st.columns(2)
+
+                        with col1:
+                            st.subheader("柱状图")
+                            fig_bar = px.bar(
+                                threshold_df,
+                                x='区间',
+                                y=count_label,
+                                title=f"'{metric_display_name}' 的阈值分析{weight_note}",
+                                text=count_label
+                            )
+                            fig_bar.update_layout(
+                                xaxis_title="分数区间",
+                                yaxis_title=count_label,
+                                title_x=0.5
+                            )
+                            st.plotly_chart(fig_bar, use_container_width=True)
+
+                        with col2:
+                            st.subheader("饼图")
+                            fig_pie = px.pie(
+                                threshold_df,
+                                values=count_label,
+                                names='区间',
+                                title=f"'{metric_display_name}' 的区间分布{weight_note}",
+                                hover_data=['百分比 (%)']
+                            )
+                            fig_pie.update_layout(
+                                title_x=0.5
+                            )
+                            st.plotly_chart(fig_pie, use_container_width=True)
+
+                        # Display data table
+                        st.subheader("区间人数统计表")
+                        st.dataframe(threshold_df)
+
+                        # Display histogram
+                        st.subheader("数据分布直方图")
+
+                        # Binned server-side, so the figure holds one bar per bin rather than every respondent's value
+                        with trace.cached('threshold_histogram') as stage_info:
+                            hist_df = threshold_histogram(current_dataset_key, filter_signature, threshold_metric, weights_signature)
+                            stage_info['bins'] = len(hist_df)
+                        hist_df = hist_df.assign(
+                            center=(hist_df['left'] + hist_df['right']) / 2,
+                            区间=[f"{l:.2f} - {r:.2f}" for l, r in zip(hist_df['left'], hist_df['right'])]
+                        )
+                        fig_hist = px.bar(
+                            hist_df,
+                            x='center',
+                            y='count',
+                            title=f"'{metric_display_name}' 的分布直方图{weight_note}",
+                            labels={'center': metric_display_name, 'count': "加权频数" if weighted else "频数"},
+                            hover_data={'center': False, '区间': True}
                         )
+                        fig_hist.update_traces(width=(hist_df['right'] - hist_df['left']).tolist())
+
+                        # Add vertical lines for thresholds
+                        for threshold in threshold_values:
+                            fig_hist.add_vline(
+                                x=threshold,
+                                line_dash="dash",
+                                line_color="red",
+                                annotation_text=f"阈值: {threshold}",
+                                annotation_position="top right"
+                            )
 
-                    with col2:
-                        # Add download button for descriptive statistics
-                        csv_stats_data = stats_df.to_csv(index=False).encode('utf-8-sig')
-                        st.download_button(
-                            label=f"📥 下载描述性统计数据 (CSV)",
-                            data=csv_stats_data,
-                            file_name=f"{threshold_metric}_descriptive_stats.csv",
-                            mime='text/csv',
-                            key="download_descriptive_stats"
+                        fig_hist.update_layout(
+                            xaxis_title=metric_display_name,
+                            yaxis_title="加权频数" if weighted else "频数",
+                            title_x=0.5
                         )
 
-                    # --- Category Table Analysis ---
-                    st.markdown("---")
-                    st.subheader("📊 类别表格分析")
-
-                    enable_category_analysis = st.checkbox("启用类别表格分析", value=False)
-                    show_totals = st.checkbox("显示总计", value=True)
-
-                    if enable_category_analysis:
-                        # Select grouping variable for categories
-                        category_options = []
-                        if 'Region' in filtered_df.columns:
-                            category_options.append(('Region', "地区"))
-                        if 'gender_str' in filtered_df.columns:
-                            category_options.append(('gender_str', "性别"))
-                        if 'native_str' in filtered_df.columns:
-                            category_options.append(('native_str', "上海人身份"))
-                        if 'major_str' in filtered_df.columns and filtered_df['major_str'].nunique() > 0:
-                            category_options.append(('major_str', "专业类型"))
-                        if 'grade_str' in filtered_df.columns and filtered_df['grade_str'].nunique() > 0:
-                            category_options.append(('grade_str', "年级"))
-
-                        if not category_options:
-                            st.warning("没有可用的分类变量。")
-                        else:
-                            # Create a dictionary for the selectbox format_func
-                            category_options_dict = {k: v for k, v in category_options}
-
-                            selected_category = st.selectbox(
-                                "选择类别变量",
-                                options=[k for k, _ in category_options],
-                                format_func=lambda x: category_options_dict.get(x, x),
-                                key="category_select"
+                        st.plotly_chart(fig_hist, use_container_width=True)
+
+                        # Display descriptive statistics
+                        st.subheader(f"描述性统计{weight_note}")
+
+                        # Calculate descriptive statistics
+                        desc_stats = memoized('describe',
+                                              lambda: weighting.weighted_describe(valid_data[threshold_metric], valid_weights) if weighted
+                                              else valid_data[threshold_metric].describe(),
+                                              current_dataset_key, filter_signature, threshold_metric, weights_signature)
+
+                        # Create a DataFrame for display
+                        stats_df = pd.DataFrame({
+                            '统计量': ['样本数', '平均值', '标准差', '最小值', '25%分位数', '中位数', '75%分位数', '最大值'],
+                            '值': [
+                                f"{desc_stats['count']:.0f}",
+                                f"{desc_stats['mean']:.2f}",
+                                f"{desc_stats['std']:.2f}",
+                                f"{desc_stats['min']:.2f}",
+                                f"{desc_stats['25%']:.2f}",
+                                f"{desc_stats['50%']:.2f}",
+                                f"{desc_stats['75%']:.2f}",
+                                f"{desc_stats['max']:.2f}"
+                            ]
+                        })
+
+                        st.dataframe(stats_df)
+                        trace.lap('threshold_charts')
+
+                        # Add download buttons for data
+                        col1, col2 = st.columns(2)
+
+                        with col1:
+                            # Add download button for threshold analysis data
+                            st.download_button(
+                                label=f"📥 下载区间统计数据 ({export_format})",
+                                data=functools.partial(survey_export.export_bytes, threshold_df, export_format),
+                                file_name=survey_export.export_file_name(f"{threshold_metric}_threshold_analysis", export_format),
+                                mime=survey_export.export_mime(export_format),
+                                key="download_threshold_analysis"
                             )
 
-                            if selected_category:
-                                # Get unique categories
-                                categories = sorted(valid_data[selected_category].dropna().unique())
-
-                                if len(categories) > 0:
-                                    # Allow user to select which categories to include
-                                    selected_categories = st.multiselect(
-                                        "选择要包含的类别",
-                                        options=categories,
-                                        default=categories,
-                                        key="selected_categories"
-                                    )
-
-                                    # Add custom group functionality
-                                    st.subheader("自定义聚合群体")
-                                    enable_custom_groups = st.checkbox("启用自定义聚合群体", value=False)
-
-                                    custom_groups = {}
-                                    if enable_custom_groups:
-                                        st.write("创建自定义群体（将多个类别聚合为一个群体）")
-
-                                        # UI for creating custom groups
-                                        col1, col2 = st.columns([1, 2])
-                                        with col1:
-                                            custom_group_name = st.text_input("群体名称", key="custom_group_name")
-                                        with col2:
-                                            group_categories = st.multiselect(
-                                                "选择要聚合的类别",
-                                                options=categories,
-                                                key="group_categories"
-                                            )
+                        with col2:
+                            # Add download button for descriptive statistics
+                            st.download_button(
+                                label=f"📥 下载描述性统计数据 ({export_format})",
+                                data=functools.partial(survey_export.export_bytes, stats_df, export_format),
+                                file_name=survey_export.export_file_name(f"{threshold_metric}_descriptive_stats", export_format),
+                                mime=survey_export.export_mime(export_format),
+                                key="download_descriptive_stats"
+                            )
 
-                                        if st.button("添加自定义群体", key="add_custom_group"):
-                                            if custom_group_name and group_categories:
-                                                custom_groups[custom_group_name] = group_categories
-                                                st.success(f"已添加自定义群体: {custom_group_name}")
+                        # --- Category Table Analysis ---
+                        st.markdown("---")
+                        st.subheader("📊 类别表格分析")
+
+                        enable_category_analysis = st.checkbox("启用类别表格分析", value=False)
+                        show_totals = st.checkbox("显示总计", value=True)
+
+                        if enable_category_analysis:
+                            # Select grouping variable for categories
+                            category_options = []
+                            if 'Region' in filtered_df.columns:
+                                category_options.append(('Region', "地区"))
+                            if 'city_tier' in filtered_df.columns and filtered_df['city_tier'].notna().any():
+                                category_options.append(('city_tier', "城市等级"))
+                            if 'gender_str' in filtered_df.columns:
+                                category_options.append(('gender_str', "性别"))
+                            if 'native_str' in filtered_df.columns:
+                                category_options.append(('native_str', "上海人身份"))
+                            if 'major_str' in filtered_df.columns and filtered_df['major_str'].nunique() > 0:
+                                category_options.append(('major_str', "专业类型"))
+                            if 'grade_str' in filtered_df.columns and filtered_df['grade_str'].nunique() > 0:
+                                category_options.append(('grade_str', "年级"))
+
+                            if not category_options:
+                                st.warning("没有可用的分类变量。")
+                            else:
+                                # Create a dictionary for the selectbox format_func
+                                category_options_dict = {k: v for k, v in category_options}
+
+                                selected_category = st.selectbox(
+                                    "选择类别变量",
+                                    options=[k for k, _ in category_options],
+                                    format_func=lambda x: category_options_dict.get(x, x),
+                                    key="category_select"
+                                )
+
+                                if selected_category:
+                                    # Get unique categories
+                                    categories = sorted(valid_data[selected_category].dropna().unique())
+
+                                    if len(categories) > 0:
+                                        # Allow user to select which categories to include
+                                        selected_categories = st.multiselect(
+                                            "选择要包含的类别",
+                                            options=categories,
+                                            default=categories,
+                                            key="selected_categories"
+                                        )
 
-                                        # Display current custom groups
+                                        # Add custom group functionality
+                                        st.subheader("自定义聚合群体")
+                                        enable_custom_groups = st.checkbox("启用自定义聚合群体", value=False)
+
+                                        custom_groups = {}
+                                        if enable_custom_groups:
+                                            st.write("创建自定义群体（将多个类别聚合为一个群体）")
+
+                                            # UI for creating custom groups
+                                            col1, col2 = st.columns([1, 2])
+                                            with col1:
+                                                custom_group_name = st.text_input("群体名称", key="custom_group_name")
+                                            with col2:
+                                                group_categories = st.multiselect(
+                                                    "选择要聚合的类别",
+                                                    options=categories,
+                                                    key="group_categories"
+                                                )
+
+                                            if st.button("添加自定义群体", key="add_custom_group"):
+                                                if custom_group_name and group_categories:
+                                                    custom_groups[custom_group_name] = group_categories
+                                                    st.success(f"已添加自定义群体: {custom_group_name}")
+
+                                            # Display current custom groups
+                                            if 'custom_groups' in st.session_state:
+                                                for name, cats in st.session_state.custom_groups.items():
+                                                    st.write(f"- {name}: {', '.join(cats)}")
+
+                                            # Store custom groups in session state
+                                            if custom_groups:
+                                                if 'custom_groups' not in st.session_state:
+                                                    st.session_state.custom_groups = {}
+                                                st.session_state.custom_groups.update(custom_groups)
+
+                                        # Get custom groups from session state
                                         if 'custom_groups' in st.session_state:
-                                            for name, cats in st.session_state.custom_groups.items():
-                                                st.write(f"- {name}: {', '.join(cats)}")
-
-                                        # Store custom groups in session state
-                                        if custom_groups:
-                                            if 'custom_groups' not in st.session_state:
-                                                st.session_state.custom_groups = {}
-                                            st.session_state.custom_groups.update(custom_groups)
-
-                                    # Get custom groups from session state
-                                    if 'custom_groups' in st.session_state:
-                                        custom_groups = st.session_state.custom_groups
-
-                                    if selected_categories or custom_groups:
-                                        # Create interval labels (same as before)
-                                        interval_labels = []
-                                        for i in range(len(threshold_values) + 1):
-                                            if i == 0:
-                                                interval_labels.append(f"< {threshold_values[0]}")
-                                            elif i == len(threshold_values):
-                                                interval_labels.append(f">= {threshold_values[-1]}")
-                                            else:
-                                                interval_labels.append(f"{threshold_values[i-1]} - {threshold_values[i]}")
-
-                                        # Get all categories that need to be included (selected categories + all categories in any custom group)
-                                        categories_to_include = set(selected_categories) if selected_categories else set()
-                                        for group_name, group_cats in custom_groups.items():
-                                            categories_to_include.update(group_cats)
-
-                                        # Filter data to include all necessary categories
-                                        category_data = valid_data[valid_data[selected_category].isin(categories_to_include)] if categories_to_include else valid_data
-
-                                        # Combine selected categories with custom groups
-                                        all_categories = list(selected_categories) if selected_categories else []
-                                        for group_name in custom_groups:
-                                            if group_name not in all_categories:
-                                                all_categories.append(group_name)
-
-                                        # Create contingency table with categories as rows and intervals as columns
-                                        contingency_table = np.zeros((len(all_categories), len(interval_labels)))
-
-                                        # Fill contingency table
-                                        for i, category in enumerate(all_categories):
-                                            # Check if this is a custom group
-                                            if category in custom_groups:
-                                                # Combine data from multiple categories
-                                                group_categories = custom_groups[category]
-                                                category_subset = category_data[category_data[selected_category].isin(group_categories)]
-                                            else:
-                                                # Regular category
-                                                category_subset = category_data[category_data[selected_category] == category]
-
-                                            for j, interval in enumerate(interval_labels):
-                                                if j == 0:  # First interval
-                                                    count = sum(category_subset[threshold_metric] < threshold_values[0])
-                                                elif j == len(threshold_values):  # Last interval
-                                                    count = sum(category_subset[threshold_metric] >= threshold_values[-1])
-                                                else:  # Middle intervals
-                                                    count = sum((category_subset[threshold_metric] >= threshold_values[j-1]) &
-                                                                (category_subset[threshold_metric] < threshold_values[j]))
-
-                                                contingency_table[i, j] = count
-
-                                        # Calculate row totals (for categories)
-                                        category_totals = np.sum(contingency_table, axis=1)
-
-                                        # Calculate column totals (for intervals)
-                                        interval_totals = np.sum(contingency_table, axis=0)
-
-                                        # Perform chi-square test if we have enough data
-                                        if np.sum(contingency_table) > 0 and np.all(category_totals > 0) and np.all(interval_totals > 0):
-                                            chi2, p, dof, expected = chi2_contingency(contingency_table)
-                                            chi2_result = f"χ² = {chi2:.2f}, p = {p:.4f}"
+                                            custom_groups = st.session_state.custom_groups
+
+                                        if selected_categories or custom_groups:
+                                            # Combine selected categories with custom groups
+                                            all_categories = list(selected_categories) if selected_categories else []
+                                            for group_name in custom_groups:
+                                                if group_name not in all_categories:
+                                                    all_categories.append(group_name)
+
+                                            trace.lap('category_inputs')
+
+                                            def build_contingency():
+                                                # Contingency table with categories/custom groups as rows and intervals as columns
+                                                table = survey_analysis.category_interval_counts(
+                                                    valid_data[threshold_metric], valid_data[selected_category],
+                                                    threshold_values, all_categories, custom_groups, valid_weights
+                                                )
+                                                effective_n = None
+                                                if weighted:
+                                                    # Weighted counts are tested at the Kish effective size of the rows they cover
+                                                    members = set(all_categories).union(*custom_groups.values())
+                                                    in_table = valid_data[selected_category].isin(members).to_numpy()
+                                                    effective_n = weighting.effective_n(valid_weights[in_table])
+                                                    table = table.round(2)
+                                                # Perform chi-square test if we have enough data
+                                                test = survey_analysis.chi2_test(table, effective_n)
+                                                if test is None:
+                                                    return table, "数据不足，无法进行卡方检验"
+                                                chi2, p, dof = test
+                                                return table, f"χ² = {chi2:.2f}, p = {p:.4f}" + (f"（加权，有效样本量 {effective_n:.1f}）" if weighted else "")
+
+                                            with trace.cached('contingency_chi2', rows=len(valid_data), categories=len(all_categories)):
+                                                contingency_table, chi2_result = memoized(
+                                                    'contingency_chi2', build_contingency, current_dataset_key, filter_signature,
+                                                    threshold_metric, threshold_values, selected_category, all_categories, custom_groups,
+                                                    weights_signature)
+
+                                            # Calculate row totals (for categories)
+                                            category_totals = np.sum(contingency_table, axis=1)
+
+                                            # Calculate column totals (for intervals)
+                                            interval_totals = np.sum(contingency_table, axis=0)
+
+                                            # Create DataFrame for display with categories as rows and intervals as columns
+                                            category_table = pd.DataFrame(contingency_table, index=all_categories, columns=interval_labels)
+
+                                            # Add row totals (for categories) if show_totals is checked
+                                            if show_totals:
+                                                category_table['总计'] = category_totals
+
+                                                # Add column totals (for intervals)
+                                                category_table.loc['总计'] = list(interval_totals) + [np.sum(contingency_table)]
+
+                                            if weighted:
+                                                category_table = category_table.round(2)
+
+                                            # Always add chi-square test results regardless of show_totals
+                                            # Ensure the chi-square test row has the same number of columns as the table
+                                            empty_values = [''] * (len(category_table.columns) - 1)
+                                            category_table.loc['卡方检验'] = [chi2_result] + empty_values
+
+                                            # Display the table
+                                            st.subheader(f"按 {category_options_dict.get(selected_category, selected_category)} 分类的区间统计表{weight_note}")
+                                            st.dataframe(category_table)
+
+                                            trace.lap('category_table')
+
+                                            # Add download button for category table
+                                            st.download_button(
+                                                label=f"📥 下载类别表格数据 ({export_format})",
+                                                data=functools.partial(survey_export.export_bytes, category_table, export_format, index=True),
+                                                file_name=survey_export.export_file_name(f"{threshold_metric}_category_analysis", export_format),
+                                                mime=survey_export.export_mime(export_format),
+                                                key="download_category_analysis"
+                                            )
                                         else:
-                                            chi2_result = "数据不足，无法进行卡方检验"
-
-                                        # Create DataFrame for display with categories as rows and intervals as columns
-                                        category_table = pd.DataFrame(contingency_table, index=all_categories, columns=interval_labels)
-
-                                        # Add row totals (for categories) if show_totals is checked
-                                        if show_totals:
-                                            category_table['总计'] = category_totals
-
-                                            # Add column totals (for intervals)
-                                            category_table.loc['总计'] = list(interval_totals) + [np.sum(contingency_table)]
-
-                                        # Always add chi-square test results regardless of show_totals
-                                        # Ensure the chi-square test row has the same number of columns as the table
-                                        empty_values = [''] * (len(category_table.columns) - 1)
-                                        category_table.loc['卡方检验'] = [chi2_result] + empty_values
-
-                                        # Display the table
-                                        st.subheader(f"按 {category_options_dict.get(selected_category, selected_category)} 分类的区间统计表")
-                                        st.dataframe(category_table)
-
-                                        # Add download button for category table
-                                        csv_category_table = category_table.to_csv(index=True).encode('utf-8-sig')
-                                        st.download_button(
-                                            label=f"📥 下载类别表格数据 (CSV)",
-                                            data=csv_category_table,
-                                            file_name=f"{threshold_metric}_category_analysis.csv",
-                                            mime='text/csv',
-                                            key="download_category_analysis"
-                                        )
+                                            st.warning("请选择至少一个类别或创建自定义聚合群体。")
                                     else:
-                                        st.warning("请选择至少一个类别或创建自定义聚合群体。")
-                                else:
-                                    st.warning(f"选定的类别变量 '{category_options_dict.get(selected_category, selected_category)}' 没有有效数据。")
-
-# --- Encoding Information ---
-with st.expander("ℹ️ 查看编码说明和原始问卷信息"):
-    st.markdown("#### **问卷问题与编码后变量名映射**")
-    rename_df_display = pd.DataFrame(list(rename_map.items()), columns=['原始问卷问题', '编码后变量名'])
-    st.table(rename_df_display)
-
-    st.markdown("#### **具体编码详情**")
-
-    st.markdown("**性别 (gender_str / gender_code):**")
-    gender_df_disp = pd.DataFrame({'原问卷答案': ['A.男', 'B.女'], '编码值 (gender_code)': [1,0], '分析用标签 (gender_str)': ['男','女']})
-    st.table(gender_df_disp)
-
-    st.markdown("**上海人身份 (native_str):**")
-    # native_mapping_display from load_and_process_data
-    native_df_disp = pd.DataFrame(list(native_map_disp.items()), columns=['原问卷答案', '分析用标签'])
-    st.table(native_df_disp)
-
-    st.markdown("**专业类型 (major_str / major):**")
-    if major_mapping:
-        major_df_disp = pd.DataFrame(list(major_mapping.items()), columns=['原问卷答案', '编码值 (major)'])
-        st.table(major_df_disp.sort_values(by='编码值 (major)'))
-    else:
-        st.markdown("_无专业类型数据或映射_")
-
-    st.markdown("**年级 (grade_str / grade):**")
-    if grade_mapping:
-        grade_df_disp = pd.DataFrame(list(grade_mapping.items()), columns=['原问卷答案', '编码值 (grade)'])
-        st.table(grade_df_disp.sort_values(by='编码值 (grade)'))
-    else:
-        st.markdown("_无年级数据或映射_")
+                                        st.warning(f"选定的类别变量 '{category_options_dict.get(selected_category, selected_category)}' 没有有效数据。")
 
-    course_attitude_map_disp = {'A.非常支持':4, 'B.支持':3, 'C.无所谓':2, 'D.反对':1}
-    st.markdown("**大学开设上海话课程态度 (course_attitude):**")
-    st.table(pd.DataFrame(list(course_attitude_map_disp.items()), columns=['原问卷答案', '编码值']))
+        # --- Significance Scan ---
+        st.markdown("---")
+        st.subheader("🔬 显著性扫描")
+
+        enable_significance_scan = st.checkbox("启用显著性扫描（全部指标 × 全部分组变量的卡方检验）", value=False, key="enable_significance_scan")
+
+        if enable_significance_scan:
+            # Permutations shuffle respondents, which says nothing about weighted counts
+            scan_permutations = st.number_input("置换检验次数（0 表示不做置换检验）", min_value=0, max_value=20000,
+                                                value=0, step=500, key="scan_permutations", disabled=bool(weighted),
+                                                help="加权时不提供置换检验" if weighted else None)
+            scan_permutations = 0 if weighted else int(scan_permutations)
+            with trace.cached('significance_scan', permutations=scan_permutations) as stage_info:
+                scan_df = load_significance_scan(current_dataset_key, filter_signature, scan_permutations, weights_signature)
+                stage_info['pairs'] = len(scan_df)
+
+            if scan_df.empty:
+                st.info("当前筛选条件下没有可检验的指标与分组变量组合。")
+            else:
+                scan_display = scan_df.assign(
+                    metric=scan_df['metric'].map(lambda m: question_cols_display_names.get(m, m)),
+                    group=scan_df['group'].map(lambda g: grouping_options_map.get(g, g))
+                ).rename(columns={
+                    'metric': '指标', 'group': '分组变量', 'n': '样本数', 'dof': '自由度', 'chi2': 'χ²',
+                    'p': 'p 值', 'cramers_v': "Cramér's V", 'min_expected': '最小期望频数',
+                    'p_holm': 'p 值 (Holm 校正)', 'p_fdr': 'p 值 (FDR 校正)', 'p_permutation': '置换检验 p 值'
+                })
+                st.caption("按 p 值从小到大排序。Holm 校正控制总体错误率，FDR 为 Benjamini-Hochberg 校正；"
+                           f"取值超过 {survey_analysis.SCAN_MAX_LEVELS} 种的指标按分位数分为 {survey_analysis.SCAN_QUANTILE_BINS} 组。"
+                           "最小期望频数低于 5 时卡方近似不可靠，可参考置换检验 p 值。"
+                           + ("已加权：列联表按各组合的 Kish 有效样本量缩放后检验。" if weighted else ""))
+                st.dataframe(scan_display, hide_index=True)
+                st.download_button(
+                    label=f"📥 下载显著性扫描结果 ({export_format})",
+                    data=functools.partial(survey_export.export_bytes, scan_display, export_format),
+                    file_name=survey_export.export_file_name("significance_scan", export_format),
+                    mime=survey_export.export_mime(export_format),
+                    key="download_significance_scan"
+                )
 
-    identity_map_disp = {'A.是的':4, 'B.部分是':3, 'D.不清楚':2, 'C.否':1}
-    st.markdown("**学习/会说上海话是‘本地身份’象征 (identity):**")
-    st.table(pd.DataFrame(list(identity_map_disp.items()), columns=['原问卷答案', '编码值']))
+        # --- Multi-choice Co-occurrence ---
+        st.markdown("---")
+        st.subheader("🧩 多选题组合分析")
+
+        mask_questions = {col: entry for col, entry in survey_data.MULTI_CHOICE_MASKS.items() if col in filtered_df.columns}
+        enable_cooccurrence = st.checkbox("启用多选题组合分析（选项组合人数与两两提升度）", value=False, key="enable_cooccurrence")
+
+        if enable_cooccurrence and not mask_questions:
+            st.info("数据中没有多选题（第21题、第24题）的选项列。")
+        elif enable_cooccurrence:
+            mask_col = st.selectbox("选择多选题", options=list(mask_questions),
+                                    format_func=lambda c: mask_questions[c]['label'], key="cooccurrence_question")
+            option_labels = list(mask_questions[mask_col]['options'].values())
+            split_by_group = st.checkbox(f"按当前分组条件（{grouping_options_map.get(selected_group_by_key, selected_group_by_key)}）拆分",
+                                         value=False, key="cooccurrence_by_group")
+            cooccurrence_group = selected_group_by_key if split_by_group else None
+
+            def build_cooccurrence():
+                groups = filtered_df[cooccurrence_group] if cooccurrence_group else None
+                return (survey_analysis.combination_counts(filtered_df[mask_col], option_labels, groups, weights),
+                        survey_analysis.pairwise_lift(filtered_df[mask_col], option_labels, groups, weights))
+
+            with trace.cached('cooccurrence', question=mask_col) as stage_info:
+                combination_df, lift_df = memoized('cooccurrence', build_cooccurrence,
+                                                   current_dataset_key, filter_signature, mask_col, cooccurrence_group, weights_signature)
+                stage_info['combinations'] = len(combination_df)
+
+            # UpSet-style view: the most common exact combinations of ticked options
+            top_combinations = combination_df.groupby('options')['count'].sum().nlargest(15).index
+            upset_df = combination_df[combination_df['options'].isin(top_combinations)]
+            fig_upset = px.bar(upset_df, x='count', y='options', orientation='h',
+                               color='group' if cooccurrence_group else None, barmode='group',
+                               category_orders={'options': list(top_combinations)},
+                               title=f"{mask_questions[mask_col]['label']}：最常见的选项组合{weight_note}",
+                               labels={'count': count_label, 'options': '选项组合', 'group': grouping_options_map.get(cooccurrence_group, '')},
+                               hover_data={'share': ':.1%'}, text_auto='.0f' if weighted else True)
+            fig_upset.update_layout(title_x=0.5, height=max(350, 28 * len(top_combinations) + 150))
+            st.plotly_chart(fig_upset, use_container_width=True)
+
+            lift_groups = lift_df['group'].unique().tolist()
+            lift_group = st.selectbox("提升度热力图的群体", options=lift_groups, key="cooccurrence_lift_group") if len(lift_groups) > 1 else lift_groups[0]
+            group_lift = lift_df[lift_df['group'] == lift_group]
+            lift_values = np.full((len(option_labels), len(option_labels)), np.nan)
+            index_a = [option_labels.index(o) for o in group_lift['option_a']]
+            index_b = [option_labels.index(o) for o in group_lift['option_b']]
+            lift_values[index_a, index_b] = lift_values[index_b, index_a] = group_lift['lift'].to_numpy()
+            lift_matrix = pd.DataFrame(lift_values, index=option_labels, columns=option_labels)
+            fig_lift = px.imshow(lift_matrix, text_auto='.2f', color_continuous_scale='RdBu_r',
+                                 color_continuous_midpoint=1.0, labels={'color': '提升度'},
+                                 title=f"选项两两提升度{weight_note}（{lift_group}，n = {int(group_lift['n'].iloc[0]) if len(group_lift) else 0}）")
+            fig_lift.update_layout(title_x=0.5)
+            st.plotly_chart(fig_lift, use_container_width=True)
+            st.caption("提升度 = 同时选择两项的比例 ÷ (选择各项比例之积)：大于 1 表示两项常被一起选择，小于 1 表示较少同时出现。")
+
+            combination_display = combination_df.drop(columns='combination').rename(columns={
+                'group': '群体', 'options': '选项组合', 'n_options': '选项数', 'count': count_label, 'share': '占比'})
+            lift_display = lift_df.rename(columns={
+                'group': '群体', 'option_a': '选项 A', 'option_b': '选项 B', 'n': '样本数',
+                'count_a': '选择 A 人数', 'count_b': '选择 B 人数', 'both': '同时选择人数', 'lift': '提升度'})
+            col_combinations, col_lift = st.columns(2)
+            with col_combinations:
+                st.dataframe(combination_display, hide_index=True)
+                st.download_button(
+                    label=f"📥 下载选项组合人数 ({export_format})",
+                    data=functools.partial(survey_export.export_bytes, combination_display, export_format),
+                    file_name=survey_export.export_file_name(f"{mask_col}_combinations", export_format),
+                    mime=survey_export.export_mime(export_format),
+                    key="download_cooccurrence_combinations"
+                )
+            with col_lift:
+                st.dataframe(lift_display, hide_index=True)
+                st.download_button(
+                    label=f"📥 下载两两提升度 ({export_format})",
+                    data=functools.partial(survey_export.export_bytes, lift_display, export_format),
+                    file_name=survey_export.export_file_name(f"{mask_col}_lift", export_format),
+                    mime=survey_export.export_mime(export_format),
+                    key="download_cooccurrence_lift"
+                )
 
-    st.markdown("**省份与地区对应 (Region):**")
-    st.table(pd.DataFrame(list(prov_to_region_map.items()), columns=['省份', '地区']))
+        # --- Rank Correlation Matrix ---
+        st.markdown("---")
+        st.subheader("🔗 相关性矩阵")
+
+        enable_correlation = st.checkbox("启用相关性矩阵（全部指标两两秩相关）", value=False, key="enable_correlation")
+
+        if enable_correlation:
+            correlation_method = st.radio("相关系数", options=list(survey_analysis.CORRELATION_METHODS),
+                                          format_func=lambda m: survey_analysis.CORRELATION_METHODS[m],
+                                          horizontal=True, key="correlation_method")
+            with trace.cached('rank_correlation', method=correlation_method) as stage_info:
+                corr_df, pair_counts = load_rank_correlation(current_dataset_key, filter_signature, correlation_method)
+                stage_info['columns'] = len(corr_df)
+
+            # Constant columns under the current filter have no correlation at all
+            corr_df = corr_df.dropna(how='all').dropna(axis=1, how='all')
+            correlation_cols = st.multiselect("选择参与的指标", options=list(corr_df.columns), default=list(corr_df.columns),
+                                              format_func=lambda c: question_cols_display_names.get(c, c), key="correlation_columns")
+            cluster_correlation = st.checkbox("按层次聚类排序（相关性强的指标相邻）", value=True, key="correlation_cluster")
+            if len(correlation_cols) < 2:
+                st.info("请至少选择两个有变化的指标。")
+            else:
+                corr_view = corr_df.loc[correlation_cols, correlation_cols]
+                if cluster_correlation:
+                    order = memoized('correlation_order', lambda: survey_analysis.cluster_order(corr_view),
+                                     current_dataset_key, filter_signature, correlation_method, correlation_cols)
+                    corr_view = corr_view.loc[order, order]
+                fig_corr = px.imshow(corr_view, zmin=-1, zmax=1, color_continuous_scale='RdBu_r',
+                                     text_auto='.2f' if len(corr_view) <= 15 else False, aspect='auto',
+                                     labels={'color': survey_analysis.CORRELATION_METHODS[correlation_method]},
+                                     title=f"{survey_analysis.CORRELATION_METHODS[correlation_method]} 相关系数矩阵（样本数 {len(filtered_df)}）")
+                fig_corr.update_layout(title_x=0.5, height=max(450, 26 * len(corr_view) + 200))
+                st.plotly_chart(fig_corr, use_container_width=True)
+                st.caption("缺失值按两两完整样本处理；Spearman 使用每个指标在自身有效答案上的平均秩。"
+                           f"最少的两两完整样本数为 {int(pair_counts.loc[correlation_cols, correlation_cols].to_numpy().min())}。"
+                           + ("相关系数未加权。" if weighted else ""))
+                st.download_button(
+                    label=f"📥 下载相关系数矩阵 ({export_format})",
+                    data=functools.partial(survey_export.export_bytes, corr_view, export_format, index=True),
+                    file_name=survey_export.export_file_name(f"correlation_{correlation_method}", export_format),
+                    mime=survey_export.export_mime(export_format),
+                    key="download_correlation"
+                )
 
+    # --- Response Quality ---
+    if 'quality_flags' in df_processed.columns:
+        with st.expander("🧹 答卷质量筛查报告"):
+            quality_df, quality_thresholds = memoized('quality_report', lambda: quality.quality_report(df_processed), current_dataset_key)
+            st.dataframe(quality_df, hide_index=True)
+            speeding = quality_thresholds.get('speeding')
+            if isinstance(speeding, dict):
+                speeding_note = "；".join(f"{wave} {seconds:.0f} 秒" for wave, seconds in speeding.items())
+            else:
+                speeding_note = "无答题时长数据" if speeding is None or pd.isna(speeding) else f"{speeding:.0f} 秒"
+            st.caption(
+                f"答题过快：用时不足中位数的 {quality.SPEEDING_SHARE:.0%}（{speeding_note}）；"
+                f"量表题答案全部相同：{len(quality.SCALE_COLUMNS)} 道 0-10 分题全部作答且分数相同；"
+                f"无效概率高：平台给出的无效概率不低于 {quality.INVALID_PROB_THRESHOLD:.0%}；"
+                "重复的用户标识或 IP 保留编号最小的一份。导出文件中没有的列对应的检查不会标记任何答卷。"
+                f"当前排除：{'、'.join(quality.QUALITY_CHECKS[c] for c in excluded_checks) or '无'}，筛选后样本数 {len(filtered_df)}。"
+            )
+            st.download_button(
+                label=f"📥 下载被标记的答卷 ({export_format})",
+                data=functools.partial(survey_export.export_bytes, memoized('flagged_responses', lambda: quality.flagged_responses(df_processed), current_dataset_key), export_format),
+                file_name=survey_export.export_file_name("flagged_responses", export_format),
+                mime=survey_export.export_mime(export_format),
+                key="download_flagged_responses"
+            )
 
-st.sidebar.markdown("---")
-st.sidebar.info("""
+    # --- Encoding Information ---
+    with st.expander("ℹ️ 查看编码说明和原始问卷信息"):
+        st.markdown("#### **问卷问题与编码后变量名映射**")
+        rename_df_display = pd.DataFrame(list(rename_map.items()), columns=['原始问卷问题', '编码后变量名'])
+        st.table(rename_df_display)
+
+        st.markdown("#### **具体编码详情**")
+
+        st.markdown("**上海人身份 (native_str):**")
+        # native_mapping_display from load_and_process_data
+        native_df_disp = pd.DataFrame(list(native_map_disp.items()), columns=['原问卷答案', '分析用标签'])
+        st.table(native_df_disp)
+
+        st.markdown("**专业类型 (major_str / major):**")
+        if major_mapping:
+            major_df_disp = pd.DataFrame(list(major_mapping.items()), columns=['原问卷答案', '编码值 (major)'])
+            st.table(major_df_disp.sort_values(by='编码值 (major)'))
+        else:
+            st.markdown("_无专业类型数据或映射_")
+
+        st.markdown("**年级 (grade_str / grade):**")
+        if grade_mapping:
+            grade_df_disp = pd.DataFrame(list(grade_mapping.items()), columns=['原问卷答案', '编码值 (grade)'])
+            st.table(grade_df_disp.sort_values(by='编码值 (grade)'))
+        else:
+            st.markdown("_无年级数据或映射_")
+
+        # Fixed answer codes, rendered from the same codebook the pipeline encodes with
+        for code_col, entry in survey_data.ANSWER_CODEBOOK.items():
+            source_col = entry.get('source', code_col)
+            st.markdown(f"**{entry['label']} ({code_col}):**")
+            codes_df_disp = pd.DataFrame(list(entry['codes'].items()), columns=['原问卷答案', f'编码值 ({code_col})'])
+            if 'display' in entry:
+                codes_df_disp['分析用标签'] = codes_df_disp[f'编码值 ({code_col})'].map(entry['display'])
+            if 'default' in entry:
+                codes_df_disp.loc[len(codes_df_disp)] = ['其他答案', entry['default']] + [''] * (codes_df_disp.shape[1] - 2)
+            st.table(codes_df_disp)
+            if source_col != code_col:
+                st.caption(f"由原变量 {source_col} 编码得到")
+
+        st.markdown("**省份与地区对应 (Region):**")
+        st.table(pd.DataFrame(list(prov_to_region_map.items()), columns=['省份', '地区']))
+
+        st.markdown("#### **数据内存占用**")
+        memory_usage = df_processed.memory_usage(deep=True, index=False)
+        st.write(f"处理后数据共 {len(df_processed)} 行、{df_processed.shape[1]} 列，占用 {memory_usage.sum() / 1024 ** 2:.2f} MB（每个工作进程各缓存一份）")
+        cache_stats = dataset_cache().stats()
+        st.write(f"数据集缓存：{cache_stats['entries']} 个（上限 {dataset_registry.CACHE_MAX_ENTRIES} 个），"
+                 f"约 {cache_stats['bytes'] / 1024 ** 2:.2f} MB（上限 {dataset_registry.CACHE_MAX_MB:.0f} MB，按最近最少使用淘汰）")
+        memory_df = pd.DataFrame({
+            '变量名': memory_usage.index,
+            '数据类型': df_processed.dtypes.astype(str).values,
+            '内存 (KB)': (memory_usage.values / 1024).round(1),
+        }).sort_values(by='内存 (KB)', ascending=False)
+        st.dataframe(memory_df, hide_index=True)
+
+
+    st.sidebar.markdown("---")
+    st.sidebar.info("""
 **💡 运行指南:**
-1. 确保 `data.csv` 文件与此 `interactive_app.py` 在同一目录下。
+1. 确保 `data.csv` 文件与此 `interactive_app.py` 在同一目录下；其他调查批次的导出文件可放在 `data/` 目录下。
 2. 安装必要的库: 
-   `pip install streamlit pandas plotly openpyxl category_encoders`
+   `pip install streamlit pandas plotly openpyxl scipy pyarrow`
 3. 在终端中运行: 
    `streamlit run interactive_app.py`
 """)
 
 
-st.markdown("---")
-st.markdown("Shanghainese Dialect Survey Interactive Analysis | Developed with Streamlit") 
+    st.markdown("---")
+    st.markdown("Shanghainese Dialect Survey Interactive Analysis | Developed with Streamlit") 
+
+    trace.lap('page_rest')
+    if st.sidebar.checkbox("⏱️ 显示性能调试面板", value=False, key="show_perf_trace"):
+        rerun_record = trace.to_record()
+        stages_df = pd.DataFrame(rerun_record['stages'])
+        st.sidebar.markdown(f"**本次运行耗时: {rerun_record['total_ms']:.1f} ms**")
+        st.sidebar.dataframe(stages_df, hide_index=True)
+        if perf_trace.TRACE_PATH:
+            st.sidebar.caption(f"每次运行的分阶段耗时追加写入 `{perf_trace.TRACE_PATH}`，可用 `python perf_trace.py` 汇总 p50/p99。")
+
+
+try:
+    main()
+finally:
+    # Also when st.stop(), an error or a widget-triggered rerun ends the script early
+    trace.finish()
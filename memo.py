@@ -0,0 +1,91 @@
+"""Bounded, thread-safe memoization shared across Streamlit reruns and sessions.
+
+Results are keyed by a canonical signature of the inputs they depend on, so a rerun triggered
+by an unrelated widget finds them again instead of recomputing them.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Bounds for the derived results one server process keeps around
+RESULT_MEMO_MB = float(os.environ.get('SURVEY_MEMO_MB', 256))
+RESULT_MEMO_ENTRIES = int(os.environ.get('SURVEY_MEMO_ENTRIES', 512))
+
+
+def signature(value):
+    """Hashable, canonical form of nested widget values: dicts are ordered by key, lists become
+    tuples (their order is kept, it usually matters), sets are sorted and numpy scalars unwrapped."""
+    if isinstance(value, dict):
+        return tuple(sorted(((signature(k), signature(v)) for k, v in value.items()), key=repr))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted((signature(v) for v in value), key=repr))
+    if isinstance(value, (list, tuple)):
+        return tuple(signature(v) for v in value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def approx_nbytes(obj):
+    """Memory held by frames and arrays nested in dicts, lists and tuples."""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum() if isinstance(obj, pd.DataFrame) else usage)
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(approx_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(approx_nbytes(v) for v in obj)
+    return 0
+
+
+class BoundedLRU:
+    """Thread-safe LRU bounded by entry count and approximate memory.
+
+    Values are shared and must not be mutated. The most recently used entry is always kept,
+    even when it alone exceeds the memory bound.
+    """
+
+    def __init__(self, max_bytes, max_entries, sizeof=approx_nbytes):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._building = {}
+
+    def get(self, key, build):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            build_lock = self._building.setdefault(key, threading.Lock())
+        # One build per key at a time; other keys are served and built concurrently
+        with build_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key][0]
+            value = build()
+            size = self.sizeof(value)
+            with self._lock:
+                self._entries[key] = (value, size)
+                self._building.pop(key, None)
+                self._evict()
+        return value
+
+    def _evict(self):
+        total = sum(size for _, size in self._entries.values())
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or total > self.max_bytes):
+            _, (_, size) = self._entries.popitem(last=False)
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': sum(size for _, size in self._entries.values()),
+                    'keys': list(self._entries)}
@@ -0,0 +1,167 @@
+"""Per-stage timing of a Streamlit script rerun.
+
+interactive_app.py opens one RerunTrace per rerun and marks its stages (data loading, filters,
+charts, CSV exports, contingency + chi-square); each stage records its wall time plus any sizes
+the app attaches. Cached loaders report misses with `note_cache_miss`, so every cached call is
+logged as a hit or a miss. Finished reruns are appended as JSON lines to TRACE_PATH when
+SURVEY_TRACE_PATH names a file (tracing is off otherwise), and
+
+    python perf_trace.py .traces/reruns.jsonl
+
+summarizes p50/p99 per stage across sessions. A trace file that cannot be written is skipped,
+so tracing never breaks a page render.
+"""
+import json
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_PATH = os.environ.get('SURVEY_TRACE_PATH', '')
+
+# Streamlit runs each session's script in its own thread
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+class RerunTrace:
+    def __init__(self, session_id=None):
+        self.session_id = session_id
+        self.timestamp = time.time()
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.stages = []
+        self._misses = []
+        _local.trace = self
+
+    def _record(self, name, start, info):
+        now = time.perf_counter()
+        self.stages.append({'stage': name, 'ms': round((now - start) * 1000, 3), **info})
+        self._last = now
+
+    def lap(self, name, **info):
+        """Close a stage that ran since the previous stage ended."""
+        self._record(name, self._last, info)
+
+    @contextmanager
+    def stage(self, name, **info):
+        """Time the enclosed block; sizes known only inside it can be added to the yielded dict."""
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self._record(name, start, info)
+
+    @contextmanager
+    def cached(self, name, **info):
+        """A stage around a cached call, logged as a miss when the cached body ran."""
+        seen = len(self._misses)
+        with self.stage(name, **info) as details:
+            yield details
+            details['cache'] = 'miss' if name in self._misses[seen:] else 'hit'
+
+    def cache_miss(self, name):
+        self._misses.append(name)
+
+    def total_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def to_record(self):
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.timestamp)),
+            'session': self.session_id,
+            'total_ms': round(self.total_ms(), 3),
+            'stages': self.stages,
+        }
+
+    def finish(self, path=TRACE_PATH):
+        """Append the rerun to `path`. Called from a `finally`, so reruns cut short are kept, with
+        the exception that ended them (StopException, RerunException, ...) as their outcome."""
+        record = self.to_record()
+        error = sys.exc_info()[1]
+        record['outcome'] = 'completed' if error is None else type(error).__name__
+        if path:
+            line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+            try:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                with _write_lock, open(path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            except OSError:
+                pass  # Read-only deployments simply skip the trace
+        if getattr(_local, 'trace', None) is self:
+            del _local.trace
+        return record
+
+
+def current():
+    """The trace of the rerun running in this thread, if any."""
+    return getattr(_local, 'trace', None)
+
+
+def note_cache_miss(name):
+    # Called from the body of a cached function, which only runs on a miss
+    trace = current()
+    if trace is not None:
+        trace.cache_miss(name)
+
+
+def _percentile(values, q):
+    # Nearest-rank, so p99 of a handful of reruns is an observed value
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(path=TRACE_PATH):
+    """p50/p99/max in ms per stage (stages repeated within a rerun are summed) and for whole reruns,
+    with the number of reruns that ended early (st.stop(), errors, widget-triggered reruns)."""
+    per_stage = {}
+    totals = []
+    cache = {}
+    cut_short = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            totals.append(record['total_ms'])
+            # Older traces have no outcome; they were only written for completed reruns
+            cut_short += record.get('outcome', 'completed') != 'completed'
+            rerun = {}
+            for stage in record['stages']:
+                rerun[stage['stage']] = rerun.get(stage['stage'], 0) + stage['ms']
+                if 'cache' in stage:
+                    hits = cache.setdefault(stage['stage'], {'hit': 0, 'miss': 0})
+                    hits[stage['cache']] += 1
+            for name, ms in rerun.items():
+                per_stage.setdefault(name, []).append(ms)
+    rows = [{'stage': '(rerun total)', 'reruns': len(totals), 'p50_ms': _percentile(totals, 50),
+             'p99_ms': _percentile(totals, 99), 'max_ms': max(totals), 'cut_short': cut_short}] if totals else []
+    for name, values in per_stage.items():
+        row = {'stage': name, 'reruns': len(values), 'p50_ms': _percentile(values, 50),
+               'p99_ms': _percentile(values, 99), 'max_ms': max(values)}
+        if name in cache:
+            row['cache_hits'] = cache[name]['hit']
+            row['cache_misses'] = cache[name]['miss']
+        rows.append(row)
+    return rows
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    path = argv[0] if argv else TRACE_PATH
+    if not path:
+        print("usage: python perf_trace.py TRACE_FILE (or set SURVEY_TRACE_PATH)", file=sys.stderr)
+        return 2
+    for row in summarize(path):
+        cache = f"  cache {row['cache_hits']} hit / {row['cache_misses']} miss" if 'cache_hits' in row else ''
+        if row.get('cut_short'):
+            cache += f"  ({row['cut_short']} ended early)"
+        print(f"{row['stage']:<28} n={row['reruns']:<6} p50 {row['p50_ms']:>9.1f} ms  "
+              f"p99 {row['p99_ms']:>9.1f} ms  max {row['max_ms']:>9.1f} ms{cache}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
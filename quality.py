@@ -0,0 +1,222 @@
+"""Response-quality screening: speeders, straight-liners, likely-invalid and repeated responses.
+
+Every check is one vectorized pass over columns process_survey keeps for it, and the results are
+packed into one uint8 bitmask column, `quality_flags` (bit i set when QUALITY_CHECKS' i-th check
+flags the response). The sidebar filter and the cube then treat it like any other dimension.
+Straight-lining only looks at the response itself and is set per chunk in process_survey; the
+other checks depend on the whole export (median duration, the scale the invalid probability is
+written in, earlier submissions), so `screen_responses` sets them once the export is merged.
+
+Raw 用户标识/IP values are never kept: process_survey replaces them with HMAC-SHA256 hashes under
+SURVEY_IDENTITY_KEY, a secret held by the deployment. The hashes only reach the duplicate check;
+they are not columns of the processed frame, so no export or download carries them. Without
+SURVEY_IDENTITY_KEY each process uses a random key, which still screens one export correctly but
+cannot extend a snapshot written by another process.
+"""
+import hashlib
+import hmac
+import os
+
+import numpy as np
+import pandas as pd
+
+QUALITY_CHECKS = {
+    'speeding': "答题过快",
+    'straight_lining': "量表题答案全部相同",
+    'invalid_prob': "无效概率高",
+    'duplicate_user': "用户标识重复",
+    'duplicate_ip': "IP 重复",
+}
+QUALITY_BITS = {check: 1 << i for i, check in enumerate(QUALITY_CHECKS)}
+# Excluded by default in the app; shared campus networks make repeated IPs common among honest respondents
+DEFAULT_EXCLUDED = ['speeding', 'straight_lining', 'invalid_prob', 'duplicate_user']
+# Responses completed in less than this share of the median duration are speeders
+SPEEDING_SHARE = 1 / 3
+INVALID_PROB_THRESHOLD = 0.5
+# The 0-10 rating questions; the same rating on every one of them is straight-lining. The lettered
+# attitude items (identity, course_attitude, young_should, ...) are left out: option A is the most
+# favourable answer on nearly all of them, so answering A throughout is a consistent attitude rather
+# than inattention (3 of the 124 responses in data.csv do, all with A)
+SCALE_COLUMNS = ['overall_impression', 'public_hear_view', 'private_use_view', 'speaking_ability',
+                 'listening_ability', 'usage_freq', 'sns_use_freq', 'video_view', 'awkward_score', 'env_support']
+# Raw export columns used by the checks -> processed column names
+QUALITY_COLUMNS = {'答题时长': 'duration_s', '智能清洗数据无效概率': 'invalid_prob',
+                   '用户标识': 'user_hash', 'IP': 'ip_hash'}
+IDENTITY_COLUMNS = ['user_hash', 'ip_hash']
+# Kept beside the frame rather than in it and handed to `screen_responses`
+SCREENING_INPUTS = IDENTITY_COLUMNS + ['invalid_prob_plain']
+
+_PROCESS_KEY = os.urandom(32)
+
+
+def identity_key():
+    key = os.environ.get('SURVEY_IDENTITY_KEY')
+    return key.encode('utf-8') if key else _PROCESS_KEY
+
+
+def key_fingerprint(key=None):
+    """Tells whether stored hashes were made with the current key, without revealing it."""
+    return hmac.new(key or identity_key(), b'survey identity fingerprint', hashlib.sha256).hexdigest()[:16]
+
+
+def identity_hash(values, key=None):
+    """Keyed uint64 hash per answer (one HMAC per distinct answer), 0 for missing ones."""
+    key = key or identity_key()
+    codes, uniques = pd.factorize(pd.Series(values).astype(object).map(lambda v: str(v).strip(), na_action='ignore'))
+    digests = [int.from_bytes(hmac.new(key, u.encode('utf-8'), hashlib.sha256).digest()[:8], 'little') | 1 for u in uniques]
+    # | 1 keeps 0 free for missing answers
+    return np.append(np.array(digests, dtype=np.uint64), np.uint64(0))[codes]
+
+
+def parse_probability(values):
+    """Exports write the probability as 0.87, 87 or '87%'.
+
+    Returns (probability, plain): '87%' is read as 0.87, while plain numbers are returned as
+    written and marked in `plain`; `screen_responses` decides their scale for the whole export.
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype(float), pd.Series(True, index=values.index)
+    text = values.astype(object).map(lambda v: str(v).strip(), na_action='ignore')
+    percent = text.str.endswith('%').fillna(False).astype(bool)
+    probability = pd.to_numeric(text.str.rstrip('%'), errors='coerce')
+    return probability.where(~percent, probability / 100), ~percent
+
+
+def probability_scale(probability):
+    """100 when plain probabilities are percentages (any of them above 1), else 1."""
+    return 100.0 if (pd.Series(probability, dtype=float) > 1).any() else 1.0
+
+
+def row_flags(df):
+    """The bits that depend on each response alone: straight-lining."""
+    flags = np.zeros(len(df), dtype=np.uint8)
+    scale = [col for col in SCALE_COLUMNS if col in df.columns]
+    if len(scale) >= 3:
+        answers = df[scale].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        same = (answers == answers[:, :1]).all(axis=1)
+        flags |= np.where(same, QUALITY_BITS['straight_lining'], 0).astype(np.uint8)
+    return flags
+
+
+def speeding_threshold(duration):
+    """Completion time in seconds below which a response counts as speeding; NaN without durations."""
+    median = pd.Series(duration, dtype=float).median()
+    return median * SPEEDING_SHARE
+
+
+def _repeats(hashes, order):
+    # Every occurrence after the first submission of the same hash; 0 is a missing identifier
+    repeated = np.zeros(len(hashes), dtype=bool)
+    ordered = hashes[order]
+    repeated[order] = pd.Series(ordered).duplicated().to_numpy() & (ordered != 0)
+    return repeated
+
+
+def screen_responses(df, inputs, state=None):
+    """Set the bits that depend on the whole export in df['quality_flags'], in place.
+
+    `inputs` holds the SCREENING_INPUTS columns of the rows not screened before, indexed like
+    them; `state` is what screening the other rows of `df` returned, so an extended export is
+    screened without re-reading its old rows. Plain invalid probabilities are read in one scale
+    for the whole export, speeding is relative to the median duration of `df`, and duplicates
+    keep the first submission by response_id.
+
+    Returns (df, state for the next call). Raises ValueError when the new rows need another
+    probability scale than the rows screened before.
+    """
+    flags = df['quality_flags'].to_numpy(dtype=np.uint8) if 'quality_flags' in df.columns else np.zeros(len(df), dtype=np.uint8)
+    flags = flags & np.uint8(QUALITY_BITS['straight_lining'])
+
+    scale = state['invalid_prob_scale'] if state else 1.0
+    if 'invalid_prob' in df.columns:
+        probability = df['invalid_prob'].astype(float)
+        plain = inputs['invalid_prob_plain'].reindex(df.index, fill_value=False).to_numpy(dtype=bool)
+        new_scale = probability_scale(probability[plain])
+        if state is None:
+            scale = new_scale
+        elif new_scale > scale:
+            raise ValueError("new rows write the invalid probability in another scale")
+        df['invalid_prob'] = probability.where(~plain, probability / scale)
+        high = (df['invalid_prob'] >= INVALID_PROB_THRESHOLD).fillna(False).to_numpy(dtype=bool)
+        flags |= np.where(high, QUALITY_BITS['invalid_prob'], 0).astype(np.uint8)
+
+    if 'duration_s' in df.columns:
+        duration = df['duration_s'].to_numpy(dtype=float, na_value=np.nan)
+        fast = duration < speeding_threshold(duration)
+        flags |= np.where(fast, QUALITY_BITS['speeding'], 0).astype(np.uint8)
+
+    identities = inputs[[col for col in IDENTITY_COLUMNS if col in inputs.columns]]
+    if state is not None:
+        identities = pd.concat([state['identities'], identities])
+    identities = identities.reindex(df.index)
+    if 'response_id' in df.columns:
+        order = np.argsort(df['response_id'].to_numpy(dtype=float, na_value=np.inf), kind='stable')
+    else:
+        order = np.arange(len(df))
+    for col, check in (('user_hash', 'duplicate_user'), ('ip_hash', 'duplicate_ip')):
+        if col in identities.columns:
+            repeated = _repeats(identities[col].fillna(0).to_numpy(dtype=np.uint64), order)
+            flags |= np.where(repeated, QUALITY_BITS[check], 0).astype(np.uint8)
+    df['quality_flags'] = flags
+    return df, {'invalid_prob_scale': scale, 'identities': identities.astype('uint64')}
+
+
+def passing_values(excluded):
+    """Every quality_flags value with none of the `excluded` checks set, for filter selections.
+
+    Returns [] (no filter) when nothing is excluded.
+    """
+    if not excluded:
+        return []
+    mask = 0
+    for check in excluded:
+        mask |= QUALITY_BITS[check]
+    return [value for value in range(1 << len(QUALITY_CHECKS)) if not value & mask]
+
+
+def check_counts(flags):
+    """Responses flagged by each check, as a Series over QUALITY_CHECKS."""
+    flags = np.asarray(flags, dtype=np.uint8)
+    bits = (flags[:, None] >> np.arange(len(QUALITY_CHECKS), dtype=np.uint8)) & 1
+    return pd.Series(bits.sum(axis=0), index=list(QUALITY_CHECKS), dtype='int64')
+
+
+def quality_report(df):
+    """Flagged responses per check, and per wave when several waves are combined.
+
+    One row per check plus 任一项 (flagged by any check), with the columns 检查项, 人数 and
+    占比 (%) (prefixed by the wave name per wave), and the checks' thresholds as a dict.
+    """
+    flags = df['quality_flags'].to_numpy(dtype=np.uint8) if 'quality_flags' in df.columns else np.zeros(len(df), dtype=np.uint8)
+    parts = {'': np.ones(len(df), dtype=bool)}
+    if 'wave' in df.columns and df['wave'].nunique() > 1:
+        parts.update({f"{wave} ": (df['wave'] == wave).to_numpy() for wave in df['wave'].cat.categories})
+    report = pd.DataFrame({'检查项': list(QUALITY_CHECKS.values()) + ["任一项"]})
+    for prefix, rows in parts.items():
+        counts = check_counts(flags[rows]).tolist() + [int((flags[rows] > 0).sum())]
+        total = int(rows.sum())
+        report[f"{prefix}人数"] = counts
+        report[f"{prefix}占比 (%)"] = np.round(np.array(counts) / total * 100, 2) if total else 0.0
+
+    thresholds = {'invalid_prob': INVALID_PROB_THRESHOLD}
+    if 'duration_s' in df.columns:
+        if len(parts) > 1:
+            thresholds['speeding'] = {prefix.strip(): speeding_threshold(df.loc[rows, 'duration_s'])
+                                      for prefix, rows in parts.items() if prefix}
+        else:
+            thresholds['speeding'] = speeding_threshold(df['duration_s'])
+    return report, thresholds
+
+
+def flag_labels(flags):
+    """'答题过快、IP 重复'-style labels of quality_flags values ('' for unflagged responses)."""
+    codes, uniques = pd.factorize(pd.Series(flags, dtype='uint8'))
+    names = ['、'.join(label for check, label in QUALITY_CHECKS.items() if value & QUALITY_BITS[check]) for value in uniques]
+    return pd.Series(np.array(names + [''], dtype=object)[codes], index=getattr(flags, 'index', None))
+
+
+def flagged_responses(df):
+    """The flagged rows with their response id, screening inputs and the checks that flagged them."""
+    flagged = df[df['quality_flags'] > 0]
+    columns = [col for col in ['wave', 'response_id', 'duration_s', 'invalid_prob'] if col in flagged.columns]
+    return flagged[columns].assign(检查项=flag_labels(flagged['quality_flags'])).reset_index(drop=True)
@@ -0,0 +1,163 @@
+"""Static report of every metric by every grouping key, built without Streamlit.
+
+All group means come from one pre-aggregated cube and the threshold tables from one binning pass
+per metric; the charts are then rendered on a process pool into a self-contained bundle:
+
+    report/index.html        every chart and table, plotly.js inlined once
+    report/group_means.csv   mean and count per metric x grouping key x group
+    report/thresholds.csv    interval counts per metric (with --thresholds)
+    report/quality.csv       responses flagged by each quality check (see quality.py)
+    report/png/*.png         one image per chart (with --png, needs kaleido)
+
+    python report.py --out report --thresholds 2,3,4 --workers 4
+
+Like the dashboard, the aggregates leave out the responses flagged by quality.DEFAULT_EXCLUDED;
+`--exclude` picks other checks, and `--exclude` alone keeps every response.
+"""
+import argparse
+import html
+import importlib.util
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import dataset_registry
+import quality
+import survey_analysis
+import survey_data
+
+
+def compute_aggregates(df, question_cols, group_keys, thresholds=()):
+    """(group means as one long frame, threshold interval counts as one long frame)."""
+    cube = survey_analysis.build_cube(df, question_cols)
+    metrics = list(cube['sum'].columns)
+    group_frames = []
+    for key in group_keys:
+        stats = survey_analysis.cube_group_stats(cube, {}, key, metrics)
+        group_frames.append(stats.rename(columns={key: 'group'}).assign(group_key=key))
+    group_means = pd.concat(group_frames, ignore_index=True)[['group_key', 'group', 'metric', 'mean', 'count']]
+
+    threshold_frames = []
+    if thresholds:
+        labels = survey_analysis.interval_labels(thresholds)
+        for metric in metrics:
+            counts = survey_analysis.interval_counts(df[metric], thresholds)
+            total = counts.sum()
+            threshold_frames.append(pd.DataFrame({
+                'metric': metric, '区间': labels, '人数': counts,
+                '百分比 (%)': (counts / total * 100).round(2) if total else 0.0,
+            }))
+    threshold_counts = pd.concat(threshold_frames, ignore_index=True) if threshold_frames else pd.DataFrame()
+    return group_means, threshold_counts
+
+
+def _chart_name(metric, group_key):
+    return f"{metric}_by_{group_key}"
+
+
+def render_chart(task):
+    """Chart of one metric by one grouping key as an HTML fragment, optionally also saved as PNG."""
+    import plotly.express as px
+
+    metric, group_key, stats, png_dir = task
+    group_label = survey_analysis.GROUPING_LABELS.get(group_key, group_key)
+    plot_df = stats.sort_values(by='mean', ascending=False).rename(columns={'group': group_key})
+    fig = px.bar(plot_df, x=group_key, y='mean',
+                 title=f"'{metric}' 按 '{group_label}' 分布 (均值)",
+                 labels={'mean': f"均值 - {metric}", group_key: group_label},
+                 color=group_key, hover_data=['count'], text_auto='.2f')
+    fig.update_layout(title_x=0.5, legend_title_text=group_label)
+    png_path = None
+    if png_dir:
+        png_path = os.path.join(png_dir, f"{_chart_name(metric, group_key)}.png")
+        fig.write_image(png_path)
+    return fig.to_html(full_html=False, include_plotlyjs=False), png_path
+
+
+def _html_page(title, sections):
+    from plotly.offline import get_plotlyjs
+
+    return (
+        "<!DOCTYPE html>\n<html lang=\"zh\"><head><meta charset=\"utf-8\">"
+        f"<title>{html.escape(title)}</title>"
+        "<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse}"
+        "td,th{border:1px solid #ccc;padding:2px 8px;text-align:right}</style>"
+        f"<script type=\"text/javascript\">{get_plotlyjs()}</script></head><body>\n"
+        f"<h1>{html.escape(title)}</h1>\n" + "\n".join(sections) + "\n</body></html>\n"
+    )
+
+
+def build_report(paths, out_dir, thresholds=(), workers=None, png=False, exclude=tuple(quality.DEFAULT_EXCLUDED)):
+    """Write the bundle for the survey exports in `paths` (several exports are combined as waves),
+    leaving the responses flagged by the `exclude` quality checks out of the aggregates."""
+    waves = [(survey_data._stem(path), survey_data.load_and_process_data(path)) for path in paths]
+    screened, question_cols, *_ = dataset_registry.combine_waves(waves)
+    df = screened
+    if exclude and 'quality_flags' in screened.columns:
+        df = screened[screened['quality_flags'].isin(quality.passing_values(exclude))]
+    group_keys = [key for key in survey_analysis.GROUPING_KEYS if key in df.columns]
+    group_means, threshold_counts = compute_aggregates(df, question_cols, group_keys, thresholds)
+
+    os.makedirs(out_dir, exist_ok=True)
+    png_dir = os.path.join(out_dir, 'png') if png else None
+    if png_dir:
+        os.makedirs(png_dir, exist_ok=True)
+    group_means.to_csv(os.path.join(out_dir, 'group_means.csv'), index=False, encoding='utf-8-sig')
+    if not threshold_counts.empty:
+        threshold_counts.to_csv(os.path.join(out_dir, 'thresholds.csv'), index=False, encoding='utf-8-sig')
+    quality_counts, _ = quality.quality_report(screened)
+    quality_counts.to_csv(os.path.join(out_dir, 'quality.csv'), index=False, encoding='utf-8-sig')
+
+    tasks = [(metric, key, stats[['group', 'mean', 'count']], png_dir)
+             for (key, metric), stats in group_means.groupby(['group_key', 'metric'], sort=False)]
+    if workers == 1:
+        rendered = [render_chart(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rendered = list(pool.map(render_chart, tasks, chunksize=max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))))
+
+    excluded_labels = '、'.join(quality.QUALITY_CHECKS[check] for check in exclude) or "无"
+    sections = [f"<p>样本数: {len(df)}（排除的质量检查: {html.escape(excluded_labels)}，共排除 {len(screened) - len(df)} 份）；数据文件: {html.escape(', '.join(paths))}；生成时间: {time.strftime('%Y-%m-%d %H:%M')}</p>"]
+    charts = {(task[1], task[0]): fragment for task, (fragment, _) in zip(tasks, rendered)}
+    for key in group_keys:
+        sections.append(f"<h2>按{html.escape(survey_analysis.GROUPING_LABELS.get(key, key))}分组</h2>")
+        sections.extend(charts[(key, metric)] for metric in group_means['metric'].unique() if (key, metric) in charts)
+    if not threshold_counts.empty:
+        sections.append(f"<h2>阈值分析 (阈值: {html.escape(', '.join(str(t) for t in thresholds))})</h2>")
+        for metric, table in threshold_counts.groupby('metric', sort=False):
+            sections.append(f"<h3>{html.escape(metric)}</h3>" + table.drop(columns='metric').to_html(index=False))
+
+    # Counted over every response, including the excluded ones
+    sections.append("<h2>答卷质量筛查</h2>" + quality_counts.to_html(index=False))
+
+    index_path = os.path.join(out_dir, 'index.html')
+    with open(index_path, 'w', encoding='utf-8') as f:
+        f.write(_html_page("上海话问卷数据分析报告", sections))
+    return index_path, len(tasks)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data', nargs='+', default=[survey_data.DATA_PATH], help="survey exports (several are combined as waves)")
+    parser.add_argument('--out', default='report', help="output directory")
+    parser.add_argument('--thresholds', default='', help="comma-separated thresholds for the threshold tables, e.g. 2,3,4")
+    parser.add_argument('--workers', type=int, default=None, help="rendering processes (default: one per CPU)")
+    parser.add_argument('--png', action='store_true', help="also save every chart as PNG (needs kaleido)")
+    parser.add_argument('--exclude', nargs='*', choices=list(quality.QUALITY_CHECKS), default=quality.DEFAULT_EXCLUDED,
+                        help="quality checks whose flagged responses are left out (default: %(default)s; none when given alone)")
+    args = parser.parse_args(argv)
+
+    if args.png and importlib.util.find_spec('kaleido') is None:
+        parser.error("--png needs kaleido: pip install kaleido")
+    thresholds = sorted(float(x) for x in args.thresholds.split(',') if x.strip())
+    start = time.perf_counter()
+    index_path, n_charts = build_report(args.data, args.out, thresholds, args.workers, args.png, args.exclude)
+    print(f"{n_charts} charts -> {index_path} ({time.perf_counter() - start:.1f} s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
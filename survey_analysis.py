@@ -0,0 +1,640 @@
+import numpy as np
+import pandas as pd
+
+import weighting
+
+# Sidebar filter dimensions, in the order the filters are shown; quality_flags is selected
+# through quality.passing_values rather than value by value
+FILTER_DIMENSIONS = ['major', 'grade', 'Region', 'gender_str', 'native_str', 'quality_flags']
+
+
+# --- Filter index ---
+def build_filter_index(df, dims=FILTER_DIMENSIONS):
+    """Precompute one boolean mask per (dimension, value) so filters never rescan the columns.
+
+    Returns {dim: {value: bool ndarray}}. Rows where the dimension is missing are in no mask,
+    which matches what `isin` does.
+    """
+    index = {}
+    for dim in dims:
+        if dim not in df.columns:
+            continue
+        codes, uniques = pd.factorize(df[dim])
+        index[dim] = {value: codes == i for i, value in enumerate(uniques)}
+    return index
+
+
+def filter_mask(index, n_rows, selections):
+    """AND together, across dimensions, the OR of the selected values' masks.
+
+    Empty selections leave their dimension unfiltered, like the sidebar always did.
+    Returns None when no filter is active.
+    """
+    mask = None
+    for dim, selected in selections.items():
+        if not selected or dim not in index:
+            continue
+        value_masks = index[dim]
+        dim_mask = np.zeros(n_rows, dtype=bool)
+        for value in selected:
+            if value in value_masks:
+                dim_mask |= value_masks[value]
+        mask = dim_mask if mask is None else mask & dim_mask
+    return mask
+
+
+def apply_filters(df, index, selections):
+    mask = filter_mask(index, len(df), selections)
+    if mask is None or mask.all():
+        return df
+    return df[mask]
+
+
+# --- Pre-aggregated cube for grouped means ---
+# Grouping keys offered in the sidebar; major_str/grade_str follow from major/grade, and
+# wave only exists when several survey waves are combined
+GROUPING_KEYS = ['Region', 'city_tier', 'gender_str', 'native_str', 'major_str', 'grade_str', 'wave']
+GROUPING_LABELS = {'Region': "地区", 'city_tier': "城市等级", 'gender_str': "性别", 'native_str': "上海人身份",
+                   'major_str': "专业类型", 'grade_str': "年级", 'wave': "调查批次"}
+
+
+def build_cube(df, metrics, weights=None):
+    """Sum and non-null count of every metric per combination of filter and grouping values.
+
+    Any sidebar filter plus grouping key can then be answered from the cells alone, so the
+    cost depends on the number of value combinations instead of the number of respondents.
+    With `weights` (aligned with `df`), 'sum' holds weighted sums and 'weight' the weight of
+    the non-null values, so the cube's means are weighted; 'count' stays the respondent count.
+    """
+    dims = [d for d in dict.fromkeys(FILTER_DIMENSIONS + GROUPING_KEYS) if d in df.columns]
+    metrics = [m for m in metrics if m in df.columns and pd.api.types.is_numeric_dtype(df[m])]
+    grouped = df.groupby(dims, dropna=False, observed=True, sort=False)[metrics]
+    sums = grouped.sum().astype(float)
+    counts = grouped.count().astype('int64')
+    keys = sums.index.to_frame(index=False)
+    cube = {
+        'keys': keys,
+        'sum': sums.reset_index(drop=True),
+        'count': counts.reset_index(drop=True),
+        # Cells are filtered with the same mask index the rows use
+        'index': build_filter_index(keys),
+    }
+    if weights is not None:
+        values = df[metrics].astype(float)
+        w = pd.Series(np.asarray(weights, dtype=float), index=df.index)
+        by = [df[d] for d in dims]
+        weighted = values.mul(w, axis=0).groupby(by, dropna=False, observed=True, sort=False).sum()
+        weight = values.notna().mul(w, axis=0).groupby(by, dropna=False, observed=True, sort=False).sum()
+        # Same cells in the same order as the unweighted aggregation
+        cube['sum'] = weighted.reindex(sums.index).reset_index(drop=True)
+        cube['weight'] = weight.reindex(sums.index).reset_index(drop=True)
+    return cube
+
+
+def cube_group_stats(cube, selections, group_key, metrics):
+    """Mean and count of several metrics by `group_key` in one pass over the cube cells.
+
+    Returns a long frame with columns [group_key, 'metric', 'mean', 'count']. Like dropna +
+    groupby().mean() on the filtered rows, groups without any value for a metric are left out.
+    Means are weighted when the cube was built with weights.
+    """
+    keys = cube['keys']
+    mask = filter_mask(cube['index'], len(keys), selections)
+    if mask is None:
+        mask = np.ones(len(keys), dtype=bool)
+    groups = keys.loc[mask, group_key]
+    sums = cube['sum'].loc[mask, metrics].groupby(groups, observed=True).sum()
+    counts = cube['count'].loc[mask, metrics].groupby(groups, observed=True).sum()
+    if 'weight' in cube:
+        weight = cube['weight'].loc[mask, metrics].groupby(groups, observed=True).sum()
+        means = sums / weight.where(weight > 0)
+    else:
+        means = sums / counts.where(counts > 0)
+    stats = pd.DataFrame({'mean': means.stack(), 'count': counts.stack()})
+    stats.index.names = [group_key, 'metric']
+    stats = stats[stats['count'] > 0].reset_index()
+    stats[group_key] = stats[group_key].astype(object)
+    # Keep the metrics in the order they were asked for
+    stats['metric'] = pd.Categorical(stats['metric'], categories=metrics)
+    return stats.sort_values(['metric', group_key], kind='stable').reset_index(drop=True).astype({'metric': object})
+
+
+def cube_group_means(cube, selections, group_key, metric):
+    """Group means of a single `metric`, shaped like groupby(group_key, as_index=False)[metric].mean()."""
+    stats = cube_group_stats(cube, selections, group_key, [metric])
+    return stats[[group_key, 'mean']].rename(columns={'mean': metric})
+
+
+# --- Threshold binning ---
+def interval_labels(thresholds):
+    labels = []
+    for i in range(len(thresholds) + 1):
+        if i == 0:
+            labels.append(f"< {thresholds[0]}")
+        elif i == len(thresholds):
+            labels.append(f">= {thresholds[-1]}")
+        else:
+            labels.append(f"{thresholds[i-1]} - {thresholds[i]}")
+    return labels
+
+
+def _as_float(values):
+    # Nullable integer columns carry pd.NA, which plain np.asarray(dtype=float) rejects
+    return pd.Series(values).to_numpy(dtype=float, na_value=np.nan)
+
+
+def bin_index(values, thresholds):
+    # Interval i holds thresholds[i-1] <= v < thresholds[i]; 0 is below the first threshold
+    return np.searchsorted(np.asarray(thresholds, dtype=float), _as_float(values), side='right')
+
+
+def interval_counts(values, thresholds, weights=None):
+    """Number (or total weight) of the non-missing values in each threshold interval, in one pass."""
+    values = _as_float(values)
+    valid = ~np.isnan(values)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[valid]
+    return np.bincount(bin_index(values[valid], thresholds), weights=weights, minlength=len(thresholds) + 1)
+
+
+def category_interval_counts(values, categories, thresholds, rows, custom_groups=None, weights=None):
+    """Contingency matrix of `rows` x threshold intervals.
+
+    `rows` are category values or names from `custom_groups` ({name: [categories]}); a custom
+    group's row is the sum of its members' rows. All counts come from a single bincount over
+    (category, interval) pairs; with `weights` they are weighted counts (floats).
+    """
+    custom_groups = custom_groups or {}
+    values = _as_float(values)
+    codes, uniques = pd.factorize(pd.Series(categories))
+    valid = (codes >= 0) & ~np.isnan(values)
+    n_bins = len(thresholds) + 1
+    flat = codes[valid] * n_bins + bin_index(values[valid], thresholds)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[valid]
+    per_category = np.bincount(flat, weights=weights, minlength=len(uniques) * n_bins).reshape(len(uniques), n_bins)
+
+    position = {value: i for i, value in enumerate(uniques)}
+    table = np.zeros((len(rows), n_bins), dtype=per_category.dtype)
+    for i, row in enumerate(rows):
+        members = custom_groups[row] if row in custom_groups else [row]
+        member_rows = [position[m] for m in members if m in position]
+        if member_rows:
+            table[i] = per_category[member_rows].sum(axis=0)
+    return table
+
+
+# --- Histogram ---
+# Integer-valued metrics spanning at most this many values get one bar per value
+MAX_INTEGER_BINS = 50
+
+
+def histogram_bins(values, nbins=20, weights=None):
+    """Histogram of the non-missing `values` as a small frame with columns ['left', 'right', 'count'].
+
+    Integer-valued data (Likert answers, summed scores) gets exact unit-width bins centred on
+    each value; anything else is binned by np.histogram. Either way the chart receives one row
+    per bin instead of one value per respondent. With `weights`, 'count' is the weight per bin.
+    """
+    values = _as_float(values)
+    valid = ~np.isnan(values)
+    values = values[valid]
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[valid]
+    dtype = np.int64 if weights is None else float
+    if len(values) == 0:
+        return pd.DataFrame({'left': [], 'right': [], 'count': np.array([], dtype=dtype)})
+    lo, hi = values.min(), values.max()
+    if np.all(values == np.round(values)) and hi - lo < MAX_INTEGER_BINS:
+        counts = np.bincount((values - lo).astype(np.int64), weights=weights)
+        left = lo - 0.5 + np.arange(len(counts))
+        right = left + 1
+    else:
+        counts, edges = np.histogram(values, bins=nbins, weights=weights)
+        left, right = edges[:-1], edges[1:]
+    return pd.DataFrame({'left': left, 'right': right, 'count': counts.astype(dtype)})
+
+
+# --- Significance scan ---
+# Metrics with more distinct answers than this are split into quantile bins for the scan
+SCAN_MAX_LEVELS = 10
+SCAN_QUANTILE_BINS = 5
+# Cap on permuted label arrays held at once, in elements
+_PERMUTATION_BATCH_ELEMENTS = 5_000_000
+
+
+def _scan_codes(values, max_levels=SCAN_MAX_LEVELS):
+    # Dense 0..k-1 codes for the distinct answers of a metric, -1 for missing
+    values = _as_float(values)
+    valid = ~np.isnan(values)
+    levels = np.unique(values[valid])
+    if len(levels) > max_levels:
+        levels = np.unique(np.quantile(values[valid], np.linspace(0, 1, SCAN_QUANTILE_BINS + 1)[1:-1]))
+        codes = np.searchsorted(levels, values, side='right')
+    else:
+        codes = np.searchsorted(levels, values)
+    return np.where(valid, codes, -1)
+
+
+def _dense_pairs(row_codes, col_codes):
+    # Keep respondents with both answers and renumber so no empty row or column remains
+    valid = (row_codes >= 0) & (col_codes >= 0)
+    _, rows = np.unique(row_codes[valid], return_inverse=True)
+    _, cols = np.unique(col_codes[valid], return_inverse=True)
+    return rows, cols, valid
+
+
+def _chi2_statistic(tables, expected):
+    return ((tables - expected) ** 2 / expected).sum(axis=(-2, -1))
+
+
+def permutation_pvalue(rows, cols, observed, n_permutations, seed=0):
+    """Share of label permutations whose chi-square reaches `observed`, (hits + 1) / (n + 1).
+
+    Permutations keep both margins, so the expected counts are fixed; each batch of shuffles is
+    counted with a single bincount over (permutation, row, column) cells.
+    """
+    n_rows, n_cols, n = rows.max() + 1, cols.max() + 1, len(rows)
+    expected = np.outer(np.bincount(rows), np.bincount(cols)) / n
+    rng = np.random.default_rng(seed)
+    hits = done = 0
+    while done < n_permutations:
+        batch = min(n_permutations - done, max(1, _PERMUTATION_BATCH_ELEMENTS // n))
+        shuffled = rng.permuted(np.tile(rows, (batch, 1)), axis=1)
+        flat = (shuffled * n_cols + cols) + (np.arange(batch) * (n_rows * n_cols))[:, None]
+        tables = np.bincount(flat.ravel(), minlength=batch * n_rows * n_cols).reshape(batch, n_rows, n_cols)
+        hits += int((_chi2_statistic(tables, expected) >= observed * (1 - 1e-12)).sum())
+        done += batch
+    return (hits + 1) / (n_permutations + 1)
+
+
+def _permutation_task(args):
+    return permutation_pvalue(*args)
+
+
+def holm_adjust(pvalues):
+    """Holm step-down adjusted p-values (family-wise error); NaN stays NaN."""
+    pvalues = np.asarray(pvalues, dtype=float)
+    adjusted = np.full(len(pvalues), np.nan)
+    finite = np.flatnonzero(~np.isnan(pvalues))
+    order = finite[np.argsort(pvalues[finite], kind='stable')]
+    m = len(order)
+    adjusted[order] = np.minimum(np.maximum.accumulate((m - np.arange(m)) * pvalues[order]), 1)
+    return adjusted
+
+
+def fdr_adjust(pvalues):
+    """Benjamini-Hochberg adjusted p-values (false discovery rate); NaN stays NaN."""
+    pvalues = np.asarray(pvalues, dtype=float)
+    adjusted = np.full(len(pvalues), np.nan)
+    finite = np.flatnonzero(~np.isnan(pvalues))
+    order = finite[np.argsort(pvalues[finite], kind='stable')]
+    m = len(order)
+    ranked = pvalues[order] * m / np.arange(1, m + 1)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return adjusted
+
+
+def significance_scan(df, metrics, groups=GROUPING_KEYS, n_permutations=0, workers=None, seed=0, weights=None):
+    """Chi-square test of independence for every metric x grouping variable pair.
+
+    Each column is coded once and every contingency table is a single bincount. Returns one row
+    per testable pair with chi-square, dof, p, Cramér's V, the smallest expected count, Holm and
+    Benjamini-Hochberg adjusted p-values and, when `n_permutations` > 0, a permutation p-value
+    (computed on a process pool when `workers` > 1). Rows are ranked by p-value, then effect size.
+    With `weights`, tables hold weighted counts rescaled to the Kish effective sample size of the
+    pair's respondents (see chi2_test); permutation p-values are then not available.
+    """
+    from scipy.stats import chi2 as chi2_dist
+
+    if weights is not None and n_permutations > 0:
+        raise ValueError("permutation p-values are not available for weighted scans")
+    groups = [g for g in groups if g in df.columns]
+    metrics = [m for m in metrics if m in df.columns and pd.api.types.is_numeric_dtype(df[m])]
+    group_codes = {g: pd.factorize(df[g])[0] for g in groups}
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        # Respondents the weighting leaves out take part in no table
+        group_codes = {g: np.where(weights > 0, codes, -1) for g, codes in group_codes.items()}
+    rows, tasks = [], []
+    for metric in metrics:
+        metric_codes = _scan_codes(df[metric])
+        for group in groups:
+            r, c, valid = _dense_pairs(group_codes[group], metric_codes)
+            if len(r) == 0 or r.max() < 1 or c.max() < 1:
+                continue  # A single group or a single answer: nothing to test
+            n_rows, n_cols = r.max() + 1, c.max() + 1
+            pair_weights = None if weights is None else weights[valid]
+            table = np.bincount(r * n_cols + c, weights=pair_weights, minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+            n = len(r)
+            if pair_weights is not None:
+                n = weighting.effective_n(pair_weights)
+                table = table * (n / table.sum())
+            expected = np.outer(table.sum(axis=1), table.sum(axis=0)) / n
+            chi2 = float(_chi2_statistic(table, expected))
+            dof = (n_rows - 1) * (n_cols - 1)
+            rows.append({
+                'metric': metric, 'group': group, 'n': len(r), 'dof': dof, 'chi2': chi2,
+                'p': float(chi2_dist.sf(chi2, dof)),
+                'cramers_v': float(np.sqrt(chi2 / (n * (min(n_rows, n_cols) - 1)))),
+                'min_expected': float(expected.min()),
+            })
+            tasks.append((r, c, chi2, n_permutations, seed + len(tasks)))
+
+    columns = ['metric', 'group', 'n', 'dof', 'chi2', 'p', 'cramers_v', 'min_expected']
+    result = pd.DataFrame(rows, columns=columns)
+    result['p_holm'] = holm_adjust(result['p'])
+    result['p_fdr'] = fdr_adjust(result['p'])
+    if n_permutations > 0 and tasks:
+        if workers and workers > 1 and len(tasks) > 1:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # spawn: forking the threaded Streamlit server is not safe
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                result['p_permutation'] = list(pool.map(_permutation_task, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+        else:
+            result['p_permutation'] = [_permutation_task(task) for task in tasks]
+    return result.sort_values(['p', 'cramers_v'], ascending=[True, False], kind='stable').reset_index(drop=True)
+
+
+# --- Bootstrap confidence intervals ---
+BOOTSTRAP_RESAMPLES = 1000
+# Filtered sets at least this large resample their groups on a process pool
+BOOTSTRAP_POOL_MIN_ROWS = 200_000
+# Groups with at most this many distinct values are resampled through their value counts
+_MULTINOMIAL_MAX_LEVELS = 64
+# Cap on resampled index matrices held at once, in elements
+_BOOTSTRAP_BATCH_ELEMENTS = 5_000_000
+
+
+def _bootstrap_means(values, n_resamples, rng, weights=None):
+    """Means of `n_resamples` bootstrap resamples of the 1-D float array `values`, weighted
+    means when `weights` are given."""
+    n = len(values)
+    if weights is None:
+        levels, counts = np.unique(values, return_counts=True)
+    else:
+        # Raking gives whole cells the same weight, so (answer, weight) pairs stay few
+        pairs, counts = np.unique(np.column_stack([values, weights]), axis=0, return_counts=True)
+        levels, level_weights = pairs[:, 0], pairs[:, 1]
+    if len(levels) <= _MULTINOMIAL_MAX_LEVELS:
+        # A resample's mean only depends on how often each answer was drawn, so drawing the
+        # counts directly is equivalent and costs O(levels) instead of O(respondents)
+        draws = rng.multinomial(n, counts / n, size=n_resamples)
+        if weights is None:
+            return draws @ levels / n
+        return draws @ (levels * level_weights) / (draws @ level_weights)
+    means = np.empty(n_resamples)
+    batch = max(1, _BOOTSTRAP_BATCH_ELEMENTS // n)
+    for start in range(0, n_resamples, batch):
+        stop = min(n_resamples, start + batch)
+        index = rng.integers(0, n, size=(stop - start, n))
+        if weights is None:
+            means[start:stop] = values[index].mean(axis=1)
+        else:
+            means[start:stop] = (values[index] * weights[index]).sum(axis=1) / weights[index].sum(axis=1)
+    return means
+
+
+def _bootstrap_task(args):
+    values, n_resamples, seed, weights = args
+    return _bootstrap_means(values, n_resamples, np.random.default_rng(seed), weights)
+
+
+def bootstrap_group_ci(values, groups, n_resamples=BOOTSTRAP_RESAMPLES, confidence=0.95, seed=0, workers=None,
+                       weights=None):
+    """Percentile bootstrap confidence interval of the mean of `values` within each group.
+
+    Returns a frame with columns ['group', 'mean', 'ci_low', 'ci_high', 'count'], one row per
+    group that has values. Groups are resampled independently, on a process pool when
+    `workers` > 1. With `weights`, means are weighted and respondents with weight 0 are left out.
+    """
+    values = _as_float(values)
+    codes, uniques = pd.factorize(pd.Series(groups))
+    valid = (codes >= 0) & ~np.isnan(values)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        valid &= weights > 0
+    codes, values = codes[valid], values[valid]
+    order = np.argsort(codes, kind='stable')
+    sizes = np.bincount(codes, minlength=len(uniques))
+    splits = np.cumsum(sizes)[:-1]
+    per_group = np.split(values[order], splits)
+    per_group_weights = np.split(weights[valid][order], splits) if weights is not None else [None] * len(uniques)
+    present = np.flatnonzero(sizes)
+    seeds = np.random.SeedSequence(seed).spawn(len(uniques))
+    tasks = [(per_group[i], n_resamples, seeds[i], per_group_weights[i]) for i in present]
+
+    if workers and workers > 1 and len(tasks) > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # spawn: forking the threaded Streamlit server is not safe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            boot = list(pool.map(_bootstrap_task, tasks))
+    else:
+        boot = [_bootstrap_task(task) for task in tasks]
+
+    alpha = (1 - confidence) / 2
+    bounds = np.array([np.quantile(means, [alpha, 1 - alpha]) for means in boot]).reshape(-1, 2)
+    return pd.DataFrame({
+        'group': pd.Index(uniques).astype(object)[present],
+        'mean': [np.average(per_group[i], weights=per_group_weights[i]) for i in present],
+        'ci_low': bounds[:, 0],
+        'ci_high': bounds[:, 1],
+        'count': sizes[present],
+    })
+
+
+def chi2_test(table, effective_n=None):
+    """(chi2, p, dof) of the contingency `table`, or None when a row or column is empty.
+
+    For a table of weighted counts pass the Kish `effective_n` of its respondents: the table is
+    rescaled to that total first, which divides chi-square by the design effect of the weights.
+    """
+    table = np.asarray(table, dtype=float)
+    if effective_n is not None and table.sum() > 0:
+        table = table * (effective_n / table.sum())
+    if table.sum() > 0 and np.all(table.sum(axis=1) > 0) and np.all(table.sum(axis=0) > 0):
+        from scipy.stats import chi2_contingency
+        chi2, p, dof, _ = chi2_contingency(table)
+        return float(chi2), float(p), int(dof)
+    return None
+
+
+# --- Multi-choice co-occurrence ---
+def _combination_table(masks, n_options, groups=None, weights=None):
+    """(group labels, groups x 2**n_options matrix of respondents, or their weight, per exact
+    option combination)."""
+    masks = pd.Series(masks).to_numpy(dtype=np.int64)
+    size = 1 << n_options
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+    if groups is None:
+        return pd.Index(['全部'], dtype=object), np.bincount(masks, weights=weights, minlength=size).reshape(1, size)
+    codes, uniques = pd.factorize(pd.Series(groups), sort=True)
+    valid = codes >= 0
+    # One bincount over (group, combination) cells instead of a boolean filter per combination
+    table = np.bincount(codes[valid] * size + masks[valid], weights=None if weights is None else weights[valid],
+                        minlength=len(uniques) * size)
+    return pd.Index(uniques).astype(object), table.reshape(len(uniques), size)
+
+
+def _option_bits(n_options):
+    # bits[m, i] is 1 when combination m includes option i
+    return (np.arange(1 << n_options)[:, None] >> np.arange(n_options)) & 1
+
+
+def combination_counts(masks, options, groups=None, weights=None):
+    """Respondents per exact combination of ticked options (the intersections of an UpSet plot).
+
+    `masks` are the bitmask columns of survey_data.MULTI_CHOICE_MASKS and `options` the option
+    labels in bit order. Returns a long frame with columns ['group', 'combination', 'options',
+    'n_options', 'count', 'share'], without empty combinations; 'share' is within the group.
+    With `weights`, 'count' is the weight of the respondents.
+    """
+    labels, table = _combination_table(masks, len(options), groups, weights)
+    bits = _option_bits(len(options))
+    names = [' + '.join(o for o, b in zip(options, row) if b) or '(未选择)' for row in bits]
+    totals = table.sum(axis=1, keepdims=True)
+    g, m = np.nonzero(table)
+    return pd.DataFrame({
+        'group': labels[g],
+        'combination': m,
+        'options': np.array(names, dtype=object)[m],
+        'n_options': bits.sum(axis=1)[m],
+        'count': table[g, m],
+        'share': table[g, m] / totals[g, 0],
+    }).sort_values(['group', 'count'], ascending=[True, False], kind='stable').reset_index(drop=True)
+
+
+def pairwise_lift(masks, options, groups=None, weights=None):
+    """Co-occurrence of every pair of options within each group.
+
+    Returns a long frame with columns ['group', 'option_a', 'option_b', 'n', 'count_a',
+    'count_b', 'both', 'lift'], where lift = P(a and b) / (P(a) P(b)): above 1 the two options
+    are ticked together more often than independent choices would be. Lift is NaN when an
+    option was never ticked. With `weights`, all counts are weighted.
+    """
+    labels, table = _combination_table(masks, len(options), groups, weights)
+    bits = _option_bits(len(options))
+    # Marginal and pair counts of all groups follow from the combination counts alone
+    singles = table @ bits
+    pairs = np.einsum('gm,mi,mj->gij', table, bits, bits)
+    n = table.sum(axis=1)
+    a, b = np.triu_indices(len(options), k=1)
+    both = pairs[:, a, b]
+    expected = singles[:, a] * singles[:, b]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lift = np.where(expected > 0, both * n[:, None] / expected, np.nan)
+    option_names = np.array(options, dtype=object)
+    return pd.DataFrame({
+        'group': np.repeat(labels, len(a)),
+        'option_a': np.tile(option_names[a], len(labels)),
+        'option_b': np.tile(option_names[b], len(labels)),
+        'n': np.repeat(n, len(a)),
+        'count_a': singles[:, a].ravel(),
+        'count_b': singles[:, b].ravel(),
+        'both': both.ravel(),
+        'lift': lift.ravel(),
+    })
+
+
+# --- Rank correlations ---
+CORRELATION_METHODS = {'spearman': "Spearman ρ", 'kendall': "Kendall τ-b"}
+# Kendall pairs whose answer cross table would exceed this many cells use scipy's O(n log n) routine
+_KENDALL_MAX_CELLS = 250_000
+
+
+def _rank_columns(df, columns):
+    """Average ranks, dense codes and validity of every column, ranked once over its own answers."""
+    values = np.column_stack([_as_float(df[c]) for c in columns]) if columns else np.empty((len(df), 0))
+    valid = ~np.isnan(values)
+    ranks = np.zeros(values.shape)
+    codes = np.full(values.shape, -1, dtype=np.int64)
+    for j in range(values.shape[1]):
+        levels, inverse, counts = np.unique(values[valid[:, j], j], return_inverse=True, return_counts=True)
+        # Tied answers share the mean of the ranks they occupy
+        ranks[valid[:, j], j] = (np.cumsum(counts) - (counts - 1) / 2)[inverse]
+        codes[valid[:, j], j] = inverse
+    return ranks, codes, valid
+
+
+def _pairwise_pearson(values, valid):
+    # Pearson r of every column pair over the rows where both are present, from five matrix products
+    x = np.where(valid, values, 0.0)
+    m = valid.astype(float)
+    n = m.T @ m
+    sums = x.T @ m  # sums[i, j]: column i summed over the rows where j is present too
+    squares = (x * x).T @ m
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = x.T @ x - sums * sums.T / n
+        var = squares - sums ** 2 / n
+        r = cov / np.sqrt(var * var.T)
+    r[(n < 2) | ~(var > 1e-12) | ~(var.T > 1e-12)] = np.nan
+    return np.clip(r, -1, 1), n
+
+
+def _kendall_tau_b(a, b):
+    # tau-b from the cross table of two dense code arrays: concordant pairs lie below-right of a
+    # cell, discordant ones below-left, both read off 2-D cumulative sums
+    n_a, n_b = a.max() + 1, b.max() + 1
+    if n_a * n_b > _KENDALL_MAX_CELLS:
+        from scipy.stats import kendalltau
+        return float(kendalltau(a, b).statistic)
+    table = np.bincount(a * n_b + b, minlength=n_a * n_b).reshape(n_a, n_b).astype(float)
+    cum = table.cumsum(axis=0).cumsum(axis=1)
+    above_left = np.zeros_like(table)
+    above_left[1:, 1:] = cum[:-1, :-1]
+    above = np.zeros_like(table)
+    above[1:, :] = cum[:-1, -1:] - cum[:-1, :]
+    concordant = (table * above_left).sum()
+    discordant = (table * above).sum()
+    n = len(a)
+    pairs = n * (n - 1) / 2
+    ties_a = (table.sum(axis=1) * (table.sum(axis=1) - 1) / 2).sum()
+    ties_b = (table.sum(axis=0) * (table.sum(axis=0) - 1) / 2).sum()
+    denominator = np.sqrt((pairs - ties_a) * (pairs - ties_b))
+    return float((concordant - discordant) / denominator) if denominator > 0 else np.nan
+
+
+def rank_correlation(df, columns, method='spearman'):
+    """Correlation matrix of `columns` (a method of CORRELATION_METHODS), pairwise-complete.
+
+    Returns (correlations, pair sizes) as square frames. Every column is ranked once over its own
+    non-missing answers; Spearman is then the Pearson correlation of those ranks over the rows
+    where both columns are present, all pairs in one matrix pass. Constant columns give NaN.
+    """
+    if method not in CORRELATION_METHODS:
+        raise ValueError(f"unknown correlation method '{method}'")
+    columns = [c for c in columns if c in df.columns and pd.api.types.is_numeric_dtype(df[c])]
+    ranks, codes, valid = _rank_columns(df, columns)
+    corr, n = _pairwise_pearson(ranks, valid)
+    if method == 'kendall':
+        both = valid.T.astype(np.int64) @ valid.astype(np.int64)
+        corr = np.full((len(columns), len(columns)), np.nan)
+        for i in range(len(columns)):
+            for j in range(i, len(columns)):
+                rows = valid[:, i] & valid[:, j]
+                if both[i, j] >= 2:
+                    corr[i, j] = corr[j, i] = _kendall_tau_b(codes[rows, i], codes[rows, j])
+    return (pd.DataFrame(corr, index=columns, columns=columns),
+            pd.DataFrame(n.astype(np.int64), index=columns, columns=columns))
+
+
+def cluster_order(corr):
+    """Column order that puts strongly correlated columns next to each other.
+
+    Average-linkage clustering on 1 - |r|; pairs without a correlation count as unrelated.
+    """
+    if len(corr) < 3:
+        return list(corr.columns)
+    from scipy.cluster.hierarchy import leaves_list, linkage
+    from scipy.spatial.distance import squareform
+
+    distance = 1 - np.abs(np.nan_to_num(corr.to_numpy(), nan=0.0))
+    np.fill_diagonal(distance, 0)
+    distance = np.clip((distance + distance.T) / 2, 0, None)
+    order = leaves_list(linkage(squareform(distance, checks=False), method='average'))
+    return [corr.columns[i] for i in order]
@@ -0,0 +1,611 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import pandas as pd
+import numpy as np
+
+import geo
+import quality
+
+DATA_PATH = 'data.csv'
+SNAPSHOT_DIR_NAME = '.snapshots'
+# Bump whenever process_survey changes its output so stale snapshots are ignored
+SNAPSHOT_VERSION = 7
+_SNAPSHOT_META_KEY = b'survey_meta'
+# Raw exports are read in chunks of this many rows
+CHUNK_SIZE = 50_000
+
+FILTER_QUESTION = '16.你是否愿意为了传承文化去特意学习上海话？'
+RENAME_MAP = {
+    '1.你的性别是？': 'gender',
+    '2.你的年级是？': 'grade',
+    '4.你的专业类型是？': 'major',
+    '5.你目前就读的学校是？':'school',
+    '6.你是否为上海本地人？': 'native',
+    '7.你的父母是否为上海本地人？':'parents',
+    '8.你对上海话的整体印象是？': 'overall_impression',
+    '9.你认为上海话属于一种：': 'shanghainese_attitude',
+    '10.你认为学习/会说上海话是否是一种“本地身份”的象征？': 'identity',
+    '14.你对在公共场合听到上海话的看法是？': 'public_hear_view',
+    '15.你对私人场合使用上海话交流的看法是？': 'private_use_view',
+    '11.你对大学中开设上海话课程的态度是？': 'course_attitude',
+    '12.你是否认同“年轻一代应该会说一些上海话”？':'young_should',
+    '13.你觉得上海话在现代社会中的地位是？':'social_status_of_shanghainese',
+    '17.你是否觉得学校或社会应该提供更多学习上海话的机会？': 'more_learning_opportunity',
+    '18.你是否会说上海话？': 'speaking_ability',
+    '19.你能听懂上海话的程度是？': 'listening_ability',
+    '20.你与家人交流时最常用的语言是？':'family_language',
+    '21.你通常在以下哪些场合使用上海话？:与家人交流':'family_use',
+    '21.你通常在以下哪些场合使用上海话？:与朋友交流':'friend_use',
+    '21.你通常在以下哪些场合使用上海话？:在本地社区或邻里间':'local_community_use',
+    '21.你通常在以下哪些场合使用上海话？:在工作/兼职中':'work_use',
+    '21.你通常在以下哪些场合使用上海话？:基本不用':'basic_no_use',
+    '22.你使用上海话的频率是？': 'usage_freq',
+    '23.你会使用上海话发微信/社交平台信息吗？': 'sns_use_freq',
+    '24.你看过或听过以下哪类与上海话有关的内容？:上海话配音短视频':'shanghainese_dubbling_tiktok',
+    '24.你看过或听过以下哪类与上海话有关的内容？:上海话电视剧/电影':'shanghainese_movies',
+    '24.你看过或听过以下哪类与上海话有关的内容？:上海话广播/音频节目':'shanghainese_radio',
+    '24.你看过或听过以下哪类与上海话有关的内容？:上海话学习类内容':'shanghainese_learning_resources',
+    '24.你看过或听过以下哪类与上海话有关的内容？:几乎没有接触过':'never_shanghainese_content',
+    '25.你是否关注过沪语博主（如G僧东、册那队长等）？': 'follow_sh_blogger',
+    '26.你对此类沪语视频的看法是？': 'video_view',
+    '27.你是否曾因不会说上海话而感到尴尬/被排斥？': 'awkward_score',
+    '28.你认为目前的语言环境是否支持上海话的使用？': 'env_support',
+    '3.你来自于：_填空1': 'Province',
+    '3.你来自于：_填空2': 'City',
+    '3.你来自于：_填空3': 'District',
+}
+
+# The only raw columns the pipeline uses; everything else in an export is never parsed
+INGEST_COLUMNS = {'编号', FILTER_QUESTION, *RENAME_MAP, *quality.QUALITY_COLUMNS}
+
+# Fixed answer codes. Each entry encodes `source` (default: the column itself) into the keyed
+# column; answers not listed become NaN, or `default` when one is given. `display` turns the
+# codes back into analysis labels. The 编码说明 expander is rendered from this table too.
+ANSWER_CODEBOOK = {
+    'gender_code': {'source': 'gender', 'label': '性别', 'codes': {'A.男': 1, 'B.女': 0, 'C.其他': 2},
+                    'display': {1: '男', 0: '女', 2: '其他'}},
+    'native_flag': {'source': 'native', 'label': '上海本地人标记', 'codes': {'A.是，在上海出生并长大': 1}, 'default': 0},
+    'long_term_sh': {'source': 'native', 'label': '长期居住上海标记', 'codes': {'B.否，但在上海生活超过5年': 1}, 'default': 0},
+    'shanghainese_attitude': {'label': '上海话属于一种',
+                              'codes': {'A.地方语言，应予保护': 4, 'B.沟通工具，实用即可': 3, 'D.无所谓': 2, 'C.方言，逐渐消失是自然现象': 1}},
+    'identity': {'label': '学习/会说上海话是‘本地身份’象征', 'codes': {'A.是的': 4, 'B.部分是': 3, 'D.不清楚': 2, 'C.否': 1}},
+    'course_attitude': {'label': '大学开设上海话课程态度', 'codes': {'A.非常支持': 4, 'B.支持': 3, 'C.无所谓': 2, 'D.反对': 1}},
+    'young_should': {'label': '年轻一代应该会说一些上海话', 'codes': {'A.非常认同': 4, 'B.认同': 3, 'C.不太认同': 2, 'D.完全不认同': 1}},
+    'social_status_of_shanghainese': {'label': '上海话在现代社会中的地位',
+                                      'codes': {'A.重要，应重视': 4, 'B.一般，可保留可取代': 3, 'D.难说': 2, 'C.不重要': 1}},
+    'more_learning_opportunity': {'label': '应提供更多学习上海话的机会', 'codes': {'A.是': 1, 'B.否': -1, 'C.无所谓': 0}},
+    'follow_sh_blogger': {'label': '是否关注过沪语博主', 'codes': {'A.是': 1, 'B.否': 0}},
+}
+
+# Multi-choice questions packed into one bitmask column each: bit i is set when the i-th
+# option was ticked. The 0/1 option columns are kept for the per-option means.
+MULTI_CHOICE_MASKS = {
+    'usage_settings_mask': {'label': '使用上海话的场合 (第21题)', 'options': {
+        'family_use': '与家人交流', 'friend_use': '与朋友交流', 'local_community_use': '本地社区/邻里',
+        'work_use': '工作/兼职', 'basic_no_use': '基本不用'}},
+    'content_types_mask': {'label': '接触过的上海话内容 (第24题)', 'options': {
+        'shanghainese_dubbling_tiktok': '配音短视频', 'shanghainese_movies': '电视剧/电影',
+        'shanghainese_radio': '广播/音频节目', 'shanghainese_learning_resources': '学习类内容',
+        'never_shanghainese_content': '几乎没有接触过'}},
+}
+
+NATIVE_LABELS = {'A.是，在上海出生并长大': '上海本地人(出生并长大)',
+                 'B.否，但在上海生活超过5年': '长期居住上海(>5年)',
+                 'C.否，在上海生活不足5年': '短期居住上海(<5年)'}
+
+
+# --- Data Loading and Preprocessing (Adapted from share.py) ---
+def encode_answers(values, codes, default=np.nan):
+    # Positions index straight into the code table; -1 (unknown or missing) picks `default`
+    positions = pd.Index(list(codes)).get_indexer(values)
+    lookup = np.append(np.array(list(codes.values()), dtype=float), default)
+    return pd.Series(lookup[positions], index=values.index)
+
+
+def encode_with_codebook(values, mapping):
+    # The codebook only ever grows: known answers keep their code and unseen ones get the next
+    # free code in order of first appearance (the same scheme OrdinalEncoder used), so codes
+    # stay stable when new responses are ingested. NaN stays NaN.
+    next_code = max(mapping.values(), default=0) + 1
+    for value in pd.unique(values.dropna()):
+        if value not in mapping:
+            mapping[value] = next_code
+            next_code += 1
+    return encode_answers(values, mapping)
+
+
+def pack_flags(df, options):
+    # uint8 holds up to 8 options; options missing from the export never set their bit
+    mask = np.zeros(len(df), dtype=np.uint8)
+    for bit, col in enumerate(options):
+        if col in df.columns:
+            mask |= (df[col].to_numpy(dtype=np.uint8) << bit).astype(np.uint8)
+    return pd.Series(mask, index=df.index)
+
+
+def process_survey(df, codebook=None):
+    # `codebook` ({column: {answer: code}}) is extended in place with any answers it has not seen
+    if codebook is None:
+        codebook = {}
+
+    # Initial filter as in share.py
+    # Consider making this an optional filter in the UI if broader analysis is needed
+    df = df[df[FILTER_QUESTION] == 'D.无所谓（请直接选择此项）'].copy() # Use .copy() to avoid SettingWithCopyWarning
+
+    drop_cols = [
+        '开始答题时间', '结束答题时间',
+        '语言', '清洗数据结果',
+        '地理位置国家和地区', '地理位置省', '地理位置市',
+        '用户类型', '昵称', '自定义字段', 'UA',
+        'Referrer', '中奖时间', '中奖金额', '审核状态', 'Unnamed: 58',
+        '16.你是否愿意为了传承文化去特意学习上海话？'
+    ]
+    df.drop(columns=[c for c in drop_cols if c in df.columns], inplace=True)
+
+    multi_cols_21 = [c for c in df.columns if c.startswith('21.你通常在以下哪些场合使用上海话')]
+    multi_cols_24 = [c for c in df.columns if c.startswith('24.你看过或听过以下哪类与上海话有关的内容')]
+    for col in multi_cols_21 + multi_cols_24:
+        df[col] = df[col].notna().astype(int)
+
+    rename_map = dict(RENAME_MAP)
+    df.rename(columns={k:v for k,v in rename_map.items() if k in df.columns}, inplace=True)
+
+    # Inputs of the quality screening; identifiers are only kept as keyed hashes, which
+    # read_survey moves out of the frame
+    df.rename(columns={'编号': 'response_id', **quality.QUALITY_COLUMNS}, inplace=True)
+    for col in ['response_id', 'duration_s']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    if 'invalid_prob' in df.columns:
+        df['invalid_prob'], df['invalid_prob_plain'] = quality.parse_probability(df['invalid_prob'])
+    for col in quality.IDENTITY_COLUMNS:
+        if col in df.columns:
+            df[col] = quality.identity_hash(df[col])
+    df['quality_flags'] = quality.row_flags(df) # before awkward_score is negated below
+
+    province_to_region = dict(geo.PROVINCE_TO_REGION)
+    if 'Province' in df.columns:
+        origin = geo.normalize_origin(df['Province'], df.get('City'), df.get('District'))
+        for col in origin.columns:
+            df[col] = origin[col]
+
+    # Specific Encodings for analysis & creating string columns for filters
+    for col, entry in ANSWER_CODEBOOK.items():
+        source = entry.get('source', col)
+        if source in df.columns:
+            df[col] = encode_answers(df[source], entry['codes'], entry.get('default', np.nan))
+
+    gender_mapping_display = dict(ANSWER_CODEBOOK['gender_code']['display']) # For display
+    if 'gender_code' in df.columns:
+        df['gender_str'] = df['gender_code'].map(gender_mapping_display)
+
+    native_mapping_display = dict(NATIVE_LABELS)
+    if 'native' in df.columns:
+        df['native_str'] = df['native'].map(native_mapping_display).fillna(df['native'])
+
+    if 'awkward_score' in df.columns:
+        df['awkward_score'] = pd.to_numeric(df['awkward_score'], errors='coerce').fillna(0) # Ensure numeric before negation
+        df['awkward_score'] = -df['awkward_score']
+
+    cat_cols = df.select_dtypes(include=['object']).columns.tolist()
+    # Columns to keep as strings for direct use (not to be ordinally encoded here if present)
+    keep_as_string = ['Region', 'gender_str', 'native_str', 'Province', 'City', 'District', 'city_tier', 'school', 'parents', 'family_language', 'gender', 'native']
+    cat_cols_for_encoding = [col for col in cat_cols if col not in keep_as_string]
+    # major/grade are always encoded (even if already numeric by mistake), as is anything the codebook already knows
+    for col in ['major', 'grade'] + list(codebook):
+        if col in df.columns and col not in cat_cols_for_encoding:
+            cat_cols_for_encoding.append(col)
+
+    for col in cat_cols_for_encoding:
+        df[col] = encode_with_codebook(df[col], codebook.setdefault(col, {}))
+
+    major_mapping = dict(codebook.get('major', {}))
+    grade_mapping = dict(codebook.get('grade', {}))
+
+    # Define attitude_cols (inferred and explicit)
+    attitude_cols = [
+        'overall_impression', 'shanghainese_attitude', 'identity',
+        'public_hear_view', 'private_use_view', 'course_attitude',
+        'young_should', 'social_status_of_shanghainese',
+        'more_learning_opportunity', 'video_view', 'awkward_score', 'env_support'
+    ]
+    # Filter out cols not in df from attitude_cols
+    attitude_cols = [col for col in attitude_cols if col in df.columns]
+
+    question_cols_list = attitude_cols + [
+        'speaking_ability', 'listening_ability', 'usage_freq', 'sns_use_freq',
+        'family_use', 'friend_use', 'local_community_use', 'work_use', 'basic_no_use',
+        'shanghainese_dubbling_tiktok', 'shanghainese_movies', 'shanghainese_radio',
+        'shanghainese_learning_resources', 'never_shanghainese_content',
+        'follow_sh_blogger'
+    ]
+
+    final_question_cols = []
+    for col in question_cols_list:
+        if col in df.columns:
+            if not pd.api.types.is_numeric_dtype(df[col]):
+                df[col] = pd.to_numeric(df[col], errors='coerce')
+            # Drop rows where essential numeric question columns became NaN after conversion, or fill them
+            # df.dropna(subset=[col], inplace=True) # This might reduce data significantly
+            # For now, we let mean handle NaNs, but this is a point of attention for data quality.
+            final_question_cols.append(col)
+    final_question_cols = sorted(list(set(final_question_cols))) # Unique and sorted
+
+    # Create string versions for major and grade for grouping display using the mappings
+    # Mappings are {original_name: encoded_code}
+    rev_major_mapping = {v: k for k, v in major_mapping.items()} if major_mapping else {}
+    rev_grade_mapping = {v: k for k, v in grade_mapping.items()} if grade_mapping else {}
+
+    if 'major' in df.columns and major_mapping:
+      df['major_str'] = df['major'].map(rev_major_mapping).fillna('未知')
+    if 'grade' in df.columns and grade_mapping:
+      df['grade_str'] = df['grade'].map(rev_grade_mapping).fillna('未知')
+
+    flag_cols = [rename_map.get(c, c) for c in multi_cols_21 + multi_cols_24] + ['native_flag', 'long_term_sh', 'quality_flags']
+    for mask_col, entry in MULTI_CHOICE_MASKS.items():
+        if any(col in df.columns for col in entry['options']):
+            df[mask_col] = pack_flags(df, entry['options'])
+            flag_cols.append(mask_col) # kept as uint8 like the flags it packs
+    df = compact_dtypes(df, flag_cols)
+
+    return df, final_question_cols, rename_map, major_mapping, grade_mapping, gender_mapping_display, native_mapping_display, province_to_region
+
+
+# --- Compact column layout ---
+def _small_int(series):
+    # Nullable Int8/16/32, whichever holds the values; non-integral columns are left alone
+    values = series.dropna()
+    if len(values) and not (values == values.round()).all():
+        return series
+    lo, hi = (values.min(), values.max()) if len(values) else (0, 0)
+    for dtype in ('Int8', 'Int16', 'Int32'):
+        info = np.iinfo(dtype.lower())
+        if info.min <= lo and hi <= info.max:
+            return series.astype(dtype)
+    return series
+
+
+def compact_dtypes(df, flag_cols=()):
+    """uint8 for 0/1 flags, nullable small ints for coded answers and `category` for labels.
+
+    Streamlit keeps a copy of the processed frame per worker, so this is what bounds memory.
+    """
+    for col in df.columns:
+        series = df[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            continue
+        if col in flag_cols:
+            df[col] = series.astype('uint8')
+        elif pd.api.types.is_bool_dtype(series):
+            continue
+        elif pd.api.types.is_numeric_dtype(series):
+            df[col] = _small_int(series)
+        else:
+            df[col] = series.astype('category')
+    return df
+
+
+# --- Columnar snapshot of the processed dataset ---
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(length)
+
+
+def _range_digest(path, start, length):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(1 << 20, length))
+            if not block:
+                break
+            h.update(block)
+            length -= len(block)
+    return h.hexdigest()
+
+
+def data_rows_region(path):
+    """Byte layout of an export: header length, and the length and digest of the data rows after it."""
+    with open(path, 'rb') as f:
+        header = f.readline()
+    length = os.path.getsize(path) - len(header)
+    return {'header': hashlib.sha256(header).hexdigest(), 'start': len(header), 'length': length,
+            'digest': _range_digest(path, len(header), length)}
+
+
+def _snapshot_dir(path):
+    return os.path.join(os.path.dirname(path) or '.', SNAPSHOT_DIR_NAME)
+
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def snapshot_path(path, digest):
+    return os.path.join(_snapshot_dir(path), f"{_stem(path)}-v{SNAPSHOT_VERSION}-{digest[:16]}.parquet")
+
+
+def codebook_path(path):
+    return os.path.join(_snapshot_dir(path), f"{_stem(path)}-codebook.json")
+
+
+def _json_default(o):
+    # numpy scalars coming out of pandas
+    return o.item() if hasattr(o, 'item') else str(o)
+
+
+def _atomic_write(target, write):
+    # Write to a temp file and rename so that replicas starting together never read a partial file
+    target_dir = os.path.dirname(target)
+    os.makedirs(target_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=target_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_codebook(path):
+    try:
+        with open(codebook_path(path), encoding='utf-8') as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {col: {k: v for k, v in pairs} for col, pairs in stored.items()}
+
+
+def save_codebook(path, codebook):
+    # [answer, code] pairs keep non-string answers intact through JSON
+    payload = json.dumps({col: [[k, v] for k, v in m.items()] for col, m in codebook.items()},
+                         ensure_ascii=False, default=_json_default)
+
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+    _atomic_write(codebook_path(path), write)
+
+
+def save_snapshot(target, outputs, watermark=None, rows=None, screening=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df, question_cols, *maps = outputs
+    # Maps are stored as [key, value] pairs so that integer keys survive the JSON round-trip
+    meta = {
+        'question_cols': list(question_cols),
+        'maps': [[[k, v] for k, v in m.items()] for m in maps],
+        'watermark': watermark,
+        # data_rows_region of the export the snapshot was built from, for append_new_rows
+        'rows': rows,
+    }
+    if screening is not None:
+        # The identity hashes are stored beside the frame's columns so that append_new_rows can
+        # screen new rows against them; load_snapshot leaves them out
+        identities = screening['identities']
+        df = pd.concat([df, identities], axis=1)
+        meta['screening'] = {'invalid_prob_scale': screening['invalid_prob_scale'],
+                             'identity_columns': list(identities.columns),
+                             'key': quality.key_fingerprint()}
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        _SNAPSHOT_META_KEY: json.dumps(meta, ensure_ascii=False, default=_json_default).encode('utf-8'),
+    })
+    _atomic_write(target, lambda tmp_path: pq.write_table(table, tmp_path))
+
+    # Drop snapshots of older versions of the same export
+    snapshot_dir = os.path.dirname(target)
+    prefix = os.path.basename(target).rsplit('-v', 1)[0] + '-v'
+    for name in os.listdir(snapshot_dir):
+        if name.startswith(prefix) and name.endswith('.parquet') and name != os.path.basename(target):
+            try:
+                os.remove(os.path.join(snapshot_dir, name))
+            except OSError:
+                pass
+
+
+def snapshot_meta(target):
+    import pyarrow.parquet as pq
+
+    return json.loads(pq.read_schema(target).metadata[_SNAPSHOT_META_KEY].decode('utf-8'))
+
+
+def load_snapshot(target):
+    import pyarrow.parquet as pq
+
+    schema = pq.read_schema(target)
+    meta = json.loads(schema.metadata[_SNAPSHOT_META_KEY].decode('utf-8'))
+    identity_cols = (meta.get('screening') or {}).get('identity_columns', [])
+    columns = [name for name in schema.names if name not in identity_cols]
+    df = pq.read_table(target, columns=columns, use_pandas_metadata=True).to_pandas()
+    maps = [{k: v for k, v in pairs} for pairs in meta['maps']]
+    return (df, meta['question_cols'], *maps)
+
+
+def load_screening(target):
+    """The screening state stored with a snapshot, or None when it was hashed under another key."""
+    import pyarrow.parquet as pq
+
+    screening = snapshot_meta(target).get('screening')
+    if not screening or screening['key'] != quality.key_fingerprint():
+        return None
+    columns = screening['identity_columns']
+    identities = pq.read_table(target, columns=columns, use_pandas_metadata=True).to_pandas()[columns]
+    return {'invalid_prob_scale': screening['invalid_prob_scale'], 'identities': identities}
+
+
+def _latest_snapshot(path):
+    snapshot_dir = _snapshot_dir(path)
+    prefix = f"{_stem(path)}-v{SNAPSHOT_VERSION}-"
+    try:
+        candidates = [os.path.join(snapshot_dir, name) for name in os.listdir(snapshot_dir)
+                      if name.startswith(prefix) and name.endswith('.parquet')]
+    except OSError:
+        return None
+    return max(candidates, key=os.path.getmtime, default=None)
+
+
+def _max_id(raw):
+    return int(raw['编号'].max()) if '编号' in raw.columns and raw['编号'].notna().any() else None
+
+
+def _merge_parts(parts):
+    # Categories differ between parts, so the concatenated frame is re-compacted
+    flag_cols = [c for c in parts[0].columns if parts[0][c].dtype == np.uint8]
+    return compact_dtypes(pd.concat(parts), flag_cols)
+
+
+def _split_screening_inputs(df):
+    inputs = df[[col for col in quality.SCREENING_INPUTS if col in df.columns]]
+    return df.drop(columns=inputs.columns), inputs
+
+
+def _read_unscreened(path, codebook, chunksize=CHUNK_SIZE, **read_kwargs):
+    # (outputs, screening inputs, watermark) of read_survey, before screen_responses
+    parts, inputs, question_cols, watermark, outputs = [], [], set(), None, None
+    chunks = pd.read_csv(path, usecols=lambda c: c in INGEST_COLUMNS, chunksize=chunksize, **read_kwargs)
+    for chunk in chunks:
+        chunk_max = _max_id(chunk)
+        if chunk_max is not None:
+            watermark = chunk_max if watermark is None else max(watermark, chunk_max)
+        outputs = process_survey(chunk, codebook)
+        part, part_inputs = _split_screening_inputs(outputs[0])
+        parts.append(part)
+        inputs.append(part_inputs)
+        question_cols.update(outputs[1])
+    if outputs is None:
+        outputs = process_survey(pd.read_csv(path, usecols=lambda c: c in INGEST_COLUMNS, nrows=0), codebook)
+        df, part_inputs = _split_screening_inputs(outputs[0])
+        return (df, *outputs[1:]), part_inputs, None
+    _, _, *maps = outputs
+    return (_merge_parts(parts), sorted(question_cols), *maps), pd.concat(inputs), watermark
+
+
+def read_survey(path, codebook=None, chunksize=CHUNK_SIZE, **read_kwargs):
+    """Stream a raw export through process_survey one chunk at a time.
+
+    Only INGEST_COLUMNS are parsed, and each chunk is filtered, encoded and compacted before the
+    next one is read, so peak memory is one raw chunk plus the compact result. The codebook is
+    extended in file order, which gives the same codes as processing the file in one go.
+    Returns (outputs, watermark, screening), where screening is the state of
+    quality.screen_responses for save_snapshot.
+    """
+    if codebook is None:
+        codebook = {}
+    (df, *rest), inputs, watermark = _read_unscreened(path, codebook, chunksize, **read_kwargs)
+    df, screening = quality.screen_responses(df, inputs)
+    return (df, *rest), watermark, screening
+
+
+def append_new_rows(path, snapshot, codebook):
+    """Merge the rows added to `path` since `snapshot` was built into that snapshot.
+
+    The export must still hold the snapshot's data rows byte for byte, either first (rows
+    appended at the end) or last (newest rows first, as the survey platform exports them), and
+    every other row must be past the watermark. Only those other rows are read, by byte offset,
+    and encoded with the frozen codebook. Returns (outputs, watermark, screening), or None when
+    rows were edited, deleted or reordered, or the snapshot's identity hashes were made under
+    another key, and the export needs a full rebuild.
+    """
+    meta = snapshot_meta(snapshot)
+    watermark, rows = meta.get('watermark'), meta.get('rows')
+    if watermark is None or not rows or not codebook:
+        return None
+    screening = load_screening(snapshot)
+    if screening is None:
+        return None
+    with open(path, 'rb') as f:
+        header = f.readline()
+    if hashlib.sha256(header).hexdigest() != rows['header']:
+        return None
+    start, old_length = len(header), rows['length']
+    new_length = os.path.getsize(path) - start - old_length
+    if new_length < 0:
+        return None  # Rows were deleted
+    outputs = load_snapshot(snapshot)
+    if new_length == 0:
+        return (outputs, watermark, screening) if _range_digest(path, start, old_length) == rows['digest'] else None
+
+    # (start of the snapshot's rows, start of the new rows)
+    for old_start, new_start in ((start, start + old_length), (start + new_length, start)):
+        new_rows = _read_range(path, new_start, new_length)
+        # The byte before the second part must end a line
+        boundary = _read_range(path, old_start + old_length - 1, 1) if old_start == start else new_rows[-1:]
+        if boundary != b'\n':
+            continue
+        if _range_digest(path, old_start, old_length) == rows['digest']:
+            break
+    else:
+        return None
+
+    delta = header + new_rows
+    try:
+        ids = pd.read_csv(io.BytesIO(delta), usecols=['编号'])['编号']
+    except ValueError:
+        return None
+    if ids.empty or not (ids > watermark).all():
+        return None  # Rows were edited or re-numbered
+
+    (delta_df, delta_question_cols, *maps), inputs, delta_watermark = _read_unscreened(io.BytesIO(delta), codebook)
+    old_df, old_question_cols = outputs[0], outputs[1]
+    delta_df.index = inputs.index = np.arange(len(delta_df)) + (old_df.index.max() + 1 if len(old_df) else 0)
+
+    # Speeding and duplicates depend on every response, so the merged frame is screened again
+    try:
+        df, screening = quality.screen_responses(_merge_parts([old_df, delta_df]), inputs, screening)
+    except ValueError:
+        return None
+    question_cols = sorted(set(old_question_cols) | set(delta_question_cols))
+    return (df, question_cols, *maps), delta_watermark, screening
+
+
+def load_and_process_data(path=DATA_PATH, use_snapshot=True, incremental=True):
+    """Return the processed survey outputs, reusing the on-disk snapshot when data.csv is unchanged.
+
+    When data.csv changed but only gained rows, those rows are appended to the previous snapshot
+    instead of reprocessing the whole export (set incremental=False to force a full rebuild).
+    """
+    if not use_snapshot:
+        return read_survey(path)[0]
+
+    target = snapshot_path(path, file_digest(path))
+    if os.path.exists(target):
+        try:
+            return load_snapshot(target)
+        except Exception:
+            pass  # Corrupt or incompatible snapshot: rebuild it below
+
+    codebook = load_codebook(path)
+    result = None
+    previous = _latest_snapshot(path) if incremental else None
+    if previous and previous != target:
+        try:
+            result = append_new_rows(path, previous, codebook)
+        except Exception:
+            result = None
+    if result is None:
+        result = read_survey(path, codebook)
+    outputs, watermark, screening = result
+
+    try:
+        save_codebook(path, codebook)
+        save_snapshot(target, outputs, watermark, data_rows_region(path), screening)
+    except (ImportError, OSError):
+        pass  # Read-only deployments or missing pyarrow simply skip the snapshot
+    return outputs
@@ -0,0 +1,86 @@
+import importlib.util
+import io
+
+import pandas as pd
+
+# Rows serialized per step, so large exports never build one giant intermediate
+EXPORT_CHUNK_ROWS = 50_000
+
+# Format name shown in the UI -> (file extension, MIME type, module it needs)
+EXPORT_FORMATS = {
+    'CSV': ('csv', 'text/csv', None),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet', 'pyarrow'),
+    'XLSX': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'openpyxl'),
+}
+
+
+def available_formats():
+    # find_spec only looks the module up, it does not import it
+    return [name for name, (_, _, module) in EXPORT_FORMATS.items()
+            if module is None or importlib.util.find_spec(module) is not None]
+
+
+def export_file_name(stem, fmt):
+    return f"{stem}.{EXPORT_FORMATS[fmt][0]}"
+
+
+def export_mime(fmt):
+    return EXPORT_FORMATS[fmt][1]
+
+
+def _chunks(df):
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        yield df.iloc[start:start + EXPORT_CHUNK_ROWS]
+
+
+def to_csv_bytes(df, index=False):
+    # utf-8-sig so Excel opens the Chinese headers correctly
+    buf = io.BytesIO()
+    df.to_csv(buf, index=index, encoding='utf-8-sig', chunksize=EXPORT_CHUNK_ROWS)
+    return buf.getvalue()
+
+
+def _arrow_safe(df):
+    # Columns mixing numbers and text (e.g. the chi-square row of the category table) become text
+    fixed = {}
+    for col in df.columns:
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True).startswith('mixed'):
+            fixed[col] = df[col].map(lambda v: v if pd.isna(v) else str(v))
+    return df.assign(**fixed) if fixed else df
+
+
+def to_parquet_bytes(df, index=False):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = _arrow_safe(df.reset_index() if index else df)
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    buf = io.BytesIO()
+    with pq.ParquetWriter(buf, schema) as writer:
+        for chunk in _chunks(df):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    return buf.getvalue()
+
+
+def to_xlsx_bytes(df, index=False):
+    from openpyxl import Workbook
+
+    df = df.reset_index() if index else df
+    # Write-only mode streams rows to the file instead of keeping every cell object in memory
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append([str(col) for col in df.columns])
+    for chunk in _chunks(df):
+        chunk = chunk.astype(object)
+        for row in chunk.where(chunk.notna(), None).itertuples(index=False, name=None):
+            ws.append(row)
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+_WRITERS = {'CSV': to_csv_bytes, 'Parquet': to_parquet_bytes, 'XLSX': to_xlsx_bytes}
+
+
+def export_bytes(df, fmt='CSV', index=False):
+    return _WRITERS[fmt](df, index=index)
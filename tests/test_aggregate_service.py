@@ -0,0 +1,79 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import aggregate_service
+import quality
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    # A copy of data.csv, so that the snapshot is written to a temporary directory
+    data_dir = tmp_path_factory.mktemp('data')
+    path = str(data_dir / 'data.csv')
+    shutil.copy(os.path.join(ROOT, 'data.csv'), path)
+    return aggregate_service.AggregateService(discover=lambda: {'data': path})
+
+
+def get(app, url, **headers):
+    status, response_headers, body = aggregate_service.request(app, url, headers)
+    return status, response_headers, json.loads(body) if body else None
+
+
+def test_group_means(app):
+    status, headers, body = get(app, '/group-means?group=Region&metric=awkward_score')
+    assert status == 200
+    assert headers['Content-Type'].startswith('application/json')
+    assert body['metrics'] == ['awkward_score']
+    assert {row['metric'] for row in body['data']} == {'awkward_score'}
+
+
+def test_etag_revalidation(app):
+    url = '/threshold-counts?metric=awkward_score&thresholds=-4,-2'
+    status, headers, _ = get(app, url)
+    assert status == 200
+    status, _, body = get(app, url, **{'If-None-Match': headers['ETag']})
+    assert (status, body) == (304, None)
+    # Another query is another ETag
+    _, other, _ = get(app, url + '&exclude=none')
+    assert other['ETag'] != headers['ETag']
+
+
+def test_quality_exclusion_defaults_to_the_app(app):
+    url = '/threshold-counts?metric=awkward_score&thresholds=-4,-2'
+    _, _, default = get(app, url)
+    _, _, explicit = get(app, url + ''.join(f'&exclude={check}' for check in quality.DEFAULT_EXCLUDED))
+    _, _, everything = get(app, url + '&exclude=none')
+    assert default['n'] == explicit['n'] < everything['n']
+
+
+@pytest.mark.parametrize('url', [
+    '/group-means?group=Region&metric=nope',
+    '/group-means?group=nope',
+    '/threshold-counts?metric=awkward_score',
+    '/threshold-counts?metric=awkward_score&thresholds=a,b',
+    '/threshold-counts?metric=awkward_score&thresholds=-4&exclude=bogus',
+    '/group-means?group=Region&wave=nope',
+    '/group-means?group=Region&gendr_str=男',
+    '/quality?metric=awkward_score',
+])
+def test_bad_queries(app, url):
+    status, _, body = get(app, url)
+    assert status == 400
+    assert body['error']
+
+
+def test_unknown_endpoint(app):
+    status, _, body = get(app, '/nope')
+    assert status == 404
+    assert '/group-means' in body['endpoints']
+
+
+def test_read_only(app):
+    status, _, body = aggregate_service.request(app, '/quality', method='POST')
+    assert status == 405
+    assert json.loads(body)['error']
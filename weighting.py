@@ -0,0 +1,132 @@
+"""Survey weights that make the respondent mix match known population margins.
+
+`rake` runs iterative proportional fitting (raking): the weights are scaled to each column's
+target shares in turn until every margin holds at once. Respondents with the same answers on
+the margin columns always end up with the same weight, so they are collapsed into cells first
+and each iteration is a few bincounts over the cells; the cost hardly grows with the number of
+respondents, and multi-wave data rakes as fast as a single wave.
+"""
+import numpy as np
+import pandas as pd
+
+# Columns population margins can be given for
+RAKING_DIMENSIONS = ['gender_str', 'grade_str', 'Region', 'native_str']
+RAKING_LABELS = {'gender_str': "性别", 'grade_str': "年级", 'Region': "地区", 'native_str': "上海人身份"}
+RAKING_MAX_ITER = 200
+# Largest gap between a weighted margin and its target, as a share of all respondents
+RAKING_TOLERANCE = 1e-6
+
+
+def sample_margins(df, dims=RAKING_DIMENSIONS):
+    """{column: {level: share of respondents}}: margins that leave every weight at 1."""
+    margins = {}
+    for dim in dims:
+        if dim in df.columns:
+            shares = df[dim].value_counts(normalize=True, sort=False)
+            margins[dim] = {level: float(share) for level, share in shares.items() if share > 0}
+    return margins
+
+
+def rake(df, margins, max_iter=RAKING_MAX_ITER, tolerance=RAKING_TOLERANCE):
+    """Raking weights for the rows of `df` that reproduce `margins`.
+
+    `margins` is {column: {level: population share}}; shares are normalized per column. Rows
+    whose answer is missing or has no positive share get weight 0, levels with a share but no
+    respondents are reported and the column's other shares rescaled. Weights average 1 over the
+    weighted rows. Returns (weights as a Series aligned with `df`, info dict).
+    """
+    dims = [dim for dim in margins if dim in df.columns and margins[dim]]
+    eligible = np.ones(len(df), dtype=bool)
+    codes, targets, levels = [], [], []
+    for dim in dims:
+        shares = {level: float(share) for level, share in margins[dim].items() if float(share) > 0}
+        dim_codes = pd.Index(list(shares)).get_indexer(df[dim]).astype(np.int64)
+        eligible &= dim_codes >= 0
+        codes.append(dim_codes)
+        targets.append(np.array(list(shares.values())))
+        levels.append(list(shares))
+
+    info = {'iterations': 0, 'converged': True, 'max_error': 0.0, 'cells': 0,
+            'respondents': int(eligible.sum()), 'excluded': int((~eligible).sum()), 'unmatched': {}}
+    weights = np.where(eligible, 1.0, 0.0)
+    if not dims or not eligible.any():
+        return pd.Series(weights, index=df.index), info
+
+    # One integer per combination of answers (mixed radix), then one weight per distinct combination
+    key = np.zeros(int(eligible.sum()), dtype=np.int64)
+    for dim_codes, target in zip(codes, targets):
+        key = key * len(target) + dim_codes[eligible]
+    cell_of_row, cell_keys = pd.factorize(key)
+    cell_n = np.bincount(cell_of_row).astype(float)
+    total = cell_n.sum()
+    cell_codes = []
+    for target in reversed(targets):
+        cell_codes.append(cell_keys % len(target))
+        cell_keys = cell_keys // len(target)
+    cell_codes.reverse()
+
+    goals = []
+    for dim, dim_levels, cells, target in zip(dims, levels, cell_codes, targets):
+        present = np.bincount(cells, weights=cell_n, minlength=len(target)) > 0
+        if not present.all():
+            info['unmatched'][dim] = [level for level, p in zip(dim_levels, present) if not p]
+        target = np.where(present, target, 0)
+        goals.append(target / target.sum() * total)
+
+    cell_w = np.ones(len(cell_n))
+    for iteration in range(1, max_iter + 1):
+        for cells, goal in zip(cell_codes, goals):
+            current = np.bincount(cells, weights=cell_n * cell_w, minlength=len(goal))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                factor = np.where(current > 0, goal / current, 0.0)
+            cell_w *= factor[cells]
+        error = max(np.abs(np.bincount(cells, weights=cell_n * cell_w, minlength=len(goal)) - goal).max()
+                    for cells, goal in zip(cell_codes, goals)) / total
+        if error < tolerance:
+            break
+    info.update(iterations=iteration, converged=bool(error < tolerance), max_error=float(error), cells=len(cell_n))
+
+    weights[eligible] = cell_w[cell_of_row]
+    weights = pd.Series(weights, index=df.index)
+    info.update(effective_n=effective_n(weights), design_effect=design_effect(weights),
+                min_weight=float(cell_w.min()), max_weight=float(cell_w.max()))
+    return weights, info
+
+
+def effective_n(weights):
+    """Kish effective sample size, (sum w)^2 / sum w^2."""
+    weights = np.asarray(weights, dtype=float)
+    squares = (weights ** 2).sum()
+    return float(weights.sum() ** 2 / squares) if squares > 0 else 0.0
+
+
+def design_effect(weights):
+    """Kish design effect of unequal weights: respondents with weight > 0 / effective_n."""
+    weights = np.asarray(weights, dtype=float)
+    n_eff = effective_n(weights)
+    return float((weights > 0).sum() / n_eff) if n_eff > 0 else np.nan
+
+
+def weighted_quantile(values, weights, q):
+    # The smallest value whose cumulative weight reaches q of the total
+    order = np.argsort(values, kind='stable')
+    cumulative = np.cumsum(weights[order])
+    positions = np.searchsorted(cumulative, np.asarray(q) * cumulative[-1], side='left')
+    return values[order][np.minimum(positions, len(values) - 1)]
+
+
+def weighted_describe(values, weights):
+    """Like Series.describe(), with weighted mean, standard deviation and quartiles; 'count' is
+    the number of weighted respondents."""
+    values = pd.Series(values).to_numpy(dtype=float, na_value=np.nan)
+    weights = np.asarray(weights, dtype=float)
+    keep = ~np.isnan(values) & (weights > 0)
+    values, weights = values[keep], weights[keep]
+    index = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+    if len(values) == 0:
+        return pd.Series([0.0] + [np.nan] * 7, index=index)
+    mean = np.average(values, weights=weights)
+    n = len(values)
+    std = np.sqrt(np.average((values - mean) ** 2, weights=weights) * n / (n - 1)) if n > 1 else np.nan
+    quartiles = weighted_quantile(values, weights, [0.25, 0.5, 0.75])
+    return pd.Series([float(n), mean, std, values.min(), *quartiles, values.max()], index=index)